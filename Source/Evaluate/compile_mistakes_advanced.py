@@ -50,15 +50,12 @@ def compile_mistakes(experiment_id, experiment_signature="InteractivePuzzle"):
             representation_type = game_info.get('representation_type', "unknown")
             config_id = game_info.get('config_id', "unknown")
 
-            # Load sim_message_log.json
-            sim_message_log_file_path = os.path.join(sub_dir, "sim_message_log.json")
-            if not os.path.exists(sim_message_log_file_path):
+            # Load sim_message_log.json, or the JSON Lines log of an unfinalized episode
+            sim_message_log = util.load_sim_message_log(sub_dir)
+            if sim_message_log is None:
                 print(f"No sim_message_log.json file found in {sub_dir}. Skipping...")
                 continue
 
-            with open(sim_message_log_file_path, 'r') as sim_message_log_file:
-                sim_message_log = json.load(sim_message_log_file)
-
             # Count occurrences of specific strings in "valididy"
             legal_move_count = 0
             destination_occupied_count = 0
@@ -16,9 +16,8 @@ from calculate_shortest_path_length import calculate_shortest_path_length
 
 def evaluate_episodes(experiment_id, experiment_signature="InteractivePuzzle"):
     # Set signatures and file paths
-    system_json_files_signature = "sim_message_log.json"
     config_json_files_signature = "config_*.json"
-    file_signatures = [system_json_files_signature, config_json_files_signature]
+    file_signatures = [config_json_files_signature]
 
     # Get directory and file paths
     experiment_dir, results_dir = util.make_results_dir(experiment_id)
@@ -29,8 +28,7 @@ def evaluate_episodes(experiment_id, experiment_signature="InteractivePuzzle"):
         file_dict = util.bulk_load_files(sub_dir, file_signatures)
         # Load board size, goal state and current step state
         try:
-            with open(file_dict[system_json_files_signature][0], 'r') as system_config_file:
-                interaction_log = json.load(system_config_file)
+            interaction_log = util.load_sim_message_log(sub_dir)
             with open(file_dict[config_json_files_signature][0], 'r') as env_config_file:
                 env_config = json.load(env_config_file)
         except Exception as e:
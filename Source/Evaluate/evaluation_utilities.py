@@ -1,8 +1,13 @@
 import os
+import sys
 import json
 import numpy as np
 import pandas as pd
 
+# The episode logs are written by the experiment code
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Experiment')))
+from episode_logs import load_sim_message_log
+
 
 def make_results_dir(experiment_id):
     # Set up paths for experiment directory and results directory
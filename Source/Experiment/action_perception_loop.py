@@ -1,18 +1,31 @@
+import asyncio
 import websockets
 import base64
 import time
 import json
 import logging
+from contextlib import nullcontext
 import experiment_utilities as util
 
 from experiment_logging import log_separator
 
-async def initialize_connection(uri):
+SERVER_ID = "0000-0000-0000-0000"
+
+
+async def initialize_connection(uri, partner_id=None, auto_pair=True, capability=None, claim_timeout=300, retry_interval=1.0):
     """
     Initialize the WebSocket connection, perform the handshake, and register the partner ID.
 
+    The partner is taken from partner_id if given, otherwise a free simulator is claimed from the relay's
+    pool when auto_pair is set, and only as a last resort the user is asked to enter the remote client id.
+
     Args:
         uri (str): The WebSocket server URI.
+        partner_id (str): Network id of a known simulator to pair with.
+        auto_pair (bool): Claim a simulator from the relay's pool instead of asking for its id.
+        capability (str): Capability tag the claimed simulator must have, None accepts any.
+        claim_timeout (float): Seconds to keep trying to claim a simulator before giving up.
+        retry_interval (float): Seconds to wait between two claim attempts.
 
     Returns:
         tuple: A tuple containing the WebSocket connection, network ID, and partner ID.
@@ -31,10 +44,12 @@ async def initialize_connection(uri):
 
         # Register partner ID
         isConnected = False
-        partner_id = None
         while not isConnected:
-            partner_id = input("Please enter the remote client id: ")
-            print()  # This ensures the cursor moves to a new line
+            if partner_id is None and auto_pair:
+                partner_id = await claim_simulator(websocket, network_id, capability, claim_timeout, retry_interval)
+            elif partner_id is None:
+                partner_id = input("Please enter the remote client id: ")
+                print()  # This ensures the cursor moves to a new line
             message_data = {
                 "command": "Handshake",
                 "from": network_id,
@@ -50,6 +65,10 @@ async def initialize_connection(uri):
             logging.info(f"Received {command}: {message_data.get('messages')}")
             if command == "ACK":
                 isConnected = True
+            else:
+                if auto_pair:
+                    await release_simulator(websocket, network_id)
+                partner_id = None
 
         return websocket, network_id, partner_id
     except Exception as e:
@@ -57,6 +76,57 @@ async def initialize_connection(uri):
         raise e
 
 
+async def claim_simulator(websocket, network_id, capability=None, claim_timeout=300, retry_interval=1.0):
+    """
+    Claim a free simulator from the relay's pool, waiting for one to announce itself if none is free.
+
+    Args:
+        websocket: The active WebSocket connection.
+        network_id (str): The client network ID.
+        capability (str): Capability tag the simulator must have, None accepts any.
+        claim_timeout (float): Seconds to keep trying before giving up.
+        retry_interval (float): Seconds to wait between two claim attempts.
+
+    Returns:
+        str: The network id of the claimed simulator.
+
+    Raises:
+        TimeoutError: If no simulator could be claimed within claim_timeout.
+    """
+    deadline = time.monotonic() + claim_timeout
+    while True:
+        message_data = {
+            "command": "Claim",
+            "from": network_id,
+            "to": SERVER_ID,
+            "messages": [json.dumps({"role": "runner", "capability": capability})],
+            "payload": "",
+        }
+        await websocket.send(json.dumps(message_data))
+        response = json.loads(await websocket.recv())
+        if response.get("command") == "Claimed":
+            simulator_id = response.get("messages")[0]
+            logging.info(f"Claimed simulator {simulator_id}")
+            return simulator_id
+
+        logging.info(f"Waiting for a free simulator: {response.get('messages')}")
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"No simulator with capability '{capability}' could be claimed within {claim_timeout}s")
+        await asyncio.sleep(retry_interval)
+
+
+async def release_simulator(websocket, network_id):
+    """Return the claimed simulator to the relay's pool so the next runner can use it."""
+    message_data = {
+        "command": "Release",
+        "from": network_id,
+        "to": SERVER_ID,
+        "messages": ["release simulator"],
+        "payload": "",
+    }
+    await websocket.send(json.dumps(message_data))
+
+
 async def interact_with_server(websocket, network_id, partner_id, agent, game, episode_logger):
     """
     Perform repeated interactions with the server after the connection has been established.
@@ -72,61 +142,71 @@ async def interact_with_server(websocket, network_id, partner_id, agent, game, e
     response = await websocket.recv()
     message_data = json.loads(response)
     delay = agent.delay
+    # LLM agents record the timings and tokens of every act call, see step_metrics
+    telemetry = getattr(agent, "telemetry", None)
 
-    i = 0
-    while not game.check_done(message_data):
-        log_separator(f"Action-Perception Loop: {i}", logger=episode_logger)
-        time.sleep(delay)
-        if message_data.get("command") == "Screenshot" or message_data.get("command") == "ActionAck":
-            observation = game.feed_sim_response(message_data, i)
-            user_message = agent.act(observation, i)
-            game.feed_agent_response(user_message)
-
-        # Exit the loop if the user wants to close the connection
-        if user_message.lower() == "reset":
-            message_data = {
-                "command": "Reset",
-                "from": network_id,
-                "to": partner_id,  # Server ID or specific target ID
-                "messages": ["reset to main menu"],
-                "payload": base64.b64encode(b"Optional binary data").decode("utf-8")
-            }
-            await websocket.send(json.dumps(message_data))
-            break
-        if user_message.lower() == "exit":
-            episode_logger.info("Closing connection...")
-            message_data = {
-                "command": "Reset",
-                "from": network_id,
-                "to": partner_id,  # Server ID or specific target ID
-                "messages": ["reset to main menu"],
-                "payload": base64.b64encode(b"Optional binary data").decode("utf-8")
-            }
-            await websocket.send(json.dumps(message_data))
-            await websocket.close()
-            episode_logger.info("Connection closed")
-            break
-        else:
-            message_list = [msg.strip() for msg in user_message.split(",")]
-            # Create a JSON-formatted message
-            # print(message_list)
-            message_data = {
-                "command": "GameInteraction",
-                "from": network_id,
-                "to": partner_id,  # Server ID or specific target ID
-                "messages": message_list,
-                "payload": base64.b64encode(b"Optional binary data").decode("utf-8")
-            }
-            await websocket.send(json.dumps(message_data))
-            response = await websocket.recv()
-            message_data = json.loads(response)
-
-        i += 1
-        game._save_logs()
-
-    #save last observation after game is done
-    observation = game.feed_sim_response(message_data, i)
-    game._save_logs()
+    try:
+        i = 0
+        while not game.check_done(message_data):
+            log_separator(f"Action-Perception Loop: {i}", logger=episode_logger)
+            time.sleep(delay)
+            if message_data.get("command") == "Screenshot" or message_data.get("command") == "ActionAck":
+                observation = game.feed_sim_response(message_data, i)
+                with telemetry.step(i) if telemetry is not None else nullcontext():
+                    user_message = agent.act(observation, i)
+                game.feed_agent_response(user_message)
+
+            # Exit the loop if the user wants to close the connection
+            if user_message.lower() == "reset":
+                message_data = {
+                    "command": "Reset",
+                    "from": network_id,
+                    "to": partner_id,  # Server ID or specific target ID
+                    "messages": ["reset to main menu"],
+                    "payload": base64.b64encode(b"Optional binary data").decode("utf-8")
+                }
+                await websocket.send(json.dumps(message_data))
+                break
+            if user_message.lower() == "exit":
+                episode_logger.info("Closing connection...")
+                message_data = {
+                    "command": "Reset",
+                    "from": network_id,
+                    "to": partner_id,  # Server ID or specific target ID
+                    "messages": ["reset to main menu"],
+                    "payload": base64.b64encode(b"Optional binary data").decode("utf-8")
+                }
+                await websocket.send(json.dumps(message_data))
+                await websocket.close()
+                episode_logger.info("Connection closed")
+                break
+            else:
+                message_list = [msg.strip() for msg in user_message.split(",")]
+                # Create a JSON-formatted message
+                # print(message_list)
+                message_data = {
+                    "command": "GameInteraction",
+                    "from": network_id,
+                    "to": partner_id,  # Server ID or specific target ID
+                    "messages": message_list,
+                    "payload": base64.b64encode(b"Optional binary data").decode("utf-8")
+                }
+                await websocket.send(json.dumps(message_data))
+                response = await websocket.recv()
+                message_data = json.loads(response)
+
+            i += 1
+            game._save_logs()
+
+        #save last observation after game is done
+        observation = game.feed_sim_response(message_data, i)
+        game.end_game()
+    finally:
+        # Also when the episode fails, so its steps reach the file and the experiment totals
+        if telemetry is not None:
+            telemetry.close()
+        # Stop the observation writer threads and keep the frames the episode saw before it failed
+        game.close_observations()
 
     # Send the JSON message to the server
     #response = await websocket.recv()
@@ -1,23 +1,42 @@
 import base64
 from logging import raiseExceptions
 
-import requests
 import io
 import os
-from anthropic import Anthropic
-import google.generativeai as genai
 from abc import ABC, abstractmethod
 import re
 import logging
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image
 import experiment_utilities as util
-
-# open source deps
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
-from qwen_vl_utils import process_vision_info
+import annotation
+from component_registry import LazyModule
+import provider_transport
+import provider_scheduler
+from state_images import EpisodeImageCache
+from image_pipeline import ImagePipeline
+from response_cache import get_response_cache, sampling_params, ResponseCacheMiss
+from history_builder import HistoryBuilder
+import step_metrics
+from step_metrics import StepTelemetry
+from model_host import get_model_host
+
+# Provider and open source deps, imported when an agent first uses them
+genai = LazyModule("google.generativeai")
 
 DEBUG = False
 
+OPENAI_CHAT_COMPLETIONS_URL = "https://api.openai.com/v1/chat/completions"
+
+# Sampling of the open source models
+QWEN2_GENERATION_KWARGS = {
+    "max_new_tokens": 300,
+    "temperature": 1.0,  # Increased from 0.7
+    "top_k": 50,  # Added top_k sampling
+    "top_p": 0.95,  # Added nucleus sampling
+    "do_sample": True,  # Enable sampling
+    "repetition_penalty": 1.05,
+}
+
 class Agent(ABC):
     """
     Abstract base class for agents.
@@ -87,10 +106,19 @@ class UserAgent(Agent):
 class LLMAgent:
     """Parent class for LLM-based agents"""
 
+    provider = None  # Name of the API provider, selects the rate limits the agent shares
+
     def __init__(self, episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path,
-                 visual_state_embedding='label', single_images=True, COT=False, delay=0, max_history=0):
+                 visual_state_embedding='label', single_images=True, COT=False, delay=0, max_history=0,
+                 request_timeout=None, rate_limits=None, image_pipeline=None, response_cache=None,
+                 history_token_budget=None):
         self.max_history = max_history
         self.api_keys = load_api_keys(api_key_file_path)
+        # Connection pool and rate limits shared with the other agents and episodes of the process
+        self.transport = provider_transport.get_transport(request_timeout)
+        self.scheduler = provider_scheduler.get_scheduler(self.provider, **(rate_limits or {}))
+        # Responses of earlier runs, reused when the same request is sent again
+        self.response_cache = get_response_cache(response_cache)
         self.goal_state = None
         self.single_images = single_images
         self.COT = COT
@@ -98,6 +126,15 @@ class LLMAgent:
         self.visual_state_embedding = visual_state_embedding
         self.episode_logger = episode_logger
         self.delay = delay
+        # Annotated and encoded state images of the episode, each frame is processed once
+        self.image_pipeline = ImagePipeline.from_params(image_pipeline, self.provider)
+        self.image_cache = EpisodeImageCache(visual_state_embedding, self.color_codes, self.image_pipeline,
+                                             max_history)
+        # Previous turns of the requests, trimmed to the token budget
+        self.history = HistoryBuilder(self.image_cache, self.provider, max_history, history_token_budget,
+                                      episode_logger)
+        # Timings, tokens and image bytes of every act call, see step_metrics
+        self.telemetry = StepTelemetry(episode_path, type(self).__name__, episode_logger)
 
         # Create the 'obs' subdirectory inside the save path
         self.obs_dir = os.path.join(episode_path, 'obs')
@@ -140,6 +177,10 @@ class LLMAgent:
         pil_image.save(buffer, format="PNG")
         return base64.b64encode(buffer.getvalue()).decode('utf-8')
 
+    def log_image_stats(self):
+        """Log the bytes and estimated tokens of the images sent in this step."""
+        self.episode_logger.info(f"\nImages sent: {self.image_cache.take_step_stats().summary()}")
+
     def process_goal_state(self, observation):
         """Process and store the goal state"""
         self.episode_logger.info("\n=== Receiving Goal State ===")
@@ -147,6 +188,7 @@ class LLMAgent:
         return "start"
 
 
+    @step_metrics.timed("parse")
     def parse_action(self, response, split_at="action: move "):
         """
         Extract the last action from model response, handling case-insensitivity,
@@ -183,6 +225,7 @@ class LLMAgent:
 
         return action, thoughts
 
+    @step_metrics.timed("parse")
     def parse_action_rmv_special_chars(self, action):
         """
         Cleans the input string to ensure it is safe to use as part of a file name.
@@ -237,78 +280,10 @@ class LLMAgent:
 
     def add_action_text(self, image, action_text, color="black"):
         """
-        Adds the action text in large red letters with a light white, semi-transparent box behind it
-        on the top-right corner of the image, 50 pixels away from the top and right border, with rounded corners.
-
-        Args:
-            image (PIL.Image): The image on which to add the action text.
-            action_text (str): The action text to add to the image.
-
-        Returns:
-            PIL.Image: The image with the action text added.
+        Adds the action text with a semi-transparent box behind it on the top-right corner of the image,
+        see annotation.add_action_text.
         """
-        # Ensure the image is in RGBA mode (supports transparency)
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
-
-        # Create a drawing context
-        draw = ImageDraw.Draw(image)
-
-        # Try to load a larger font size
-        try:
-            font = ImageFont.truetype("arial.ttf", 50)  # Increased font size to 80
-        except IOError:
-            logging.error("Warning: 'arial.ttf' not found. Using default font.")
-            font = ImageFont.load_default()
-
-        # Get text bounding box
-        text_bbox = draw.textbbox((0, 0), action_text, font=font)
-        text_width, text_height = text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]
-
-        # Add extra padding to make the box slightly larger than the text
-        box_extra_padding = 20  # Adjust this value to control how much larger the box should be
-        border_thickness = 3  # Thickness of the black border
-
-        # Set padding, border offset, and corner radius for rounded edges
-        padding = 10
-        border_offset = 50
-        corner_radius = 20  # Radius for the rounded corners
-
-        # Calculate box and text position (50 pixels from the top and right with additional padding)
-        text_x = image.width - text_width - padding - border_offset
-        text_y = border_offset
-        box_x0 = text_x - padding - box_extra_padding
-        box_y0 = text_y - padding - box_extra_padding
-        box_x1 = image.width - padding - border_offset + box_extra_padding
-        box_y1 = text_y + text_height + padding + box_extra_padding
-
-        # Create a semi-transparent overlay
-        overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))  # Transparent overlay
-        overlay_draw = ImageDraw.Draw(overlay)
-
-        # Draw a black border (slightly larger rectangle)
-        overlay_draw.rounded_rectangle(
-            [box_x0 - border_thickness, box_y0 - border_thickness,
-             box_x1 + border_thickness, box_y1 + border_thickness],
-            radius=corner_radius + border_thickness,
-            fill=(0, 0, 0, 255)  # Black border
-        )
-
-        # Draw a semi-transparent white box with rounded corners (50% transparency)
-        overlay_draw.rounded_rectangle(
-            [box_x0, box_y0, box_x1, box_y1],
-            radius=corner_radius,
-            fill=(255, 255, 255, 128)
-        )
-
-        # Composite the overlay onto the image
-        image = Image.alpha_composite(image, overlay)
-
-        # Draw the text in red on the original image
-        draw = ImageDraw.Draw(image)
-        draw.text((text_x, text_y), action_text, font=font, fill=color)
-
-        return image
+        return annotation.add_action_text(image, action_text, color)
 
 def load_api_keys(api_key_file_path):
     """Load API keys from file"""
@@ -404,7 +379,7 @@ def format_message_structure_gemini(content, cutoff=None):
 
     for item in content:
         # Handle different content types
-        if isinstance(item, Image.Image):
+        if isinstance(item, Image.Image) or (isinstance(item, dict) and 'mime_type' in item):
             content_preview = "[IMAGE]"
         elif isinstance(item, str):
             if cutoff and len(item) > cutoff:
@@ -423,8 +398,10 @@ def format_message_structure_gemini(content, cutoff=None):
 
 
 class GPT4Agent(LLMAgent):
-    def __init__(self, episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images=True, COT=False, delay=0, max_history=0):
-        super().__init__(episode_path, episode_logger,api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images, COT, delay, max_history)
+    provider = "openai"
+
+    def __init__(self, episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images=True, COT=False, delay=0, max_history=0, request_timeout=None, rate_limits=None, image_pipeline=None, response_cache=None, history_token_budget=None):
+        super().__init__(episode_path, episode_logger,api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images, COT, delay, max_history, request_timeout, rate_limits, image_pipeline, response_cache, history_token_budget)
         self.api_key = self.api_keys['GPT4_API_KEY']
         self.headers = {
             "Content-Type": "application/json",
@@ -457,13 +434,15 @@ class GPT4Agent(LLMAgent):
                     "max_tokens": 500
                 }
 
-                response = requests.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers=self.headers,
-                    json=payload
+                response_text = self.response_cache.complete(
+                    self.provider, self.model, payload["messages"], sampling_params(payload),
+                    lambda: self.scheduler.call(
+                        lambda: self.transport.post_json(OPENAI_CHAT_COMPLETIONS_URL, payload, headers=self.headers),
+                        estimated_tokens=provider_scheduler.estimate_tokens(payload["messages"]) + payload["max_tokens"]
+                    ).json()['choices'][0]['message']['content']
                 )
 
-                action, thoughts = self.parse_action(response.json()['choices'][0]['message']['content'], split_at='description:')
+                action, thoughts = self.parse_action(response_text, split_at='description:')
                 thoughts = self.parse_action_rmv_special_chars(thoughts)
                 action = self.parse_action_rmv_special_chars(action)
                 self.episode_logger.info(f"\nGPT suggested thoughts: {thoughts}")
@@ -472,12 +451,15 @@ class GPT4Agent(LLMAgent):
                 # Store the current exchange in history
                 self.chat_history.append({
                     "observation": observation,
+                    "step": loop_iteration,
                     "response": action
                 })
 
                 return action
 
 
+            except ResponseCacheMiss:
+                raise
             except Exception as e:
                 logging.error(f"\nError calling OpenAI API: {e}")
                 return "error"
@@ -493,67 +475,23 @@ class GPT4Agent(LLMAgent):
                 # Block of code that embeds information what this image represents, e.g. active (current) state, goal state
                 # or past state (later). There are several settings we can check for where the information about the
                 # state the image represents is marked by color, label, both or none
-                if self.visual_state_embedding == 'color':
-                    current = self.color_code_observation(observation.copy(), tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(), tuple(self.color_codes['goal_1']['rgb']))
-                elif self.visual_state_embedding == 'label':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    current = self.add_action_text(current.copy(), 'active')
-                    goal = self.add_action_text(goal.copy(), 'goal')
-                elif self.visual_state_embedding == 'both':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['goal_1']['rgb']))
-                    current = self.add_action_text(current.copy(), 'active')
-                    goal = self.add_action_text(goal.copy(), 'goal')
-                elif self.visual_state_embedding == 'none':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['active_1']['rgb']))
+                current = self.image_cache.image(observation, loop_iteration, 'active')
+                goal = self.image_cache.image(self.goal_state, None, 'goal')
 
 
-                current_base64 = self.encode_image_from_pil(current)
-                goal_base64 = self.encode_image_from_pil(goal)
+                current_base64 = self.image_cache.encoded(observation, loop_iteration, 'active')
+                goal_base64 = self.image_cache.encoded(self.goal_state, None, 'goal')
 
                 messages = [{"role": "system", "content": self.system_prompt}]
 
-                # Add history if available
-                if self.max_history > 0:
-                    for i, prev_exchange in enumerate(self.chat_history[-self.max_history:], 1):
-
-                        # Block of code that embeds information what this image represents, here past state.
-                        # There are several settings we can check for where the information about the
-                        # state the image represents is marked by color, label, both or none
-                        if self.visual_state_embedding == 'color':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(), tuple(self.color_codes['past']['rgb']))
-                        elif self.visual_state_embedding == 'label':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),  tuple(self.color_codes['active_1']['rgb']))
-                            prev_image_colored = self.add_action_text(prev_image_colored.copy(), 'past')
-                        elif self.visual_state_embedding == 'both':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),tuple(self.color_codes['past']['rgb']))
-                            prev_image_colored = self.add_action_text(prev_image_colored.copy(), 'past')
-                        elif self.visual_state_embedding == 'none':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),  tuple(self.color_codes['active_1']['rgb']))
-
-
-                        prev_image_base64 = self.encode_image_from_pil(prev_image_colored)
-                        # User message with image
-                        messages.append({
-                            "role": "user", 
-                            "content": [
-                                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{prev_image_base64}"}}
-                            ]
-                        })
-                        # Assistant response
-                        messages.append({
-                            "role": "assistant",
-                            "content": f"Action: {prev_exchange['response']}"
-                        })
+                # Add history if available, past states are labeled and encoded by the image cache
+                messages.extend(self.history.openai_messages(self.chat_history))
 
                 # Add goal state image
                 messages.append({
                     "role": "user",
                     "content": [
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{goal_base64}"}}
+                        {"type": "image_url", "image_url": {"url": f"data:{self.image_pipeline.media_type};base64,{goal_base64}"}}
                     ]
                 })
 
@@ -561,7 +499,7 @@ class GPT4Agent(LLMAgent):
                 messages.append({
                     "role": "user",
                     "content": [
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{current_base64}"}}
+                        {"type": "image_url", "image_url": {"url": f"data:{self.image_pipeline.media_type};base64,{current_base64}"}}
                     ]
                 })
 
@@ -596,6 +534,7 @@ class GPT4Agent(LLMAgent):
                     if self.max_history > 0:
                         for i, prev_exchange in enumerate(self.chat_history[-self.max_history:], 1):
                             try:
+                                prev_image_colored = self.image_cache.image(prev_exchange['observation'], prev_exchange.get('step'), 'past')
                                 prev_image_colored.save(filepath_obs_past)  # Save the image as a PNG
                             except Exception as e:
                                 logging.error(f"Error saving image to {filename_obs_past}.png: {e}")
@@ -649,6 +588,7 @@ class GPT4Agent(LLMAgent):
 
                 formatted_message = format_message_structure(messages) # use it for debugging make sure the input is correct
                 self.episode_logger.info(formatted_message)
+                self.log_image_stats()
 
                 payload = {
                     "model": self.model,
@@ -656,12 +596,15 @@ class GPT4Agent(LLMAgent):
                     "max_tokens": 500
                 }
 
-                response = requests.post("https://api.openai.com/v1/chat/completions",
-                    headers=self.headers,
-                    json=payload
+                response_text = self.response_cache.complete(
+                    self.provider, self.model, payload["messages"], sampling_params(payload),
+                    lambda: self.scheduler.call(
+                        lambda: self.transport.post_json(OPENAI_CHAT_COMPLETIONS_URL, payload, headers=self.headers),
+                        estimated_tokens=provider_scheduler.estimate_tokens(payload["messages"]) + payload["max_tokens"]
+                    ).json()['choices'][0]['message']['content']
                 )
 
-                action, thoughts = self.parse_action(response.json()['choices'][0]['message']['content'])
+                action, thoughts = self.parse_action(response_text)
                 thoughts = self.parse_action_rmv_special_chars(thoughts)
                 action = self.parse_action_rmv_special_chars(action)
                 self.episode_logger.info(f"\nGPT suggested thoughts: {thoughts}")
@@ -670,11 +613,14 @@ class GPT4Agent(LLMAgent):
                 # Store the current exchange in history
                 self.chat_history.append({
                     "observation": observation,
+                    "step": loop_iteration,
                     "response": action
                 })
 
                 return action
 
+            except ResponseCacheMiss:
+                raise
             except Exception as e:
                 logging.error(f"\nError calling OpenAI API: {e}")
                 return "error"
@@ -692,12 +638,7 @@ class GPT4Agent(LLMAgent):
                 messages = [{"role": "system", "content": self.system_prompt}]
                 
                 # Add conversation history
-                if self.max_history > 0:
-                    for i, prev_exchange in enumerate(self.chat_history[-self.max_history:], 1):
-                        messages.extend([
-                            {"role": "user", "content": f"Previous observation {i}: {prev_exchange['observation']}"},
-                            {"role": "assistant", "content": f"Previous action {i}: {prev_exchange['response']}"}
-                        ])
+                messages.extend(self.history.openai_messages(self.chat_history))
 
                 # Add current observation
                 current_content = [
@@ -736,13 +677,15 @@ class GPT4Agent(LLMAgent):
                     "temperature": 0.5 # default is 0
                 }
 
-                response = requests.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers=self.headers,
-                    json=payload
+                response_text = self.response_cache.complete(
+                    self.provider, self.model, payload["messages"], sampling_params(payload),
+                    lambda: self.scheduler.call(
+                        lambda: self.transport.post_json(OPENAI_CHAT_COMPLETIONS_URL, payload, headers=self.headers),
+                        estimated_tokens=provider_scheduler.estimate_tokens(payload["messages"]) + payload["max_tokens"]
+                    ).json()['choices'][0]['message']['content']
                 )
 
-                action, thoughts = self.parse_action(response.json()['choices'][0]['message']['content'])
+                action, thoughts = self.parse_action(response_text)
                 thoughts = self.parse_action_rmv_special_chars(thoughts)
                 action = self.parse_action_rmv_special_chars(action)
                 self.episode_logger.info(f"\nGPT suggested thoughts: {thoughts}")
@@ -751,21 +694,25 @@ class GPT4Agent(LLMAgent):
                 # Store the exchange in history
                 self.chat_history.append({
                     "observation": observation,
+                    "step": loop_iteration,
                     "response": action
                 })
 
                 return action
 
+            except ResponseCacheMiss:
+                raise
             except Exception as e:
                 logging.error(f"\nError calling OpenAI API: {e}")
                 return "error"
 
 
 class ClaudeAgent(LLMAgent):
+    provider = "anthropic"
 
-    def __init__(self, episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images=True, COT=False, delay=0, max_history=0):
-        super().__init__(episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images, COT, delay, max_history)
-        self.client = Anthropic(api_key=self.api_keys['CLAUDE_API_KEY'])
+    def __init__(self, episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images=True, COT=False, delay=0, max_history=0, request_timeout=None, rate_limits=None, image_pipeline=None, response_cache=None, history_token_budget=None):
+        super().__init__(episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images, COT, delay, max_history, request_timeout, rate_limits, image_pipeline, response_cache, history_token_budget)
+        self.client = provider_transport.anthropic_client(self.api_keys['CLAUDE_API_KEY'], self.transport)
         self.model = "claude-3-5-sonnet-20241022"
         self.chat_history = []
         self.content = []  
@@ -782,68 +729,24 @@ class ClaudeAgent(LLMAgent):
                 # Block of code that embeds information what this image represents, e.g. active (current) state, goal state
                 # or past state (later). There are several settings we can check for where the information about the
                 # state the image represents is marked by color, label, both or none
-                if self.visual_state_embedding == 'color':
-                    current = self.color_code_observation(observation.copy(), tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(), tuple(self.color_codes['goal_1']['rgb']))
-                elif self.visual_state_embedding == 'label':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    current = self.add_action_text(current.copy(), 'active')
-                    goal = self.add_action_text(goal.copy(), 'goal')
-                elif self.visual_state_embedding == 'both':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['goal_1']['rgb']))
-                    current = self.add_action_text(current.copy(), 'active')
-                    goal = self.add_action_text(goal.copy(), 'goal')
-                elif self.visual_state_embedding == 'none':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['active_1']['rgb']))
+                current = self.image_cache.image(observation, loop_iteration, 'active')
+                goal = self.image_cache.image(self.goal_state, None, 'goal')
 
 
-                current_base64 = self.encode_image_from_pil(current)
-                goal_base64 = self.encode_image_from_pil(goal)
+                current_base64 = self.image_cache.encoded(observation, loop_iteration, 'active')
+                goal_base64 = self.image_cache.encoded(self.goal_state, None, 'goal')
 
                 messages = []
 
-                # Add history if available
-                if self.max_history > 0:
-                    for i, prev_exchange in enumerate(self.chat_history[-self.max_history:], 1):
-
-                        # Block of code that embeds information what this image represents, here past state.
-                        # There are several settings we can check for where the information about the
-                        # state the image represents is marked by color, label, both or none
-                        if self.visual_state_embedding == 'color':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(), tuple(self.color_codes['past']['rgb']))
-                        elif self.visual_state_embedding == 'label':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),  tuple(self.color_codes['active_1']['rgb']))
-                            prev_image_colored = self.add_action_text(prev_image_colored.copy(), 'past')
-                        elif self.visual_state_embedding == 'both':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),tuple(self.color_codes['past']['rgb']))
-                            prev_image_colored = self.add_action_text(prev_image_colored.copy(), 'past')
-                        elif self.visual_state_embedding == 'none':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),  tuple(self.color_codes['active_1']['rgb']))
-
-                        prev_image_base64 = self.encode_image_from_pil(prev_image_colored)
-
-                        # Add previous image
-                        messages.append({
-                            "role": "user",
-                            "content": [
-                                {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": prev_image_base64}}
-                            ]
-                        })
-                        # Add assistant's response
-                        messages.append({
-                            "role": "assistant",
-                            "content": f"Action: {prev_exchange['response']}"
-                        })
+                # Add history if available, past states are labeled and encoded by the image cache
+                messages.extend(self.history.anthropic_messages(self.chat_history))
 
 
                 # Add goal state image
                 messages.append({
                     "role": "user",
                     "content": [
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": goal_base64}}
+                        {"type": "image", "source": {"type": "base64", "media_type": self.image_pipeline.media_type, "data": goal_base64}}
                     ]
                 })
 
@@ -851,7 +754,7 @@ class ClaudeAgent(LLMAgent):
                 messages.append({
                     "role": "user",
                     "content": [
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": current_base64}}
+                        {"type": "image", "source": {"type": "base64", "media_type": self.image_pipeline.media_type, "data": current_base64}}
                     ]
                 })
 
@@ -933,6 +836,7 @@ class ClaudeAgent(LLMAgent):
                     if self.max_history > 0:
                         for i, prev_exchange in enumerate(self.chat_history[-self.max_history:], 1):
                             try:
+                                prev_image_colored = self.image_cache.image(prev_exchange['observation'], prev_exchange.get('step'), 'past')
                                 prev_image_colored.save(filepath_obs_past)  # Save the image as a PNG
                             except Exception as e:
                                 logging.error(f"Error saving image to {filename_obs_past}.png: {e}")
@@ -940,16 +844,25 @@ class ClaudeAgent(LLMAgent):
 
                 formatted_message = format_message_structure(messages)
                 self.episode_logger.info(formatted_message)
+                self.log_image_stats()
 
-                message = self.client.messages.create(
-                    model=self.model,
-                    max_tokens=500,
-                    system=self.system_prompt,
-                    temperature=0.5,
-                    messages=messages
+                request = {
+                    "model": self.model,
+                    "max_tokens": 500,
+                    "system": self.system_prompt,
+                    "temperature": 0.5,
+                    "messages": messages
+                }
+                response_text = self.response_cache.complete(
+                    self.provider, self.model, [self.system_prompt, messages],
+                    sampling_params(request, request_fields=("model", "system", "messages")),
+                    lambda: self.scheduler.call(
+                        lambda: self.client.messages.create(**request),
+                        estimated_tokens=provider_scheduler.estimate_tokens([self.system_prompt, messages]) + request["max_tokens"]
+                    ).content[0].text
                 )
 
-                action, thoughts = self.parse_action(message.content[0].text)
+                action, thoughts = self.parse_action(response_text)
                 thoughts = self.parse_action_rmv_special_chars(thoughts)
                 action = self.parse_action_rmv_special_chars(action)
                 self.episode_logger.info(f"\nClaude suggested thoughts: {thoughts}")
@@ -958,11 +871,14 @@ class ClaudeAgent(LLMAgent):
                 # Store the current exchange in history
                 self.chat_history.append({
                     "observation": observation,
+                    "step": loop_iteration,
                     "response": action
                 })
 
                 return action
 
+            except ResponseCacheMiss:
+                raise
             except Exception as e:
                 logging.error(f"\nError calling Claude API: {e}")
                 return "error"
@@ -977,12 +893,7 @@ class ClaudeAgent(LLMAgent):
                 messages = []
 
 
-                if self.max_history > 0:
-                    for i, prev_exchange in enumerate(self.chat_history[-self.max_history:], 1):
-                        messages.extend([
-                            {"role": "user", "content": f"Previous observation {i}: {prev_exchange['observation']}"},
-                            {"role": "assistant", "content": f"Previous action {i}: {prev_exchange['response']}"}
-                        ])
+                messages.extend(self.history.anthropic_messages(self.chat_history))
                 current_content = [
                     {"type": "text", "text": f"""
                         ## Analyze the States
@@ -1014,15 +925,23 @@ class ClaudeAgent(LLMAgent):
                 self.episode_logger.info(formatted_message)
 
 
-                message = self.client.messages.create(
-                    model=self.model,
-                    max_tokens=500,
-                    system=self.system_prompt,
-                    temperature=0.5,  # maybe needs too be tuned
-                    messages= messages
+                request = {
+                    "model": self.model,
+                    "max_tokens": 500,
+                    "system": self.system_prompt,
+                    "temperature": 0.5,  # maybe needs too be tuned
+                    "messages": messages
+                }
+                response_text = self.response_cache.complete(
+                    self.provider, self.model, [self.system_prompt, messages],
+                    sampling_params(request, request_fields=("model", "system", "messages")),
+                    lambda: self.scheduler.call(
+                        lambda: self.client.messages.create(**request),
+                        estimated_tokens=provider_scheduler.estimate_tokens([self.system_prompt, messages]) + request["max_tokens"]
+                    ).content[0].text
                 )
 
-                action, thoughts = self.parse_action(message.content[0].text)
+                action, thoughts = self.parse_action(response_text)
                 thoughts = self.parse_action_rmv_special_chars(thoughts)
                 action = self.parse_action_rmv_special_chars(action)
                 self.episode_logger.info(f"\nClaude suggested thoughts: {thoughts}")
@@ -1030,21 +949,25 @@ class ClaudeAgent(LLMAgent):
 
                 self.chat_history.append({
                     "observation": observation,
+                    "step": loop_iteration,
                     "response": action
                 })
 
                 return action
 
+            except ResponseCacheMiss:
+                raise
             except Exception as e:
                 logging.error(f"\nError calling Claude API: {e}")
                 return "error"
             
 class GeminiAgent(LLMAgent):
-    def __init__(self, episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images=True, COT=False, delay=0, max_history=0):
-        super().__init__(episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images, COT, delay, max_history)
+    provider = "gemini"
+
+    def __init__(self, episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images=True, COT=False, delay=0, max_history=0, request_timeout=None, rate_limits=None, image_pipeline=None, response_cache=None, history_token_budget=None):
+        super().__init__(episode_path, episode_logger, api_key_file_path, instruction_prompt_file_path, visual_state_embedding, single_images, COT, delay, max_history, request_timeout, rate_limits, image_pipeline, response_cache, history_token_budget)
         self.api_key = self.api_keys['GEMINI_API_KEY']
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel(model_name="models/gemini-2.0-flash-exp", system_instruction=self.system_prompt)
+        self.model = provider_transport.gemini_model(self.api_key, "models/gemini-2.0-flash-exp", self.system_prompt)
         self.chat_history = []
         self.content = [] 
 
@@ -1059,55 +982,19 @@ class GeminiAgent(LLMAgent):
                 # Initialize content list for Gemini
                 messages = []
                 
-                # Add history if available
-                if self.max_history > 0:
-                    for prev_exchange in self.chat_history[-self.max_history:]:
-                        # Color the previous state orange and add to messages
-
-
-                        # Block of code that embeds information what this image represents, here past state.
-                        # There are several settings we can check for where the information about the
-                        # state the image represents is marked by color, label, both or none
-                        if self.visual_state_embedding == 'color':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(), tuple(self.color_codes['past']['rgb']))
-                        elif self.visual_state_embedding == 'label':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),  tuple(self.color_codes['active_1']['rgb']))
-                            prev_image_colored = self.add_action_text(prev_image_colored.copy(), 'past')
-                        elif self.visual_state_embedding == 'both':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),tuple(self.color_codes['past']['rgb']))
-                            prev_image_colored = self.add_action_text(prev_image_colored.copy(), 'past')
-                        elif self.visual_state_embedding == 'none':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),  tuple(self.color_codes['active_1']['rgb']))
-
-                        messages.extend([
-                            prev_image_colored,
-                            f"Previous action: {prev_exchange['response']}"
-                        ])
+                # Add history if available, past states are labeled and encoded by the image cache
+                messages.extend(self.history.gemini_parts(self.chat_history))
 
                 # Block of code that embeds information what this image represents, e.g. active (current) state, goal state
                 # or past state (above). There are several settings we can check for where the information about the
                 # state the image represents is marked by color, label, both or none
-                if self.visual_state_embedding == 'color':
-                    current = self.color_code_observation(observation.copy(), tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(), tuple(self.color_codes['goal_1']['rgb']))
-                elif self.visual_state_embedding == 'label':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    current = self.add_action_text(current.copy(), 'active')
-                    goal = self.add_action_text(goal.copy(), 'goal')
-                elif self.visual_state_embedding == 'both':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['goal_1']['rgb']))
-                    current = self.add_action_text(current.copy(), 'active')
-                    goal = self.add_action_text(goal.copy(), 'goal')
-                elif self.visual_state_embedding == 'none':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['active_1']['rgb']))
+                current = self.image_cache.image(observation, loop_iteration, 'active')
+                goal = self.image_cache.image(self.goal_state, None, 'goal')
 
 
                 messages.extend([
-                    goal,    # Goal state image (green)
-                    current, # Current state image (blue)
+                    self.image_cache.blob(self.goal_state, None, 'goal'),    # Goal state image (green)
+                    self.image_cache.blob(observation, loop_iteration, 'active'), # Current state image (blue)
                 ])
 
                 # Block of code that add to the prompt information what states the images represent,  e.g. active (current)
@@ -1157,6 +1044,7 @@ class GeminiAgent(LLMAgent):
                 messages.extend([instruction])
                 formatted_message = format_message_structure_gemini(messages) # use it for debugging make sure the input is correct
                 self.episode_logger.info(formatted_message)
+                self.log_image_stats()
 
 
                 # Debug block that saves the images with the colors or text labels into debug_obs to check if
@@ -1189,6 +1077,7 @@ class GeminiAgent(LLMAgent):
                     if self.max_history > 0:
                         for i, prev_exchange in enumerate(self.chat_history[-self.max_history:], 1):
                             try:
+                                prev_image_colored = self.image_cache.image(prev_exchange['observation'], prev_exchange.get('step'), 'past')
                                 prev_image_colored.save(filepath_obs_past)  # Save the image as a PNG
                             except Exception as e:
                                 logging.error(f"Error saving image to {filename_obs_past}.png: {e}")
@@ -1196,14 +1085,19 @@ class GeminiAgent(LLMAgent):
 
 
                 # Generate response using Gemini
-                response = self.model.generate_content(
-                    messages,
-                    generation_config=genai.GenerationConfig(
-                        max_output_tokens=500
-                    )
+                generation = {"max_output_tokens": 500}
+                response_text = self.response_cache.complete(
+                    self.provider, self.model.model_name, [self.system_prompt, messages], generation,
+                    lambda: self.scheduler.call(
+                        lambda: self.model.generate_content(
+                            messages,
+                            generation_config=genai.GenerationConfig(**generation)
+                        ),
+                        estimated_tokens=provider_scheduler.estimate_tokens([self.system_prompt, messages]) + generation["max_output_tokens"]
+                    ).text
                 )
 
-                action, thoughts = self.parse_action(response.text)
+                action, thoughts = self.parse_action(response_text)
                 thoughts = self.parse_action_rmv_special_chars(thoughts)
                 action = self.parse_action_rmv_special_chars(action)
                 self.episode_logger.info(f"\nGemini suggested thoughts: {thoughts}")
@@ -1213,11 +1107,14 @@ class GeminiAgent(LLMAgent):
                 # Store the current exchange in history
                 self.chat_history.append({
                     "observation": observation,
+                    "step": loop_iteration,
                     "response": action
                 })
 
                 return action
 
+            except ResponseCacheMiss:
+                raise
             except Exception as e:
                 logging.error(f"\nError calling Gemini API: {e}")
                 return "error"
@@ -1230,11 +1127,7 @@ class GeminiAgent(LLMAgent):
                     return self.process_goal_state(observation)  
                 self.episode_logger.info("\n=== Processing Current State ===")
 
-                if self.max_history > 0:
-                    history_context = ""
-                    for prev_exchange in self.chat_history[-self.max_history:]:
-                        history_context += f"Previous observation: {prev_exchange['observation']}\n"
-                        history_context += f"Previous action: {prev_exchange['response']}\n\n"
+                history_context = self.history.gemini_text_context(self.chat_history)
                 
                 content = [f"""{history_context if self.max_history > 0 else ''}
                     The first coordinates show the goal state, and the second coordinates show
@@ -1274,8 +1167,15 @@ class GeminiAgent(LLMAgent):
                     """
                 ]
 
-                response = self.model.generate_content(content)
-                action, thoughts = self.parse_action(response.text)
+                generation = {}  # Defaults of the model
+                response_text = self.response_cache.complete(
+                    self.provider, self.model.model_name, [self.system_prompt, content], generation,
+                    lambda: self.scheduler.call(
+                        lambda: self.model.generate_content(content, generation_config=genai.GenerationConfig(**generation)),
+                        estimated_tokens=provider_scheduler.estimate_tokens([self.system_prompt, content])
+                    ).text
+                )
+                action, thoughts = self.parse_action(response_text)
                 thoughts = self.parse_action_rmv_special_chars(thoughts)
                 action = self.parse_action_rmv_special_chars(action)
                 self.episode_logger.info(f"\nGemini suggested thoughts: {thoughts}")
@@ -1283,17 +1183,21 @@ class GeminiAgent(LLMAgent):
 
                 self.chat_history.append({
                     "observation": observation,
+                    "step": loop_iteration,
                     "response": action
                 })
 
                 return action
 
+            except ResponseCacheMiss:
+                raise
             except Exception as e:
                 logging.error(f"\nError calling Gemini API: {e}")
                 return "error"
 
 class OpenSourceAgent:
-    def __init__(self, model_path, instruction_prompt_file_path, max_history, visual_state_embedding, single_images=True, COT=False):
+    def __init__(self, model_path, instruction_prompt_file_path, max_history, visual_state_embedding, single_images=True, COT=False,
+                 image_pipeline=None, history_token_budget=None):
         self.model_path = model_path
         self.model = None
         self.goal_state = None
@@ -1302,6 +1206,8 @@ class OpenSourceAgent:
         self.max_history = max_history
         self.visual_state_embedding = visual_state_embedding
         self.color_codes = util.load_params_from_json('color_codes.json')
+        self.image_pipeline = ImagePipeline.from_params(image_pipeline)
+        self.history_token_budget = history_token_budget
         self.delay = 0.0
 
         # Load system prompt from file
@@ -1329,6 +1235,11 @@ class OpenSourceAgent:
     def reset(self, episode_path, episode_logger):
         self.goal_state = None
         self.episode_logger = episode_logger
+        self.image_cache = EpisodeImageCache(self.visual_state_embedding, self.color_codes, self.image_pipeline,
+                                             self.max_history)
+        self.history = HistoryBuilder(self.image_cache, None, self.max_history, self.history_token_budget,
+                                      episode_logger)
+        self.telemetry = StepTelemetry(episode_path, type(self).__name__, episode_logger)
         
         # Create the 'obs' subdirectory inside the save path
         self.obs_dir = os.path.join(episode_path, 'obs')
@@ -1340,12 +1251,17 @@ class OpenSourceAgent:
         pil_image.save(buffer, format="PNG")
         return base64.b64encode(buffer.getvalue()).decode('utf-8')
 
+    def log_image_stats(self):
+        """Log the bytes and estimated tokens of the images sent in this step."""
+        self.episode_logger.info(f"\nImages sent: {self.image_cache.take_step_stats().summary()}")
+
     def process_goal_state(self, observation):
         """Process and store the goal state"""
         self.episode_logger.info("\n=== Receiving Goal State ===")
         self.goal_state = observation
         return "start"
 
+    @step_metrics.timed("parse")
     def parse_action(self, response, split_at="action: move "):
         """Extract the last action from model response."""
         # Find the last occurrence of the split string
@@ -1361,6 +1277,7 @@ class OpenSourceAgent:
             action = "No valid action found."
         return action, thoughts
 
+    @step_metrics.timed("parse")
     def parse_action_rmv_special_chars(self, action):
         """
         Cleans the input string to ensure it is safe to use as part of a file name.
@@ -1412,78 +1329,10 @@ class OpenSourceAgent:
 
     def add_action_text(self, image, action_text, color="black"):
         """
-        Adds the action text in large red letters with a light white, semi-transparent box behind it
-        on the top-right corner of the image, 50 pixels away from the top and right border, with rounded corners.
-
-        Args:
-            image (PIL.Image): The image on which to add the action text.
-            action_text (str): The action text to add to the image.
-
-        Returns:
-            PIL.Image: The image with the action text added.
+        Adds the action text with a semi-transparent box behind it on the top-right corner of the image,
+        see annotation.add_action_text.
         """
-        # Ensure the image is in RGBA mode (supports transparency)
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
-
-        # Create a drawing context
-        draw = ImageDraw.Draw(image)
-
-        # Try to load a larger font size
-        try:
-            font = ImageFont.truetype("arial.ttf", 50)  # Increased font size to 80
-        except IOError:
-            logging.error("Warning: 'arial.ttf' not found. Using default font.")
-            font = ImageFont.load_default()
-
-        # Get text bounding box
-        text_bbox = draw.textbbox((0, 0), action_text, font=font)
-        text_width, text_height = text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]
-
-        # Add extra padding to make the box slightly larger than the text
-        box_extra_padding = 20  # Adjust this value to control how much larger the box should be
-        border_thickness = 3  # Thickness of the black border
-
-        # Set padding, border offset, and corner radius for rounded edges
-        padding = 10
-        border_offset = 50
-        corner_radius = 20  # Radius for the rounded corners
-
-        # Calculate box and text position (50 pixels from the top and right with additional padding)
-        text_x = image.width - text_width - padding - border_offset
-        text_y = border_offset
-        box_x0 = text_x - padding - box_extra_padding
-        box_y0 = text_y - padding - box_extra_padding
-        box_x1 = image.width - padding - border_offset + box_extra_padding
-        box_y1 = text_y + text_height + padding + box_extra_padding
-
-        # Create a semi-transparent overlay
-        overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))  # Transparent overlay
-        overlay_draw = ImageDraw.Draw(overlay)
-
-        # Draw a black border (slightly larger rectangle)
-        overlay_draw.rounded_rectangle(
-            [box_x0 - border_thickness, box_y0 - border_thickness,
-             box_x1 + border_thickness, box_y1 + border_thickness],
-            radius=corner_radius + border_thickness,
-            fill=(0, 0, 0, 255)  # Black border
-        )
-
-        # Draw a semi-transparent white box with rounded corners (50% transparency)
-        overlay_draw.rounded_rectangle(
-            [box_x0, box_y0, box_x1, box_y1],
-            radius=corner_radius,
-            fill=(255, 255, 255, 128)
-        )
-
-        # Composite the overlay onto the image
-        image = Image.alpha_composite(image, overlay)
-
-        # Draw the text in red on the original image
-        draw = ImageDraw.Draw(image)
-        draw.text((text_x, text_y), action_text, font=font, fill=color)
-
-        return image
+        return annotation.add_action_text(image, action_text, color)
     
     def act(self, observation, loop_iteration=None):
         raise NotImplementedError 
@@ -1492,12 +1341,15 @@ class OpenSourceAgent:
 class Qwen2Agent(OpenSourceAgent):
     """Parent class for LLM-based agents"""
 
-    def __init__(self, model_path, instruction_prompt_file_path, max_history, visual_state_embedding, single_images=True, COT=False):
-        super().__init__(model_path, instruction_prompt_file_path, max_history, visual_state_embedding, single_images, COT)
-        self.model = Qwen2VLForConditionalGeneration.from_pretrained(
-            model_path, torch_dtype="auto", device_map="auto", cache_dir='weights'
-        )
-        self.processor = AutoProcessor.from_pretrained(model_path, cache_dir='weights')
+    def __init__(self, model_path, instruction_prompt_file_path, max_history, visual_state_embedding, single_images=True, COT=False,
+                 image_pipeline=None, batching=None, prefix_cache=False, history_token_budget=None):
+        super().__init__(model_path, instruction_prompt_file_path, max_history, visual_state_embedding, single_images, COT,
+                         image_pipeline, history_token_budget)
+        # Weights are loaded once per process and shared by the agents of all episodes
+        self.host = get_model_host(model_path).open_session()
+        self.model = self.host.model
+        self.processor = self.host.processor
+        self.server = self.host.inference_server(prefix_cache=prefix_cache, **(batching or {}))
         
     def reset(self, episode_path, episode_logger):
         super().reset(episode_path, episode_logger)
@@ -1515,62 +1367,16 @@ class Qwen2Agent(OpenSourceAgent):
                 # Block of code that embeds information what this image represents, e.g. active (current) state, goal state
                 # or past state (later). There are several settings we can check for where the information about the
                 # state the image represents is marked by color, label, both or none
-                if self.visual_state_embedding == 'color':
-                    current = self.color_code_observation(observation.copy(), tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(), tuple(self.color_codes['goal_1']['rgb']))
-                elif self.visual_state_embedding == 'label':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    current = self.add_action_text(current.copy(), 'active')
-                    goal = self.add_action_text(goal.copy(), 'goal')
-                elif self.visual_state_embedding == 'both':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['goal_1']['rgb']))
-                    current = self.add_action_text(current.copy(), 'active')
-                    goal = self.add_action_text(goal.copy(), 'goal')
-                elif self.visual_state_embedding == 'none':
-                    current = self.color_code_observation(observation.copy(),tuple(self.color_codes['active_1']['rgb']))
-                    goal = self.color_code_observation(self.goal_state.copy(),tuple(self.color_codes['active_1']['rgb']))
+                current = self.image_cache.image(observation, loop_iteration, 'active')
+                goal = self.image_cache.image(self.goal_state, None, 'goal')
                     
                 self.messages = [{"role": "system", "content": self.system_prompt}]
                 
-                current_base64 = self.encode_image_from_pil(current)
-                goal_base64 = self.encode_image_from_pil(goal)
+                current_base64 = self.image_cache.encoded(observation, loop_iteration, 'active')
+                goal_base64 = self.image_cache.encoded(self.goal_state, None, 'goal')
                 
-                # Add history if available
-                if self.max_history > 0:
-                    for i, prev_exchange in enumerate(self.chat_history[-self.max_history:], 1):
-
-                        # Block of code that embeds information what this image represents, here past state.
-                        # There are several settings we can check for where the information about the
-                        # state the image represents is marked by color, label, both or none
-                        if self.visual_state_embedding == 'color':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(), tuple(self.color_codes['past']['rgb']))
-                        elif self.visual_state_embedding == 'label':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),  tuple(self.color_codes['active_1']['rgb']))
-                            prev_image_colored = self.add_action_text(prev_image_colored.copy(), 'past')
-                        elif self.visual_state_embedding == 'both':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),tuple(self.color_codes['past']['rgb']))
-                            prev_image_colored = self.add_action_text(prev_image_colored.copy(), 'past')
-                        elif self.visual_state_embedding == 'none':
-                            prev_image_colored = self.color_code_observation(prev_exchange['observation'].copy(),  tuple(self.color_codes['active_1']['rgb']))
-
-                        prev_image_base64 = self.encode_image_from_pil(prev_image_colored)
-
-                        # Add previous image
-                        self.messages.append({
-                            "role": "user",
-                            "content": [
-                                {"type": "image", "image": f'data:image;base64,{prev_image_base64}'}
-                            ],
-                        })
-                        
-                        # Add assistant's response
-                        self.messages.append({
-                            "role": "assistant",
-                            "content": f"Action: {prev_exchange['response']}"
-                        })
-                        
+                # Add history if available, past states are labeled and encoded by the image cache
+                self.messages.extend(self.history.qwen_messages(self.chat_history))
                         
                 # Add goal state image
                 self.messages.append({
@@ -1634,6 +1440,7 @@ class Qwen2Agent(OpenSourceAgent):
                         where you replace <object color> <object shape> <direction> with the valid move action based on your reasoning and do not add any characters after your action.
                 """
                 })
+                self.log_image_stats()
             elif isinstance(observation, list) and all(isinstance(item, str) for item in observation):
                 observation = '\n'.join(observation)
                 if self.goal_state is None:
@@ -1642,12 +1449,7 @@ class Qwen2Agent(OpenSourceAgent):
                 
                 self.messages = [{"role": "system", "content": self.system_prompt}]
                 
-                if self.max_history > 0:
-                    for i, prev_exchange in enumerate(self.chat_history[-self.max_history:], 1):
-                        self.messages.extend([
-                            {"role": "user", "content": f"Previous observation {i}: {prev_exchange['observation']}"},
-                            {"role": "assistant", "content": f"Previous action {i}: {prev_exchange['response']}"}
-                        ])
+                self.messages.extend(self.history.qwen_messages(self.chat_history))
                         
                 self.messages.append({"role": "user", "content": f"""
                         ## Analyze the States
@@ -1674,36 +1476,16 @@ class Qwen2Agent(OpenSourceAgent):
                     """})
 
             
-            text = self.processor.apply_chat_template(
-                self.messages, tokenize=False, add_generation_prompt=True
-            )
-            image_inputs, video_inputs = process_vision_info(self.messages)
-            inputs = self.processor(
-                text=[text],
-                images=image_inputs,
-                videos=video_inputs,
-                padding=True,
-                return_tensors="pt"
-            )
-            inputs = inputs.to("cuda")
-            generated_ids = self.model.generate(
-                **inputs, max_new_tokens=300, temperature=1.0,  # Increased from 0.7
-                                   top_k=50,         # Added top_k sampling
-                                   top_p=0.95,       # Added nucleus sampling
-                                   do_sample=True ,   # Enable sampling
-                                   repetition_penalty=1.05,)
-            generated_ids_trimmed = [
-                out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-            ]
-            response = self.processor.batch_decode(
-                generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-            )[0]
+            # Batched with the requests of episodes on other threads, a single episode generates right away,
+            # see inference_server
+            response = self.server.generate(self.messages, **QWEN2_GENERATION_KWARGS)
             
             self.episode_logger.info(response)
             action, thoughts = self.parse_action(response)
             
             self.chat_history.append({
                 "observation": observation,
+                "step": loop_iteration,
                 "response": action
             })
             
@@ -1717,6 +1499,6 @@ class Qwen2Agent(OpenSourceAgent):
             return "error"
       
 class Qwen2_72BAgent(Qwen2Agent):
-    def __init__(self, instruction_prompt_file_path, max_history, visual_state_embedding, single_images=True, COT=False, *args, **kwargs):
-        super().__init__('Qwen/Qwen2-VL-72B-Instruct-GPTQ-Int4', instruction_prompt_file_path, max_history, visual_state_embedding, single_images, COT)
+    def __init__(self, instruction_prompt_file_path, max_history, visual_state_embedding, single_images=True, COT=False, image_pipeline=None, batching=None, prefix_cache=False, history_token_budget=None, *args, **kwargs):
+        super().__init__('Qwen/Qwen2-VL-72B-Instruct-GPTQ-Int4', instruction_prompt_file_path, max_history, visual_state_embedding, single_images, COT, image_pipeline, batching, prefix_cache, history_token_budget)
             
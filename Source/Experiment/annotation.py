@@ -0,0 +1,142 @@
+"""
+- Text annotations of observation images, shared by the agents, render_2D, Visualize/* and merge_images
+- Fonts are loaded once per process and size, label boxes are measured once per text and image width
+- A label only touches its own region: the region is cropped, the pre-drawn box is composited onto it, the text
+  is drawn and the region is pasted back, instead of compositing a full-frame overlay
+"""
+import logging
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+DEFAULT_FONT = "arial.ttf"
+ACTION_FONT_SIZE = 50
+
+# Layout of the action label in the top right corner
+LABEL_PADDING = 10
+LABEL_BOX_EXTRA_PADDING = 20
+LABEL_BORDER_OFFSET = 50
+LABEL_BORDER_THICKNESS = 3
+LABEL_CORNER_RADIUS = 20
+LABEL_BOX_FILL = (255, 255, 255, 128)
+LABEL_BORDER_FILL = (0, 0, 0, 255)
+
+
+@lru_cache(maxsize=None)
+def load_font(size, font_name=DEFAULT_FONT):
+    """
+    Load a TrueType font once per process, falling back to PIL's default font if it is not installed.
+
+    Args:
+        size (int): Font size in pixels.
+        font_name (str): File name or path of the font.
+
+    Returns:
+        PIL.ImageFont.ImageFont: The font, shared by all callers.
+    """
+    try:
+        return ImageFont.truetype(font_name, size)
+    except IOError:
+        logging.warning(f"'{font_name}' not found. Using default font.")
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=None)
+def text_bbox(text, size, font_name=DEFAULT_FONT):
+    """Bounding box of text drawn at (0, 0), like ImageDraw.textbbox."""
+    return load_font(size, font_name).getbbox(text)
+
+
+@lru_cache(maxsize=None)
+def fit_font_size(text, max_width, font_name=DEFAULT_FONT):
+    """
+    Largest font size at which text is narrower than max_width, found by bisection instead of trying every size.
+
+    Returns:
+        int: The font size, at least 1.
+    """
+    lo, hi = 1, max(1, int(max_width))
+    if text_bbox(text, lo, font_name)[2] >= max_width:
+        return lo
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if text_bbox(text, mid, font_name)[2] < max_width:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+@lru_cache(maxsize=None)
+def _action_label(action_text, image_width, size, font_name):
+    """
+    Measure the action label of an image width once and pre-draw its box.
+
+    Returns:
+        tuple: Region (x0, y0, x1, y1) covered by the label, its box as an RGBA image of the region's size and
+            the text position relative to the region.
+    """
+    bbox = text_bbox(action_text, size, font_name)
+    text_width, text_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+    text_x = image_width - text_width - LABEL_PADDING - LABEL_BORDER_OFFSET
+    text_y = LABEL_BORDER_OFFSET
+    box_x0 = text_x - LABEL_PADDING - LABEL_BOX_EXTRA_PADDING
+    box_y0 = text_y - LABEL_PADDING - LABEL_BOX_EXTRA_PADDING
+    box_x1 = image_width - LABEL_PADDING - LABEL_BORDER_OFFSET + LABEL_BOX_EXTRA_PADDING
+    box_y1 = text_y + text_height + LABEL_PADDING + LABEL_BOX_EXTRA_PADDING
+
+    # The region also holds the text, which may reach beyond the box for tall glyphs
+    region = (min(box_x0 - LABEL_BORDER_THICKNESS, text_x + bbox[0]),
+              min(box_y0 - LABEL_BORDER_THICKNESS, text_y + bbox[1]),
+              max(box_x1 + LABEL_BORDER_THICKNESS, text_x + bbox[2]) + 1,
+              max(box_y1 + LABEL_BORDER_THICKNESS, text_y + bbox[3]) + 1)
+    x0, y0 = region[0], region[1]
+
+    box = Image.new('RGBA', (region[2] - x0, region[3] - y0), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(box)
+    draw.rounded_rectangle(
+        [box_x0 - LABEL_BORDER_THICKNESS - x0, box_y0 - LABEL_BORDER_THICKNESS - y0,
+         box_x1 + LABEL_BORDER_THICKNESS - x0, box_y1 + LABEL_BORDER_THICKNESS - y0],
+        radius=LABEL_CORNER_RADIUS + LABEL_BORDER_THICKNESS,
+        fill=LABEL_BORDER_FILL
+    )
+    draw.rounded_rectangle(
+        [box_x0 - x0, box_y0 - y0, box_x1 - x0, box_y1 - y0],
+        radius=LABEL_CORNER_RADIUS,
+        fill=LABEL_BOX_FILL
+    )
+    return region, box, (text_x - x0, text_y - y0)
+
+
+def action_label_region(action_text, image_width, size=ACTION_FONT_SIZE, font_name=DEFAULT_FONT):
+    """Region (x0, y0, x1, y1) that add_action_text draws into on an image of image_width."""
+    return _action_label(action_text, image_width, size, font_name)[0]
+
+
+def add_action_text(image, action_text, color="black", size=ACTION_FONT_SIZE, font_name=DEFAULT_FONT):
+    """
+    Adds the action text with a light white, semi-transparent box with rounded corners and a black border behind
+    it on the top-right corner of the image, 50 pixels away from the top and right border.
+
+    The image is not modified, the label is drawn on an RGBA copy of it.
+
+    Args:
+        image (PIL.Image): The image on which to add the action text.
+        action_text (str): The action text to add to the image.
+        color (str): Color of the text.
+        size (int): Font size.
+        font_name (str): File name or path of the font.
+
+    Returns:
+        PIL.Image: The image with the action text added.
+    """
+    # Work on an RGBA copy (supports transparency), only the label region is composited
+    image = image.convert('RGBA') if image.mode != 'RGBA' else image.copy()
+
+    region, box, text_position = _action_label(action_text, image.width, size, font_name)
+    patch = image.crop(region)
+    patch.alpha_composite(box)
+    ImageDraw.Draw(patch).text(text_position, action_text, font=load_font(size, font_name), fill=color)
+    image.paste(patch, region[:2])
+    return image
@@ -5,30 +5,162 @@ import shutil
 from datetime import datetime
 
 
-def save_checkpoint(experiment_id, checkpoint_state):
+CHECKPOINT_FILE_NAME = 'experiment_checkpoint.json'
+JOURNAL_FILE_NAME = 'experiment_checkpoint.journal'
+
+
+def _experiment_dir(experiment_id):
     base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-    experiment_dir = os.path.join(base_dir, 'Data', 'Experiments', experiment_id)
-    os.makedirs(os.path.dirname(experiment_dir), exist_ok=True)
-    experiment_checkpoint_file = os.path.join(experiment_dir, 'experiment_checkpoint.json')
-    with open(experiment_checkpoint_file, 'w') as f:
+    return os.path.join(base_dir, 'Data', 'Experiments', experiment_id)
+
+
+def _fsync_dir(dir_path):
+    # Persist the rename itself, directories cannot be opened on Windows
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def save_checkpoint(experiment_id, checkpoint_state):
+    experiment_dir = _experiment_dir(experiment_id)
+    os.makedirs(experiment_dir, exist_ok=True)
+    experiment_checkpoint_file = os.path.join(experiment_dir, CHECKPOINT_FILE_NAME)
+
+    # Write a temporary file and rename it, so a crash never leaves a partially written checkpoint
+    tmp_file = f"{experiment_checkpoint_file}.tmp"
+    with open(tmp_file, 'w') as f:
         json.dump(checkpoint_state, f, indent=4)  # Pretty-print with 4-space indentation
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, experiment_checkpoint_file)
+    _fsync_dir(experiment_dir)
     logging.info(f"Saved checkpoint {experiment_checkpoint_file}")
 
 
+def read_journal(experiment_id):
+    """
+    Read the checkpoint journal of an experiment.
+
+    Returns:
+        list: The journal entries in order, each a dict with "event", "episode" and "timestamp".
+    """
+    journal_file = os.path.join(_experiment_dir(experiment_id), JOURNAL_FILE_NAME)
+    entries = []
+    if os.path.exists(journal_file):
+        with open(journal_file, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A crash during an append can only damage the last line
+                    logging.warning(f"Ignoring incomplete entry in {journal_file}")
+    return entries
+
+
 def load_checkpoint(experiment_id):
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-    experiment_dir = os.path.join(base_dir, 'Data', 'Experiments', experiment_id)
-    experiment_checkpoint_file = os.path.join(experiment_dir, 'experiment_checkpoint.json')
+    """
+    Load the checkpoint state of an experiment, including the completions journaled since the last compaction.
+    """
+    experiment_checkpoint_file = os.path.join(_experiment_dir(experiment_id), CHECKPOINT_FILE_NAME)
+    checkpoint_state = None
     if os.path.exists(experiment_checkpoint_file):
         logging.info(f"Load checkpoint {experiment_checkpoint_file}")
         with open(experiment_checkpoint_file, 'r') as f:
-            return json.load(f)
-    else:
+            checkpoint_state = json.load(f)
+
+    entries = read_journal(experiment_id)
+    if checkpoint_state is None and not entries:
         logging.info(f"No checkpoint file found")
         return None
 
+    checkpoint_state = checkpoint_state or {"completed": []}
+    completed = set(checkpoint_state.setdefault("completed", []))
+    for entry in entries:
+        if entry.get("event") == "completed" and entry["episode"] not in completed:
+            checkpoint_state["completed"].append(entry["episode"])
+            completed.add(entry["episode"])
+    return checkpoint_state
+
+
+class CheckpointJournal:
+    """
+    Crash-safe checkpoint of the episodes of an experiment.
+
+    Starting and completing an episode appends one line to experiment_checkpoint.journal and fsyncs it, instead of
+    rewriting the whole checkpoint. Every compact_every completions the journal is folded into
+    experiment_checkpoint.json with an atomic rename and truncated. Completed episodes are kept in a set, so
+    membership checks do not depend on the size of the experiment.
+    """
+
+    def __init__(self, experiment_id, compact_every=100):
+        self.experiment_id = experiment_id
+        self.compact_every = compact_every
+        self.journal_file = os.path.join(_experiment_dir(experiment_id), JOURNAL_FILE_NAME)
+        os.makedirs(os.path.dirname(self.journal_file), exist_ok=True)
+
+        entries = read_journal(experiment_id)
+        self.state = load_checkpoint(experiment_id) or {"completed": []}
+        self.completed = set(self.state["completed"])
+
+        # Episodes that were started but never completed were running when the experiment stopped
+        started = {}
+        for entry in entries:
+            if entry.get("event") == "started":
+                started[entry["episode"]] = entry.get("timestamp")
+        self.in_flight = {name: timestamp for name, timestamp in started.items() if name not in self.completed}
+
+        self._journal = open(self.journal_file, 'a')
+        self._num_uncompacted = 0
+        self._running = {}
+        if entries:
+            self.compact()
+
+    def __contains__(self, episode_name):
+        return episode_name in self.completed
+
+    def _append(self, event, episode_name, timestamp=None):
+        entry = {"event": event, "episode": episode_name, "timestamp": timestamp or datetime.now().isoformat()}
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def mark_started(self, episode_name):
+        self._running[episode_name] = datetime.now().isoformat()
+        self._append("started", episode_name, self._running[episode_name])
+
+    def mark_completed(self, episode_name):
+        self._append("completed", episode_name)
+        self._running.pop(episode_name, None)
+        if episode_name not in self.completed:
+            self.completed.add(episode_name)
+            self.state["completed"].append(episode_name)
+        self._num_uncompacted += 1
+        if self._num_uncompacted >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Fold the journal into the checkpoint file and start a new, empty journal."""
+        save_checkpoint(self.experiment_id, self.state)
+        self._journal.close()
+        # The journal is only truncated after the checkpoint that contains it was renamed into place
+        tmp_file = f"{self.journal_file}.tmp"
+        open(tmp_file, 'w').close()
+        os.replace(tmp_file, self.journal_file)
+        self._journal = open(self.journal_file, 'a')
+        self._num_uncompacted = 0
+        # Episodes still running are carried over, so a crash after compaction still reports them
+        for episode_name, timestamp in self._running.items():
+            self._append("started", episode_name, timestamp)
+
+    def close(self):
+        self.compact()
+        self._journal.close()
+
 
-def remove_incomplete_episode(experiment_id, checkpoint_state):
+def remove_incomplete_episode(experiment_id, checkpoint_state, in_flight=None):
     """
     Removes any incomplete episode directories that are not marked as completed
     in the checkpoint state and stores information about removed episodes.
@@ -36,6 +168,7 @@ def remove_incomplete_episode(experiment_id, checkpoint_state):
     Args:
         experiment_id (str): The ID of the experiment to clean up.
         checkpoint_state (dict): The current checkpoint state with completed episodes.
+        in_flight (dict): Episodes that were running when the experiment stopped, with the time they started.
     """
     logging.info("Checking for incomplete episodes.")
     base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
@@ -49,7 +182,10 @@ def remove_incomplete_episode(experiment_id, checkpoint_state):
     ]
 
     # Get the list of completed episodes from the checkpoint state
-    completed_episodes = checkpoint_state.get("completed", [])
+    completed_episodes = set(checkpoint_state.get("completed", []))
+    in_flight = in_flight or {}
+    for episode_name, started in in_flight.items():
+        logging.warning(f"Episode {episode_name} was in flight when the experiment stopped (started {started}).")
     removed_episodes = checkpoint_state.setdefault("removed", {})
     num_removed_episodes = 0
 
@@ -62,7 +198,7 @@ def remove_incomplete_episode(experiment_id, checkpoint_state):
             # Store removal info
             removed_episodes[episode_dir] = {
                 "timestamp": datetime.now().isoformat(),
-                "reason": "Incomplete episode removal"
+                "reason": "Interrupted while running" if episode_dir in in_flight else "Incomplete episode removal"
             }
             num_removed_episodes +=1
             logging.info(f"Removing incomplete episode {num_removed_episodes}: {episode_dir}")
@@ -0,0 +1,81 @@
+"""
+- Registry of the agent classes and schematic renderers of an experiment, resolved by name on first use
+- Entries are "module:attribute" strings, so importing the experiment code does not import any agent or renderer
+- LazyModule defers heavy provider and ML dependencies (transformers, anthropic, google.generativeai, requests, ...)
+  until an attribute of them is used, a baseline run never loads them
+- import_benchmark.py guards the import time this buys
+"""
+import importlib
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    Args:
+        name (str): Fully qualified module name, e.g. "google.generativeai".
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+
+AGENT_CLASSES = {
+    "AIAgent": "agent_systems:AIAgent",
+    "UserAgent": "agent_systems:UserAgent",
+    "GPT4Agent": "agent_systems:GPT4Agent",
+    "ClaudeAgent": "agent_systems:ClaudeAgent",
+    "GeminiAgent": "agent_systems:GeminiAgent",
+    "Qwen2Agent": "agent_systems:Qwen2Agent",
+    "Qwen2_72BAgent": "agent_systems:Qwen2_72BAgent",
+}
+
+RENDERERS = {
+    "schematic": "render_2D:render_schematic",
+    "schematic_matplotlib": "render_2D:render_schematic_matplotlib",
+}
+
+_resolved = {}
+
+
+def _resolve(registry, kind, name):
+    if name not in registry:
+        raise ValueError(f"Unsupported {kind}: {name}")
+    target = registry[name]
+    if target not in _resolved:
+        module_name, attribute = target.split(":")
+        _resolved[target] = getattr(importlib.import_module(module_name), attribute)
+    return _resolved[target]
+
+
+def register_agent(name, target):
+    """Register an agent class as "module:attribute" under an agent_type."""
+    AGENT_CLASSES[name] = target
+
+
+def register_renderer(name, target):
+    """Register a renderer as "module:attribute" under a name."""
+    RENDERERS[name] = target
+
+
+def agent_class(agent_type):
+    """Return the agent class of an agent_type, importing its module if needed."""
+    return _resolve(AGENT_CLASSES, "agent_type", agent_type)
+
+
+def renderer(name):
+    """Return a schematic renderer, board_data -> PIL.Image.Image, importing its module if needed."""
+    return _resolve(RENDERERS, "renderer", name)
@@ -0,0 +1,137 @@
+"""
+- Append-only logs of an episode, written while the episode is played
+- Agent messages are appended to agent_message_log.txt, simulator messages to sim_message_log.jsonl with one
+  {"step": ..., "message": ...} record per line, so saving a step costs the size of that step only
+- finalize writes sim_message_log.json in the shape evaluate_episodes expects, once at the end of the episode
+- finalize_experiment_logs converts episodes that were interrupted before they were finalized
+- load_sim_message_log is the reader of the evaluation scripts, for finalized and for interrupted episodes
+"""
+import os
+import json
+import logging
+
+AGENT_LOG_FILE_NAME = "agent_message_log.txt"
+SIM_LOG_FILE_NAME = "sim_message_log.json"
+SIM_LOG_JSONL_FILE_NAME = "sim_message_log.jsonl"
+
+
+def read_sim_message_log(episode_path):
+    """
+    Read the simulator messages of an episode from its JSON Lines log.
+
+    Returns:
+        dict: The messages by step key ("step 0", "step 1", ...), a step logged twice keeps its last message.
+    """
+    sim_message_log = {}
+    jsonl_path = os.path.join(episode_path, SIM_LOG_JSONL_FILE_NAME)
+    with open(jsonl_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of an interrupted episode may be incomplete
+                logging.warning(f"Skipping incomplete record in {jsonl_path}")
+                continue
+            sim_message_log[record["step"]] = record["message"]
+    return sim_message_log
+
+
+def load_sim_message_log(episode_path):
+    """
+    Load the simulator messages of an episode, from sim_message_log.json or, if the episode was interrupted before
+    it was finalized, from its JSON Lines log.
+
+    Returns:
+        dict: The messages by step key, or None if the episode has no simulator log.
+    """
+    sim_log_path = os.path.join(episode_path, SIM_LOG_FILE_NAME)
+    if os.path.exists(sim_log_path):
+        with open(sim_log_path, 'r') as f:
+            return json.load(f)
+    if os.path.exists(os.path.join(episode_path, SIM_LOG_JSONL_FILE_NAME)):
+        return read_sim_message_log(episode_path)
+    return None
+
+
+def write_sim_message_log(episode_path, sim_message_log):
+    """Write sim_message_log.json atomically, so readers never see a partially written file."""
+    sim_log_path = os.path.join(episode_path, SIM_LOG_FILE_NAME)
+    tmp_path = f"{sim_log_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(sim_message_log, f, indent=4)
+    os.replace(tmp_path, sim_log_path)
+
+
+class EpisodeLogWriter:
+    """
+    Incremental writer of the agent and simulator logs of one episode.
+
+    Records are buffered by the open files and reach the disk on flush, which the game calls after every step.
+    """
+
+    def __init__(self, episode_path):
+        self.episode_path = episode_path
+        self._agent_file = None
+        self._sim_file = None
+        self._has_agent_messages = False
+
+    def _open(self):
+        if self._sim_file is None:
+            os.makedirs(self.episode_path, exist_ok=True)
+            self._agent_file = open(os.path.join(self.episode_path, AGENT_LOG_FILE_NAME), 'a')
+            self._sim_file = open(os.path.join(self.episode_path, SIM_LOG_JSONL_FILE_NAME), 'a')
+
+    def append_agent_message(self, agent_message):
+        self._open()
+        # Keep the newline separated layout of agent_message_log.txt
+        if self._has_agent_messages:
+            self._agent_file.write("\n")
+        self._agent_file.write(agent_message)
+        self._has_agent_messages = True
+
+    def append_sim_message(self, step_key, sim_message):
+        self._open()
+        self._sim_file.write(json.dumps({"step": step_key, "message": sim_message}) + "\n")
+
+    def flush(self):
+        if self._sim_file is not None:
+            self._agent_file.flush()
+            self._sim_file.flush()
+
+    def close(self):
+        if self._sim_file is not None:
+            self._agent_file.close()
+            self._sim_file.close()
+            self._agent_file = None
+            self._sim_file = None
+
+    def finalize(self):
+        """Close the logs and write sim_message_log.json, further messages reopen the logs."""
+        self.close()
+        write_sim_message_log(self.episode_path, read_sim_message_log(self.episode_path))
+
+
+def finalize_experiment_logs(experiment_id):
+    """
+    Write sim_message_log.json for all episodes of an experiment that only have the JSON Lines log.
+
+    Returns:
+        int: Number of finalized episodes.
+    """
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    episodes_dir = os.path.join(base_dir, 'Data', 'Experiments', experiment_id, 'Episodes')
+    num_finalized = 0
+    for episode_name in sorted(os.listdir(episodes_dir)):
+        episode_path = os.path.join(episodes_dir, episode_name)
+        if (os.path.exists(os.path.join(episode_path, SIM_LOG_JSONL_FILE_NAME))
+                and not os.path.exists(os.path.join(episode_path, SIM_LOG_FILE_NAME))):
+            write_sim_message_log(episode_path, read_sim_message_log(episode_path))
+            num_finalized += 1
+    logging.info(f"Finalized the logs of {num_finalized} episodes of experiment {experiment_id}")
+    return num_finalized
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    experiment_id = "Test_Auto_Done"
+    finalize_experiment_logs(experiment_id)
@@ -0,0 +1,162 @@
+"""
+- Preparation of experiment episodes ahead of time
+- collect_episodes lists every episode of an experiment from the games, agents and envs parameters
+- prepare_episode stages the config, writes the metadata, sets up logging and builds env config, agent, game and
+  the Setup content of one episode
+- prefetch_episodes prepares the next episodes on a background thread while the current one is played, so the
+  Setup packet of the next episode can be sent as soon as the previous one is finished
+"""
+import os
+import json
+import fnmatch
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import experiment_utilities as util
+from init_experiment_components import init_env, init_agent, init_game
+from experiment_logging import setup_episode_logging
+
+
+def collect_episodes(games, agents, envs, experiment_dir):
+    """
+    List all episodes of an experiment in the order they are run.
+
+    Args:
+        games (dict): Game parameters by game name.
+        agents (dict): Agent parameters by agent name.
+        envs (dict): Environment parameters by env name.
+        experiment_dir (str): Directory of the experiment.
+
+    Returns:
+        list: One dict per episode with the episode name and path, the config file and the parameters it uses.
+    """
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    episodes = []
+    for env_name, env_params in envs.items():
+        for agent_name, agent_params in agents.items():
+            for game_name, game_params in games.items():
+                config_dir = os.path.join(base_dir, 'Data', 'Configs', game_params.get('config_id', None))
+
+                # Load all config files from config_ID collection, sorted alphabetically
+                json_file_paths = [
+                    os.path.join(config_dir, file_name) for file_name in sorted(os.listdir(config_dir))
+                    if fnmatch.fnmatch(file_name, "config*.json")
+                ]
+
+                num_game_env = game_params.get('num_game_env', 0)
+                if num_game_env > len(json_file_paths):
+                    logging.warning(
+                        f"Number of game environments exceeds the number of config files in the dataset, "
+                        f"setting num_game_env to {len(json_file_paths)}."
+                    )
+                    num_game_env = len(json_file_paths)
+
+                for config_file_path in json_file_paths[:num_game_env]:
+                    json_base_name = os.path.splitext(os.path.basename(config_file_path))[0]
+                    episode_name = f"episode_{agent_name}_{game_name}_{env_name}_{json_base_name}"
+                    episodes.append({
+                        "episode_name": episode_name,
+                        "episode_path": os.path.join(experiment_dir, 'Episodes', episode_name),
+                        "config_file_path": config_file_path,
+                        "env_name": env_name,
+                        "env_params": env_params,
+                        "agent_name": agent_name,
+                        "agent_params": agent_params,
+                        "game_name": game_name,
+                        "game_params": game_params,
+                    })
+    return episodes
+
+
+def prepare_episode(episode):
+    """
+    Do all the work of an episode that does not need the simulator.
+
+    Args:
+        episode (dict): Episode as returned by collect_episodes.
+
+    Returns:
+        dict: The episode extended with its logger, env config, agent, game and the config sent with Setup.
+    """
+    episode_name = episode["episode_name"]
+    episode_path = episode["episode_path"]
+    env_name, env_params = episode["env_name"], episode["env_params"]
+    agent_name, agent_params = episode["agent_name"], episode["agent_params"]
+    game_name, game_params = episode["game_name"], episode["game_params"]
+
+    # Move the JSON and image files to the episode path
+    os.makedirs(episode_path, exist_ok=True)
+    util.copy_json_to_experiment(episode["config_file_path"], episode_path,
+                                 link_images=game_params.get('deduplicate_frames', False))
+
+    # Save envs, agents, and games data of the episode
+    metadata = {
+        "env": {env_name: env_params},
+        "agent": {agent_name: agent_params},
+        "game": {game_name: game_params}
+    }
+    with open(os.path.join(episode_path, 'metadata.json'), 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=4)
+
+    episode_logger = setup_episode_logging(episode_path, episode_name)
+    config = init_env(env_params, episode_path, episode_logger)
+    agent = init_agent(agent_params, episode_path, config, episode_logger)
+    game = init_game(game_params, episode_path, episode_logger)
+
+    prepared = dict(episode)
+    prepared.update({
+        "logger": episode_logger,
+        "config": config,
+        "agent": agent,
+        "game": game,
+        "setup_config": util.load_single_json_from_directory(episode_path),
+    })
+    return prepared
+
+
+async def prefetch_episodes(episodes, prefetch=1, release=None):
+    """
+    Yield prepared episodes, preparing up to `prefetch` further episodes in the background.
+
+    Preparation runs on a single worker thread, so episodes are prepared one after the other and in order, while
+    the event loop keeps running the episode that was yielded last. When the caller stops early, e.g. because an
+    episode failed, the episodes prepared ahead are cancelled and handed to `release`, so the claims a work queue
+    took for them are given back.
+
+    Args:
+        episodes (iterable): Episodes as returned by collect_episodes, or the claim generator of a work queue.
+        prefetch (int): Number of episodes prepared ahead of the running one, 0 prepares each episode on demand.
+        release (callable): Called with the name of every episode taken from `episodes` that was not yielded.
+
+    Yields:
+        dict: The prepared episodes as returned by prepare_episode.
+    """
+    loop = asyncio.get_running_loop()
+    remaining = iter(episodes)
+    pending = deque()
+
+    def submit(executor):
+        episode = next(remaining, None)
+        if episode is None:
+            return False
+        pending.append((episode, loop.run_in_executor(executor, prepare_episode, episode)))
+        return True
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="episode-prefetch") as executor:
+        try:
+            while pending or submit(executor):
+                # The episode stays pending until it is prepared, so a failed preparation is released as well
+                prepared = await pending[0][1]
+                pending.popleft()
+                # Start preparing the next episodes before handing this one to the caller
+                while len(pending) < prefetch and submit(executor):
+                    pass
+                yield prepared
+        finally:
+            while pending:
+                episode, future = pending.popleft()
+                future.cancel()
+                if release is not None:
+                    release(episode["episode_name"])
@@ -0,0 +1,240 @@
+"""
+- Record and replay of the messages exchanged between the experiment and the simulator
+- TraceRecorder wraps the websocket of an episode and writes every sent and received packet, starting with the
+  Setup packet, into a gzipped JSON Lines trace in the episode directory
+- ReplayConnection serves a trace back in-process, so the action-perception loop, the agents and
+  GameSystem.feed_sim_response can be benchmarked and regression tested offline without Unity
+- serve_traces runs a websocket server that stands in for relay and simulator and replays traces to a real
+  experiment runner at full speed
+"""
+import os
+import gzip
+import json
+import time
+import uuid
+import base64
+import logging
+import asyncio
+
+TRACE_FILE_NAME = "episode_trace.jsonl.gz"
+SERVER_ID = "0000-0000-0000-0000"
+
+
+class TraceRecorder:
+    """
+    Websocket proxy that records every packet of an episode into a trace file.
+
+    Only send, recv and close are used by the experiment, so those are the methods it proxies.
+    """
+
+    def __init__(self, websocket, trace_path, compresslevel=6):
+        self.websocket = websocket
+        self.trace_path = trace_path
+        self._file = gzip.open(trace_path, "wt", encoding="utf-8", compresslevel=compresslevel)
+        self._start = time.monotonic()
+
+    def _record(self, direction, message):
+        try:
+            content = json.loads(message)
+        except (TypeError, json.JSONDecodeError):
+            content = message
+        record = {"t": round(time.monotonic() - self._start, 6), "dir": direction, "message": content}
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    async def send(self, message):
+        self._record("send", message)
+        await self.websocket.send(message)
+
+    async def recv(self):
+        message = await self.websocket.recv()
+        self._record("recv", message)
+        return message
+
+    async def close(self):
+        self.finish()
+        await self.websocket.close()
+
+    def finish(self):
+        """Flush and close the trace file, the websocket stays open for the next episode."""
+        if not self._file.closed:
+            self._file.close()
+            logging.info(f"Saved episode trace {self.trace_path}")
+
+
+def load_trace(trace_path):
+    """
+    Load an episode trace.
+
+    Args:
+        trace_path (str): Path to a trace file or to an episode directory containing one.
+
+    Returns:
+        list: The trace records in order, each a dict with "t", "dir" and "message".
+    """
+    if os.path.isdir(trace_path):
+        trace_path = os.path.join(trace_path, TRACE_FILE_NAME)
+    with gzip.open(trace_path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def split_trace(records):
+    """
+    Group the received packets of a trace by the sent packet they answer.
+
+    Returns:
+        tuple: The list of sent packets and, for each of them, the list of packets received after it.
+            Packets received before the first send are attached to a leading None entry.
+    """
+    sends = [None]
+    replies = [[]]
+    for record in records:
+        if record["dir"] == "send":
+            sends.append(record["message"])
+            replies.append([])
+        else:
+            replies[-1].append(record["message"])
+    return sends, replies
+
+
+def _serialise(message):
+    return message if isinstance(message, str) else json.dumps(message)
+
+
+class ReplayConnection:
+    """
+    In-process stand-in for the websocket of an episode that serves the recorded simulator responses.
+
+    Responses are returned in recorded order regardless of what is sent, which keeps the replay deterministic.
+    With strict set, a sent packet whose command differs from the recorded one raises a RuntimeError.
+    """
+
+    def __init__(self, trace, strict=False):
+        records = load_trace(trace) if isinstance(trace, str) else trace
+        self._responses = [r["message"] for r in records if r["dir"] == "recv"]
+        self._expected = [r["message"] for r in records if r["dir"] == "send"]
+        self.strict = strict
+        self.sent = []
+        self.closed = False
+
+    async def send(self, message):
+        index = len(self.sent)
+        self.sent.append(message)
+        if self.strict and index < len(self._expected):
+            expected = self._expected[index]
+            actual = json.loads(message) if isinstance(message, str) else message
+            if isinstance(expected, dict) and expected.get("command") != actual.get("command"):
+                raise RuntimeError(f"Replay diverged at packet {index}: sent {actual.get('command')}, "
+                                   f"recorded {expected.get('command')}")
+
+    async def recv(self):
+        if not self._responses:
+            raise EOFError("Episode trace has no more recorded responses")
+        return _serialise(self._responses.pop(0))
+
+    async def close(self):
+        self.closed = True
+
+
+async def replay_episode(trace, agent, game, episode_logger, strict=False):
+    """
+    Run the action-perception loop for one episode against a recorded trace instead of the simulator.
+
+    Args:
+        trace (str or list): Trace file, episode directory or already loaded records.
+        agent: The agent performing the actions.
+        game: The game system that processes the simulator responses.
+        episode_logger: Logger of the episode.
+        strict (bool): Fail when the sent packets diverge from the recorded ones.
+
+    Returns:
+        ReplayConnection: The connection, whose sent attribute holds the packets the loop produced.
+    """
+    from action_perception_loop import interact_with_server
+
+    connection = ReplayConnection(trace, strict=strict)
+    await interact_with_server(connection, "replay-client", "replay-simulator", agent, game, episode_logger)
+    return connection
+
+
+def find_traces(experiment_id):
+    """Return the trace files of all episodes of an experiment, sorted by episode name."""
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    episodes_dir = os.path.join(base_dir, 'Data', 'Experiments', experiment_id, 'Episodes')
+    trace_paths = []
+    for episode_name in sorted(os.listdir(episodes_dir)):
+        trace_path = os.path.join(episodes_dir, episode_name, TRACE_FILE_NAME)
+        if os.path.exists(trace_path):
+            trace_paths.append(trace_path)
+    return trace_paths
+
+
+async def serve_traces(trace_paths, host="localhost", port=1984, stop_event=None):
+    """
+    Serve recorded episodes to an experiment runner, standing in for both relay and simulator.
+
+    The runner is paired automatically, every Setup packet starts the next trace and every sent packet is
+    answered with the packets that followed it in the recording, without any delay.
+
+    Args:
+        trace_paths (list): Trace files to replay, one per episode, in the order the runner will request them.
+        host (str): Host to listen on.
+        port (int): Port to listen on, the default is the port of the relay.
+        stop_event (asyncio.Event): Stops the server when set, None serves until cancelled.
+    """
+    import websockets
+
+    pending_traces = list(trace_paths)
+    simulator_id = str(uuid.uuid4())
+
+    async def handle_runner(websocket, path=None):
+        client_id = str(uuid.uuid4())
+        replies = []
+
+        async def reply(command, messages):
+            await websocket.send(json.dumps({"command": command, "from": SERVER_ID, "to": client_id,
+                                             "messages": messages, "payload": ""}))
+
+        await websocket.send(json.dumps({
+            "command": "Handshake", "from": SERVER_ID, "to": client_id,
+            "messages": ["action perception replay server", "your network id is registered"],
+            "payload": base64.b64encode(b"replay").decode("utf-8"),
+        }))
+        async for message in websocket:
+            message_data = json.loads(message)
+            command = message_data.get("command")
+            if command == "Claim":
+                await reply("Claimed", [simulator_id])
+            elif command == "Handshake":
+                await websocket.send(json.dumps({"command": "ACK", "from": simulator_id, "to": client_id,
+                                                 "messages": ["Handshake Acknowledged!"], "payload": ""}))
+            elif command == "Setup":
+                if not pending_traces:
+                    await reply("Error", ["No recorded episodes left to replay."])
+                    continue
+                # replies[0] holds packets received before Setup, replies[1] the answer to Setup itself
+                _, episode_replies = split_trace(load_trace(pending_traces.pop(0)))
+                for response in (episode_replies[1] if len(episode_replies) > 1 else []):
+                    await websocket.send(_serialise(response))
+                replies = episode_replies[2:]
+            elif command in ("Release", "ClientClose"):
+                continue
+            elif replies:
+                for response in replies.pop(0):
+                    await websocket.send(_serialise(response))
+
+    server = await websockets.serve(handle_runner, host, port, max_size=None)
+    logging.info(f"Replay server for {len(pending_traces)} episodes started on ws://{host}:{port}")
+    try:
+        await (stop_event.wait() if stop_event is not None else asyncio.Future())
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    experiment_id = "Test_Auto_Done"
+    try:
+        asyncio.run(serve_traces(find_traces(experiment_id)))
+    except KeyboardInterrupt:
+        logging.info("Replay server interrupted")
@@ -0,0 +1,225 @@
+"""
+- Splitting one experiment across several hosts
+- Static sharding assigns every episode of the cross product of envs, agents, games and configs to exactly one of
+  shard_count shards, so each host runs run_experiment with its own shard_index
+- Dynamic sharding lets workers claim episodes from a file-based work queue on shared storage, a claim is the
+  atomic creation of a claim file, so no lock server is needed
+- Every shard runs as its own experiment <experiment_id>_shard_<name> with its own checkpoint,
+  merge_shards combines the finished shards into the single Data/Experiments/<experiment_id> tree
+"""
+import os
+import json
+import glob
+import shutil
+import socket
+import logging
+from datetime import datetime
+
+from frame_store import FRAME_STORE_DIR_NAME, stored_objects, frame_references, relink_frames
+
+SHARD_SEPARATOR = "_shard_"
+WORK_QUEUE_DIR_NAME = "work_queue"
+
+
+def experiments_dir():
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    return os.path.join(base_dir, 'Data', 'Experiments')
+
+
+def shard_experiment_id(experiment_id, shard_name):
+    """Return the experiment ID under which a shard stores its episodes and checkpoint."""
+    return f"{experiment_id}{SHARD_SEPARATOR}{shard_name}"
+
+
+def shard_episodes(episodes, shard_index, shard_count):
+    """
+    Select the episodes of one shard.
+
+    Episodes are assigned round robin in the order of collect_episodes, which only depends on the experiment
+    parameters and the config datasets, so every host computes the same split.
+
+    Args:
+        episodes (list): Episodes as returned by collect_episodes.
+        shard_index (int): Index of this shard, from 0 to shard_count - 1.
+        shard_count (int): Total number of shards.
+
+    Returns:
+        list: The episodes of this shard.
+    """
+    if shard_index is None or shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f"Invalid shard {shard_index} of {shard_count}")
+    return episodes[shard_index::shard_count]
+
+
+def select_episodes(episodes, completed, queue=None, logger=None):
+    """
+    Select the episodes a run still has to play.
+
+    Args:
+        episodes (list): Episodes as returned by collect_episodes.
+        completed: Names of the completed episodes of this run, e.g. its CheckpointJournal.
+        queue (FileWorkQueue): Work queue the episodes are claimed from, None to play all pending episodes.
+        logger (logging.Logger): Logger of the experiment.
+
+    Returns:
+        tuple: The episodes to play and the number of episodes of the run that are finished already. With a
+            queue the episodes to play are a generator that claims each episode only when it is requested, and
+            the finished episodes are those of all workers.
+    """
+    pending = []
+    for episode in episodes:
+        if episode["episode_name"] in completed:
+            (logger or logging).info(f"Skipping completed episode: {episode['episode_name']}")
+        else:
+            pending.append(episode)
+    if queue is None:
+        return pending, len(episodes) - len(pending)
+    # Episodes are claimed one at a time when the pipeline asks for the next one, how many this worker gets is
+    # only known once the queue is drained
+    return queue.claim_episodes(pending), queue.progress()[1]
+
+
+class FileWorkQueue:
+    """
+    Work queue of episodes on storage shared by all workers.
+
+    A worker owns an episode once it created <episode_name>.claim with O_CREAT | O_EXCL, which is atomic on local
+    file systems and NFS, and marks it finished with <episode_name>.done. Claims of a worker that crashed can be
+    taken over by restarting it with the same worker ID.
+    """
+
+    def __init__(self, experiment_id, worker_id=None):
+        self.queue_dir = os.path.join(experiments_dir(), experiment_id, WORK_QUEUE_DIR_NAME)
+        self.worker_id = worker_id or socket.gethostname()
+        os.makedirs(self.queue_dir, exist_ok=True)
+
+    def _path(self, episode_name, suffix):
+        return os.path.join(self.queue_dir, f"{episode_name}.{suffix}")
+
+    def is_done(self, episode_name):
+        return os.path.exists(self._path(episode_name, "done"))
+
+    def owner(self, episode_name):
+        """Return the worker ID holding the claim on an episode, or None if it is unclaimed."""
+        try:
+            with open(self._path(episode_name, "claim"), 'r') as f:
+                return json.load(f).get("worker_id")
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            # The claim file exists but its owner has not written it yet
+            return ""
+
+    def claim(self, episode_name):
+        """
+        Try to claim an episode.
+
+        Returns:
+            bool: True if this worker now owns the episode.
+        """
+        if self.is_done(episode_name):
+            return False
+        try:
+            fd = os.open(self._path(episode_name, "claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Resume the claims this worker held before it was restarted
+            return self.owner(episode_name) == self.worker_id
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"worker_id": self.worker_id, "timestamp": datetime.now().isoformat()}, f)
+        return True
+
+    def release(self, episode_name):
+        """Give up the claim on an unfinished episode so another worker can run it."""
+        if self.owner(episode_name) == self.worker_id:
+            os.remove(self._path(episode_name, "claim"))
+
+    def mark_done(self, episode_name):
+        with open(self._path(episode_name, "done"), 'w') as f:
+            json.dump({"worker_id": self.worker_id, "timestamp": datetime.now().isoformat()}, f)
+
+    def claim_episodes(self, episodes):
+        """Yield the episodes this worker managed to claim, claiming each only when it is requested."""
+        for episode in episodes:
+            if self.claim(episode["episode_name"]):
+                logging.info(f"Worker {self.worker_id} claimed episode {episode['episode_name']}")
+                yield episode
+
+    def progress(self):
+        """Return the number of claimed and of finished episodes."""
+        return (len(glob.glob(os.path.join(self.queue_dir, "*.claim"))),
+                len(glob.glob(os.path.join(self.queue_dir, "*.done"))))
+
+
+def find_shards(experiment_id):
+    """Return the experiment IDs of all shards of an experiment."""
+    pattern = os.path.join(experiments_dir(), f"{glob.escape(experiment_id)}{SHARD_SEPARATOR}*")
+    return sorted(os.path.basename(path) for path in glob.glob(pattern) if os.path.isdir(path))
+
+
+def merge_shards(experiment_id, shard_ids=None, move=False):
+    """
+    Combine the completed episodes of all shards into Data/Experiments/<experiment_id>.
+
+    Only episodes a shard checkpointed as completed are merged, episodes that already exist in the merged tree are
+    kept. The merged checkpoint lists every completed episode, so the merged experiment can be resumed or
+    evaluated like one that ran on a single host. Frames a shard deduplicated into its frame store are added to the
+    frame store of the merged experiment and linked from there, so they survive removing the shard.
+
+    Args:
+        experiment_id (str): ID of the sharded experiment.
+        shard_ids (list): Shard experiment IDs to merge, all shards found on disk if None.
+        move (bool): Move the episode directories instead of copying them.
+
+    Returns:
+        dict: Number of merged episodes per shard.
+    """
+    from checkpoints import load_checkpoint, save_checkpoint
+
+    shard_ids = shard_ids if shard_ids is not None else find_shards(experiment_id)
+    episodes_dir = os.path.join(experiments_dir(), experiment_id, 'Episodes')
+    store_dir = os.path.join(experiments_dir(), experiment_id, FRAME_STORE_DIR_NAME)
+    os.makedirs(episodes_dir, exist_ok=True)
+
+    state = load_checkpoint(experiment_id) or {"completed": []}
+    completed = set(state["completed"])
+    merged = {}
+    for shard_id in shard_ids:
+        shard_state = load_checkpoint(shard_id) or {"completed": []}
+        shard_dir = os.path.join(experiments_dir(), shard_id)
+        shard_store_dir = os.path.join(shard_dir, FRAME_STORE_DIR_NAME)
+        shard_objects = stored_objects(shard_store_dir) if os.path.isdir(shard_store_dir) else None
+        merged[shard_id] = 0
+        for episode_name in shard_state.get("completed", []):
+            source = os.path.join(shard_dir, 'Episodes', episode_name)
+            target = os.path.join(episodes_dir, episode_name)
+            if episode_name in completed or not os.path.isdir(source):
+                continue
+            # Find the stored frames before the links are moved away from the store or copied as plain files
+            references = frame_references(source, shard_store_dir, shard_objects) if shard_objects is not None else {}
+            if move:
+                shutil.move(source, target)
+            else:
+                shutil.copytree(source, target, dirs_exist_ok=True)
+            relink_frames(target, references, store_dir)
+            state["completed"].append(episode_name)
+            completed.add(episode_name)
+            merged[shard_id] += 1
+
+        # Keep the log of every shard next to the merged episodes
+        shard_log = os.path.join(shard_dir, 'experiment_log.log')
+        if os.path.exists(shard_log):
+            shutil.copy(shard_log, os.path.join(experiments_dir(), experiment_id, f"experiment_log_{shard_id}.log"))
+        logging.info(f"Merged {merged[shard_id]} episodes of shard {shard_id}")
+
+    state.setdefault("merged_shards", {}).update(
+        {shard_id: {"episodes": count, "timestamp": datetime.now().isoformat()} for shard_id, count in merged.items()}
+    )
+    save_checkpoint(experiment_id, state)
+    return merged
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    experiment_id = "ICML_benchmark"
+    merged = merge_shards(experiment_id)
+    print(f"Merged {sum(merged.values())} episodes from {len(merged)} shards into {experiment_id}")
@@ -5,9 +5,11 @@ import time
 import csv
 import json
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 import fnmatch
 
+import annotation
+
 
 def load_params_from_json(file_name):
     """
@@ -377,13 +379,14 @@ def copy_files_to_experiment(json_file_path, image_file_paths, experiment_path):
 
 
 
-def copy_json_to_experiment(json_file_path, experiment_path):
+def copy_json_to_experiment(json_file_path, experiment_path, link_images=False):
     """
     Copies the JSON and PNG files (with the same base name) to the specified experiment path.
 
     Args:
         json_file_path (str): The full path of the JSON file to be copied.
         experiment_path (str): The path to the experiment directory where the files should be copied.
+        link_images (bool): Hard link the PNG file instead of copying it, falls back to copying if linking fails.
     """
     try:
         # Ensure the experiment directory exists
@@ -398,7 +401,12 @@ def copy_json_to_experiment(json_file_path, experiment_path):
         png_file_path = os.path.splitext(json_file_path)[0] + '.png'  # Replace .json with .png
         if os.path.exists(png_file_path):
             png_file_dest = os.path.join(experiment_path, os.path.basename(png_file_path))
-            shutil.copy(png_file_path, png_file_dest)
+            try:
+                if not link_images:
+                    raise OSError("Linking disabled")
+                os.link(png_file_path, png_file_dest)
+            except OSError:
+                shutil.copy(png_file_path, png_file_dest)
 
     except Exception as e:
         print(f"Error copying files: {e}")
@@ -472,19 +480,10 @@ def merge_images(single_img_filename, obs_dir, bar_width=20, bar_height=80, text
     text_current = "Current State"
     text_goal = "Goal State"
 
-    # Dynamically adjust font size based on image width and text_fraction
-    fontsize = 1  # Start with font size 1
+    # Largest font size at which the text stays below the desired fraction of the image width
     font_path = "arial.ttf"  # Use a default or available TTF font path on your system
-    font = ImageFont.truetype(font_path, fontsize)
-
-    # Increase font size until it fits the desired fraction of image width
-    while draw.textbbox((0, 0), text_current, font=font)[2] < text_fraction * img1.width:
-        fontsize += 1
-        font = ImageFont.truetype(font_path, fontsize)
-
-    # Optionally decrease by 1 to ensure it's less than or equal to the desired fraction
-    fontsize -= 1
-    font = ImageFont.truetype(font_path, fontsize)
+    fontsize = annotation.fit_font_size(text_current, text_fraction * img1.width, font_path)
+    font = annotation.load_font(fontsize, font_path)
 
     # Calculate text width and position based on the new font size
     current_text_width = draw.textbbox((0, 0), text_current, font=font)[2]  # Use textbbox
@@ -0,0 +1,165 @@
+"""
+- Content-addressed storage of observation frames shared by all episodes of an experiment
+- A frame is identified by a hash of its decoded pixels, so byte-identical screenshots of invalid moves, repeated
+  states or the same config played by several agents are encoded and written only once
+- Episode directories reference the stored frame under their usual obs/obs_{i}_{2D,3D}.png name through a hard link,
+  or a symbolic link where hard links are not supported, so existing readers keep working unchanged
+- Episodes merged into another experiment, e.g. the shards of a sharded run, take their frames along into the frame
+  store of that experiment and are linked to it again, see frame_references and relink_frames
+"""
+import os
+import shutil
+import hashlib
+import logging
+
+FRAME_STORE_DIR_NAME = "FrameStore"
+
+
+def frame_hash(image):
+    """Return the content hash of a PIL image, including its mode and size."""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode("utf-8"))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def experiment_frame_store_dir(episode_path):
+    """Return the frame store of the experiment an episode directory belongs to."""
+    return os.path.abspath(os.path.join(episode_path, '..', '..', FRAME_STORE_DIR_NAME))
+
+
+class FrameStore:
+    """
+    Directory of encoded frames named by the hash of their pixels.
+
+    Frames are written to a temporary file and renamed into place, so several writer threads or processes can
+    store the same frame at the same time.
+
+    Args:
+        store_dir (str): Directory of the store, usually Data/Experiments/<id>/FrameStore.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.num_stored = 0
+        self.num_reused = 0
+
+    def object_path(self, digest, extension):
+        return os.path.join(self.store_dir, digest[:2], f"{digest}{extension}")
+
+    def put(self, image, path, write):
+        """
+        Store an image and reference it from path.
+
+        Args:
+            image (PIL.Image.Image): The frame.
+            path (str): Path of the reference in the episode directory, its extension selects the stored format.
+            write (callable): write(image, path) encodes the image, used only if the frame is not stored yet.
+
+        Returns:
+            str: The hash of the frame.
+        """
+        digest = frame_hash(image)
+        object_path = self.object_path(digest, os.path.splitext(path)[1])
+        if os.path.exists(object_path):
+            self.num_reused += 1
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f"{object_path}.{os.getpid()}.{id(image)}.tmp{os.path.splitext(path)[1]}"
+            write(image, tmp_path)
+            os.replace(tmp_path, object_path)
+            self.num_stored += 1
+        link_frame(object_path, path)
+        return digest
+
+
+def link_frame(object_path, path):
+    """Reference a stored frame from an episode directory, copying it only as the last resort."""
+    if os.path.lexists(path):
+        os.remove(path)
+    try:
+        os.link(object_path, path)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.relpath(object_path, os.path.dirname(path)), path)
+    except OSError as e:
+        logging.warning(f"Could not link {path} to the frame store, copying it instead: {e}")
+        shutil.copy(object_path, path)
+
+
+def stored_objects(store_dir):
+    """Return the paths of the objects of a frame store by their (device, inode), to match hard links."""
+    objects = {}
+    for root, _, files in os.walk(os.path.abspath(store_dir)):
+        for file_name in files:
+            object_path = os.path.join(root, file_name)
+            stat = os.stat(object_path)
+            objects[(stat.st_dev, stat.st_ino)] = object_path
+    return objects
+
+
+def frame_references(episode_path, store_dir, objects=None):
+    """
+    Find the files of an episode directory that reference a stored frame.
+
+    Hard links are matched by inode against the objects of the store, symbolic links by their target, so the
+    frames can be found again after the episode directory was copied or moved away from the store.
+
+    Args:
+        episode_path (str): The episode directory.
+        store_dir (str): The frame store the episode was written with.
+        objects (dict): stored_objects of the store, pass it when looking at several episodes of one store.
+
+    Returns:
+        dict: Path of the object in the store by path of the file relative to the episode directory.
+    """
+    store_dir = os.path.abspath(store_dir)
+    objects = stored_objects(store_dir) if objects is None else objects
+    references = {}
+    for root, _, files in os.walk(episode_path):
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            if os.path.islink(path):
+                object_path = os.path.normpath(os.path.join(os.path.abspath(root), os.readlink(path)))
+                if os.path.commonpath([object_path, store_dir]) != store_dir:
+                    continue
+            else:
+                stat = os.stat(path)
+                object_path = objects.get((stat.st_dev, stat.st_ino)) if stat.st_nlink > 1 else None
+                if object_path is None:
+                    continue
+            references[os.path.relpath(path, episode_path)] = object_path
+    return references
+
+
+def relink_frames(episode_path, references, store_dir):
+    """
+    Reference the frames of an episode from another frame store, adding the stored objects it does not have yet.
+
+    Args:
+        episode_path (str): The episode directory at its new place.
+        references (dict): As returned by frame_references for the episode at its old place.
+        store_dir (str): The frame store of the experiment the episode now belongs to.
+
+    Returns:
+        int: Number of frames linked to the store.
+    """
+    linked = 0
+    for relative_path, object_path in references.items():
+        target_object = os.path.join(store_dir, os.path.basename(os.path.dirname(object_path)),
+                                     os.path.basename(object_path))
+        if not os.path.exists(target_object):
+            if not os.path.exists(object_path):
+                logging.warning(f"Stored frame {object_path} of {relative_path} is missing, it keeps its file")
+                continue
+            os.makedirs(os.path.dirname(target_object), exist_ok=True)
+            try:
+                os.link(object_path, target_object)
+            except OSError:
+                shutil.copy2(object_path, target_object)
+        link_frame(target_object, os.path.join(episode_path, relative_path))
+        linked += 1
+    return linked
@@ -1,18 +1,29 @@
 import os
 import json
-from PIL import Image
-import base64
 import logging
 
-from render_2D import render_schematic
+import component_registry
+from episode_logs import EpisodeLogWriter
+from observation_writer import ObservationWriter
+from frame_store import FrameStore, experiment_frame_store_dir
+from observation_archive import ObservationArchiveWriter, archive_path
+from screenshot_decoding import decode_screenshot
 
 class GameSystem:
 
-    def __init__(self, experiment_path, instruction_prompt_file_path, chain_of_thoughts, representation_type, predict_board_state):
+    def __init__(self, experiment_path, instruction_prompt_file_path, chain_of_thoughts, representation_type, predict_board_state,
+                 observation_format="png", compress_level=6, save_intermediate_3D=True, deduplicate_frames=False,
+                 archive_observations=False):
         """
         Initialize the GameSystem.
         Args:
             experiment_path (str): The path where the log files will be saved.
+            observation_format (str): Image format of the saved observations, "png", "webp" or "jpeg".
+            compress_level (int): PNG compression level of the saved observations.
+            save_intermediate_3D (bool): Save every 3D frame, otherwise only the first and the last one of the episode.
+            deduplicate_frames (bool): Keep identical frames once in the experiment's frame store and link them into obs.
+            archive_observations (bool): Store the frames in the episode archive obs/observations.ivobs instead of
+                single image files.
         """
         self.experiment_path = experiment_path
         base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
@@ -37,6 +48,13 @@ class GameSystem:
         self.is_done = False
         self.agent_message_log = []
         self.sim_message_log = {}  # Changed to a dictionary
+        self.log_writer = EpisodeLogWriter(experiment_path)
+        frame_store = FrameStore(experiment_frame_store_dir(experiment_path)) if deduplicate_frames else None
+        archive = ObservationArchiveWriter(archive_path(experiment_path)) if archive_observations else None
+        self.observation_writer = ObservationWriter(image_format=observation_format, compress_level=compress_level,
+                                                    frame_store=frame_store, archive=archive)
+        self.save_intermediate_3D = save_intermediate_3D
+        self._last_3D_frame = None
 
 
     def feed_agent_response(self, agent_message):
@@ -47,6 +65,7 @@ class GameSystem:
         """
 
         self.agent_message_log.append(agent_message)
+        self.log_writer.append_agent_message(agent_message)
 
 
     def feed_sim_response(self, response, i): #TODO make this i step number internal param of game
@@ -66,6 +85,7 @@ class GameSystem:
                 self.is_done = sim_message.get("game_done", False)
                 step_key = f"step {i}"  # Create the step key as "step 1", "step 2", etc.
                 self.sim_message_log[step_key] = sim_message  # Add the message to the log
+                self.log_writer.append_sim_message(step_key, sim_message)
             else:
                 logging.error("Invalid simulation message format. Must be a dictionary after parsing.")
         except json.JSONDecodeError as e:
@@ -73,58 +93,47 @@ class GameSystem:
 
         # add 2D modality
         if self.representation_type=='vision' or self.representation_type == 'text':
-            encoded_data = response.get("payload")
-            img_observation = base64.b64decode(encoded_data)
-            image = Image.frombytes('RGBA', (1200, 900), img_observation, 'raw')
-            image = image.transpose(Image.FLIP_TOP_BOTTOM)
+            screenshot = decode_screenshot(response.get("payload"))
+            # The text representation never looks at the pixels, the writer thread converts them when saving
+            image = screenshot.image if self.representation_type == 'vision' else screenshot
 
             filename = os.path.join(self.obs_dir, f"obs_{i}_3D")
+            self._save_3D_frame(image, filename, i)
 
         elif self.representation_type=='schematic':
-            image = render_schematic(sim_message.get("board_data", []))
+            image = component_registry.renderer("schematic")(sim_message.get("board_data", []))
 
-            encoded_data = response.get("payload")
-            img_observation = base64.b64decode(encoded_data)
-            image2 = Image.frombytes('RGBA', (1200, 900), img_observation, 'raw')
-            image2 = image2.transpose(Image.FLIP_TOP_BOTTOM)
+            # Only saved, so the screenshot is converted on the writer thread
+            image2 = decode_screenshot(response.get("payload"))
 
             filename = os.path.join(self.obs_dir, f"obs_{i}_2D")
-            filename2 = os.path.join(self.obs_dir, f"obs_{i}_3D")
-
-            try:
-                filename2 = f"{filename2}.png"
-                image2.save(filename2)  # Save the image as a PNG
-            except Exception as e:
-                logging.error(f"Error saving image to {filename2}: {e}")
+            self._save_3D_frame(image2, os.path.join(self.obs_dir, f"obs_{i}_3D"), i)
+            self.observation_writer.save_image(image, filename)
 
         else:
             raise Exception(f"Unknown representation type: {self.representation_type}")
 
-
-        # Save the image as a PNG file
-        try:
-            image_path = f"{filename}.png"
-            image.save(image_path)  # Save the image as a PNG
-        except Exception as e:
-            logging.error(f"Error saving image to {filename}: {e}")
-
         current_board_state = ""
         if isinstance(sim_message, dict):
-            # Extract the board state
+            # Extract the board state and save it as a JSON file in the background
             current_board_state = sim_message.get("board_state", [])
-
-            # Save the board state as a JSON file
-            try:
-                json_path = f"{filename}.json"
-                with open(json_path, 'w') as f:
-                    json.dump(current_board_state, f, indent=4)
-            except Exception as e:
-                logging.error(f"Error saving board state to {filename}.json: {e}")
+            self.observation_writer.save_json(current_board_state, f"{filename}.json")
 
 
         return current_board_state if self.representation_type=='text' else image
 
 
+    def _save_3D_frame(self, image, filename, i):
+        """
+        Queue a 3D frame for saving, intermediate frames are held back when they should not be saved.
+        """
+        if self.save_intermediate_3D or i == 0:
+            self.observation_writer.save_image(image, filename)
+        else:
+            # Only the frame seen last is written, by end_game
+            self._last_3D_frame = (image, filename)
+
+
     def check_done(self, response):
         """
         Check if the game system is done.
@@ -142,39 +151,44 @@ class GameSystem:
 
     def end_game(self):
         """
-        End the game, append an ending message, and save logs.
+        End the game and write the final logs, including sim_message_log.json.
         """
         #self.sim_message_log.append({"message": "Game was ended, possibly due to running out of steps"})
-        self._save_logs()
+        self.close_observations()
+        try:
+            self.log_writer.finalize()
+        except IOError as e:
+            logging.error(f"Error finalizing episode logs: {e}")
 
 
-    def _save_logs(self):
+    def close_observations(self):
         """
-        Save the agent message log to a text file and the sim message log to a JSON file.
+        Write the observations still queued, including the 3D frame held back last, and stop the writer.
+
+        Safe to call more than once, the action-perception loop calls it again when an episode fails.
         """
-        os.makedirs(self.experiment_path, exist_ok=True)
+        if self._last_3D_frame is not None:
+            self.observation_writer.save_image(*self._last_3D_frame)
+            self._last_3D_frame = None
+        self.observation_writer.close()
 
-        # Save agent message log as a simple text file
-        agent_message_log_path = os.path.join(self.experiment_path, "agent_message_log.txt")
-        try:
-            with open(agent_message_log_path, "w") as log_file:
-                log_file.write("\n".join(self.agent_message_log))
-        except IOError as e:
-            logging.error(f"Error saving agent log: {e}")
 
-        # Save sim message log as a JSON file
-        sim_message_log_path = os.path.join(self.experiment_path, "sim_message_log.json")
+    def _save_logs(self):
+        """
+        Flush the agent and sim message logs, only the records added since the last call are written.
+        """
         try:
-            with open(sim_message_log_path, "w") as log_file:
-                json.dump(self.sim_message_log, log_file, indent=4)
+            self.log_writer.flush()
         except IOError as e:
-            logging.error(f"Error saving simulation log: {e}")
+            logging.error(f"Error saving episode logs: {e}")
 
 
 class InteractivePuzzle(GameSystem):
 
-    def __init__(self, experiment_id, instruction_prompt_file_path, chain_of_thoughts, representation_type, planning_steps, max_game_length,predict_board_state):
-        super().__init__(experiment_id, instruction_prompt_file_path, chain_of_thoughts, representation_type, predict_board_state)
+    def __init__(self, experiment_id, instruction_prompt_file_path, chain_of_thoughts, representation_type, planning_steps, max_game_length,predict_board_state,
+                 **observation_params):
+        super().__init__(experiment_id, instruction_prompt_file_path, chain_of_thoughts, representation_type, predict_board_state,
+                         **observation_params)
         self.planning_steps = planning_steps
         self.max_game_length = max_game_length
         self.iteration = 0
@@ -199,8 +213,9 @@ class InteractivePuzzle(GameSystem):
 
 class SceneUnderstanding(GameSystem):
 
-    def __init__(self, experiment_id, instruction_prompt_file_path, chain_of_thoughts):
-        super().__init__(experiment_id, instruction_prompt_file_path, chain_of_thoughts, representation_type='vision', predict_board_state=True)
+    def __init__(self, experiment_id, instruction_prompt_file_path, chain_of_thoughts, **observation_params):
+        super().__init__(experiment_id, instruction_prompt_file_path, chain_of_thoughts, representation_type='vision', predict_board_state=True,
+                         **observation_params)
 
 
     def feed_sim_response(self, response, i):
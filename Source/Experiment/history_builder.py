@@ -0,0 +1,143 @@
+"""
+- History of the previous steps in the requests of the LLM agents, shared by GPT-4o, Claude, Gemini and Qwen2
+- The turns of the last max_history steps are estimated in tokens, text by characters and images by the vision token
+  formula of the provider at the size the image pipeline sends
+- With a history_token_budget the newest turns that fit into the budget are sent in full, the older turns of the
+  window are summarized as the list of their actions, or dropped if even the summary does not fit
+- The turns are returned in the message structure of each provider, images come encoded from the episode image
+  cache, so a past frame is encoded once no matter how many requests it is part of
+"""
+from PIL import Image
+
+from image_pipeline import image_tokens
+from provider_scheduler import estimate_tokens
+
+
+class HistoryBuilder:
+    """
+    Previous turns of an agent in the structure of its provider.
+
+    Args:
+        image_cache (EpisodeImageCache): Annotated and encoded images of the episode.
+        provider (str): "openai", "anthropic", "gemini" or None for local models, for the image token estimate.
+        max_history (int): Most previous steps in a request.
+        token_budget (int): Most estimated tokens of the history, None for no limit.
+        logger (logging.Logger): Episode logger, notes the steps that did not fit into the budget.
+    """
+
+    def __init__(self, image_cache, provider=None, max_history=0, token_budget=None, logger=None):
+        self.image_cache = image_cache
+        self.provider = provider
+        self.max_history = max_history
+        self.token_budget = token_budget
+        self.logger = logger
+        self.last_tokens = 0
+        self.last_summarized = 0
+
+    @staticmethod
+    def _is_image(exchange):
+        return isinstance(exchange['observation'], Image.Image)
+
+    def _past_image(self, exchange):
+        return self.image_cache.image(exchange['observation'], exchange.get('step'), 'past')
+
+    def turn_tokens(self, exchange):
+        """Estimated tokens of one previous turn, its observation and its action."""
+        if self._is_image(exchange):
+            observation_tokens = image_tokens(*self._past_image(exchange).size, self.provider)
+        else:
+            observation_tokens = estimate_tokens(str(exchange['observation']))
+        return observation_tokens + estimate_tokens(str(exchange['response']))
+
+    @staticmethod
+    def summary_text(exchanges):
+        actions = "; ".join(str(exchange['response']) for exchange in exchanges)
+        return f"Actions of the {len(exchanges)} steps before, oldest first: {actions}"
+
+    def select(self, chat_history):
+        """
+        Split the history window into turns to summarize and turns to send in full.
+
+        Returns:
+            tuple: The summary text or None, and the turns sent in full, oldest first.
+        """
+        window = chat_history[-self.max_history:] if self.max_history > 0 else []
+        kept, used = [], 0
+        for exchange in reversed(window):
+            tokens = self.turn_tokens(exchange)
+            if self.token_budget is not None and used + tokens > self.token_budget:
+                break
+            kept.append(exchange)
+            used += tokens
+        kept.reverse()
+        older = window[:len(window) - len(kept)]
+        summary = None
+        if older:
+            summary = self.summary_text(older)
+            if used + estimate_tokens(summary) > self.token_budget:
+                summary = None
+            else:
+                used += estimate_tokens(summary)
+        self.last_tokens = used
+        self.last_summarized = len(older)
+        if older and self.logger is not None:
+            self.logger.info(f"\nHistory: {len(kept)} steps in full, {len(older)} "
+                             f"{'summarized' if summary else 'dropped'}, ~{used} of {self.token_budget} tokens")
+        return summary, kept
+
+    def openai_messages(self, chat_history):
+        """Previous turns as OpenAI chat messages."""
+        return self._chat_messages(chat_history, lambda media_type, data: {
+            "type": "image_url", "image_url": {"url": f"data:{media_type};base64,{data}"}
+        })
+
+    def anthropic_messages(self, chat_history):
+        """Previous turns as Anthropic messages."""
+        return self._chat_messages(chat_history, lambda media_type, data: {
+            "type": "image", "source": {"type": "base64", "media_type": media_type, "data": data}
+        })
+
+    def qwen_messages(self, chat_history):
+        """Previous turns as messages of the Qwen2-VL chat template."""
+        return self._chat_messages(chat_history, lambda media_type, data: {
+            "type": "image", "image": f'data:image;base64,{data}'
+        })
+
+    def _chat_messages(self, chat_history, image_part):
+        summary, kept = self.select(chat_history)
+        messages = [{"role": "user", "content": summary}] if summary else []
+        for i, exchange in enumerate(kept, 1):
+            if self._is_image(exchange):
+                data = self.image_cache.encoded(exchange['observation'], exchange.get('step'), 'past')
+                messages.extend([
+                    {"role": "user", "content": [image_part(self.image_cache.pipeline.media_type, data)]},
+                    {"role": "assistant", "content": f"Action: {exchange['response']}"}
+                ])
+            else:
+                messages.extend([
+                    {"role": "user", "content": f"Previous observation {i}: {exchange['observation']}"},
+                    {"role": "assistant", "content": f"Previous action {i}: {exchange['response']}"}
+                ])
+        return messages
+
+    def gemini_parts(self, chat_history):
+        """Previous turns as Gemini content parts, images as blobs."""
+        summary, kept = self.select(chat_history)
+        parts = [summary] if summary else []
+        for exchange in kept:
+            if self._is_image(exchange):
+                parts.append(self.image_cache.blob(exchange['observation'], exchange.get('step'), 'past'))
+                parts.append(f"Previous action: {exchange['response']}")
+            else:
+                parts.append(f"Previous observation: {exchange['observation']}\n"
+                             f"Previous action: {exchange['response']}\n\n")
+        return parts
+
+    def gemini_text_context(self, chat_history):
+        """Previous turns of text observations as the context string of the Gemini text prompt."""
+        summary, kept = self.select(chat_history)
+        context = f"{summary}\n\n" if summary else ""
+        for exchange in kept:
+            context += f"Previous observation: {exchange['observation']}\n"
+            context += f"Previous action: {exchange['response']}\n\n"
+        return context
@@ -0,0 +1,251 @@
+"""
+- Compression and downscaling of the state images an agent sends to its model, configured per agent with the
+  image_pipeline agent param
+- Images can be cropped to the board, scaled down to a target resolution and encoded as PNG, JPEG or WebP with
+  a quality, smaller images are cheaper to upload and cost fewer vision tokens
+- The board box is found from the transparency of the observation once per image size and reused, EpisodeImageCache
+  runs every frame through the pipeline once
+- ImageStats count the bytes and the estimated vision tokens of the sent images against the full size PNG, the
+  agents log them per step to trade accuracy against latency and cost
+"""
+import io
+import math
+import base64
+import logging
+from dataclasses import dataclass
+
+from PIL import Image
+
+# PIL format and media type per image format
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+DEFAULT_QUALITY = 85
+BOARD_MARGIN = 10  # Pixels kept around the board when cropping
+BOARD_ALPHA_THRESHOLD = 8  # Pixels more transparent than this are background, ignores faint anti-aliasing
+
+
+def image_tokens(width, height, provider=None):
+    """
+    Estimate the vision tokens of an image, following the published formulas of the providers.
+
+    Args:
+        width (int): Width of the image in pixels.
+        height (int): Height of the image in pixels.
+        provider (str): "openai", "anthropic", "gemini", None for Qwen2-VL style 28 x 28 pixel patches.
+
+    Returns:
+        int: Estimated tokens.
+    """
+    if provider == "openai":
+        # Fit into 2048 x 2048, shortest side to 768, 170 tokens per 512 tile and 85 for the overview
+        scale = min(1.0, 2048 / max(width, height))
+        scale *= min(1.0, 768 / (min(width, height) * scale))
+        return 85 + 170 * math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    if provider == "anthropic":
+        scale = min(1.0, 1568 / max(width, height))
+        return math.ceil(width * scale * height * scale / 750)
+    if provider == "gemini":
+        if width <= 384 and height <= 384:
+            return 258
+        return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+    return math.ceil(width / 28) * math.ceil(height / 28)
+
+
+@dataclass
+class ImageStats:
+    """Bytes and estimated tokens of sent images, and of the full size PNGs they replace."""
+    images: int = 0
+    bytes: int = 0
+    original_bytes: int = 0
+    tokens: int = 0
+    original_tokens: int = 0
+
+    def __iadd__(self, other):
+        self.images += other.images
+        self.bytes += other.bytes
+        self.original_bytes += other.original_bytes
+        self.tokens += other.tokens
+        self.original_tokens += other.original_tokens
+        return self
+
+    def summary(self):
+        return (f"{self.images} images, {self.bytes / 1024:.0f} KiB "
+                f"(saved {(self.original_bytes - self.bytes) / 1024:.0f} KiB), ~{self.tokens} tokens "
+                f"(saved ~{self.original_tokens - self.tokens})")
+
+
+class ImagePipeline:
+    """
+    Crop, downscale and encode state images for a model.
+
+    The defaults send the full image as PNG, like the agents did before the pipeline existed.
+
+    Args:
+        resolution (int | list): Maximum [width, height] of the sent image, or the maximum of its longer side.
+            The aspect ratio is kept and images are never scaled up, None keeps the size.
+        crop_to_board (bool): Crop the transparent border around the board, keeping the state label.
+        image_format (str): "png", "jpeg" or "webp".
+        quality (int): Quality of JPEG and WebP, WebP is lossless when quality is None.
+        compress_level (int): zlib level of PNG, 0 (fastest) to 9 (smallest).
+        provider (str): Provider of the model, for the token estimate, see image_tokens.
+        measure_savings (bool): Also encode every frame as a full size PNG to log the bytes saved.
+    """
+
+    def __init__(self, resolution=None, crop_to_board=False, image_format="png", quality=None, compress_level=6,
+                 provider=None, measure_savings=True):
+        image_format = image_format.lower()
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format: {image_format}, use one of {', '.join(IMAGE_FORMATS)}")
+        if isinstance(resolution, int):
+            resolution = (resolution, resolution)
+        self.resolution = tuple(resolution) if resolution else None
+        self.crop_to_board = crop_to_board
+        self.image_format = image_format
+        self.pil_format, self.media_type = IMAGE_FORMATS[image_format]
+        self.quality = DEFAULT_QUALITY if quality is None and image_format == "jpeg" else quality
+        self.compress_level = compress_level
+        self.provider = provider
+        self.measure_savings = measure_savings
+        self._board_boxes = {}
+
+    @classmethod
+    def from_params(cls, params, provider=None):
+        """
+        Create a pipeline from the image_pipeline agent param.
+
+        Args:
+            params (dict): resolution, crop_to_board, format, quality, compress_level and measure_savings, None
+                for the defaults.
+            provider (str): Provider of the model, for the token estimate.
+        """
+        params = params or {}
+        return cls(
+            resolution=params.get('resolution', None),
+            crop_to_board=params.get('crop_to_board', False),
+            image_format=params.get('format', 'png'),
+            quality=params.get('quality', None),
+            compress_level=params.get('compress_level', 6),
+            provider=provider,
+            measure_savings=params.get('measure_savings', True),
+        )
+
+    @property
+    def is_default(self):
+        """True if the pipeline sends the image unchanged as PNG."""
+        return self.resolution is None and not self.crop_to_board and self.pil_format == "PNG"
+
+    def board_box(self, observation, keep=None):
+        """
+        Box (x0, y0, x1, y1) around the opaque pixels of an observation, plus a margin.
+
+        The camera does not move within an episode, so the box is computed once per image size and reused.
+
+        Args:
+            observation (PIL.Image.Image): Observation with a transparent background.
+            keep (tuple): Box that must stay inside the crop, e.g. the region of the state label.
+
+        Returns:
+            tuple: The box, the whole image if the observation has no transparency.
+        """
+        if observation.size not in self._board_boxes:
+            box = None
+            if 'A' in observation.getbands():
+                box = observation.getchannel('A').point(lambda a: 255 if a > BOARD_ALPHA_THRESHOLD else 0).getbbox()
+            if box is None:
+                box = (0, 0) + observation.size
+            else:
+                box = (max(0, box[0] - BOARD_MARGIN), max(0, box[1] - BOARD_MARGIN),
+                       min(observation.width, box[2] + BOARD_MARGIN), min(observation.height, box[3] + BOARD_MARGIN))
+            self._board_boxes[observation.size] = box
+        box = self._board_boxes[observation.size]
+        if keep is not None:
+            box = (max(0, min(box[0], keep[0])), max(0, min(box[1], keep[1])),
+                   min(observation.width, max(box[2], keep[2])), min(observation.height, max(box[3], keep[3])))
+        return box
+
+    def target_size(self, width, height):
+        """Size an image of width x height is scaled down to."""
+        if self.resolution is None:
+            return width, height
+        scale = min(1.0, self.resolution[0] / width, self.resolution[1] / height)
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def process(self, image, observation=None, keep=None):
+        """
+        Crop and downscale an annotated image.
+
+        Args:
+            image (PIL.Image.Image): The annotated image.
+            observation (PIL.Image.Image): The observation the image was made from, its transparency locates the
+                board, None to not crop.
+            keep (tuple): Box that must stay inside the crop, see board_box.
+
+        Returns:
+            PIL.Image.Image: The processed image, image itself if nothing changes.
+        """
+        if self.crop_to_board and observation is not None:
+            box = self.board_box(observation, keep)
+            if box != (0, 0) + image.size:
+                image = image.crop(box)
+        size = self.target_size(*image.size)
+        if size != image.size:
+            # reducing_gap shrinks by an integer factor first, which is much faster than a full Lanczos resize
+            image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        return image
+
+    def _save_options(self):
+        if self.pil_format == "PNG":
+            return {"compress_level": self.compress_level}
+        if self.pil_format == "WEBP":
+            return {"lossless": True} if self.quality is None else {"quality": self.quality}
+        return {"quality": self.quality}
+
+    def encode_bytes(self, image):
+        """Encode an image in the format of the pipeline."""
+        if self.pil_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format=self.pil_format, **self._save_options())
+        return buffer.getvalue()
+
+    def encode(self, image):
+        """Encode an image as base64 string for API consumption."""
+        return base64.b64encode(self.encode_bytes(image)).decode('utf-8')
+
+    def stats(self, image, original, data):
+        """
+        Statistics of sending image instead of original as full size PNG.
+
+        Args:
+            image (PIL.Image.Image): The processed image.
+            original (PIL.Image.Image): The annotated image before processing.
+            data (bytes): The encoded image, see encode_bytes.
+        """
+        size = original_size = len(data)
+        if self.measure_savings and not self.is_default:
+            buffer = io.BytesIO()
+            original.save(buffer, format="PNG")
+            original_size = len(buffer.getvalue())
+        return ImageStats(images=1, bytes=size, original_bytes=original_size,
+                          tokens=image_tokens(*image.size, self.provider),
+                          original_tokens=image_tokens(*original.size, self.provider))
+
+    def describe(self):
+        resolution = "full size" if self.resolution is None else f"max {self.resolution[0]}x{self.resolution[1]}"
+        quality = "" if self.quality is None else f" quality {self.quality}"
+        return f"{self.image_format}{quality}, {resolution}{', cropped to board' if self.crop_to_board else ''}"
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    observation = Image.new('RGBA', (1200, 900), (0, 0, 0, 0))
+    observation.paste((120, 120, 120, 255), (250, 150, 950, 800))
+    for params in [None, {'resolution': [600, 450], 'crop_to_board': True, 'format': 'webp', 'quality': 80}]:
+        pipeline = ImagePipeline.from_params(params, provider="openai")
+        image = pipeline.process(observation.convert('RGB'), observation)
+        logging.info(f"{pipeline.describe()}: {image.size}, "
+                     f"{pipeline.stats(image, observation.convert('RGB'), pipeline.encode_bytes(image)).summary()}")
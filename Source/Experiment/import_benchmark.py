@@ -0,0 +1,88 @@
+"""
+- Import-time benchmark of the experiment code, guarding the startup budget of a run
+- Every module is imported in a fresh interpreter, the best of a few runs is compared with the budget
+- Importing the experiment code must not load any of HEAVY_MODULES, component_registry defers them to the agent
+  or renderer that needs them
+- Exits with status 1 if a module is over budget or loads a heavy dependency, so it can run in CI
+"""
+import os
+import sys
+import json
+import logging
+import subprocess
+
+EXPERIMENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HEAVY_MODULES = [
+    "transformers",
+    "torch",
+    "qwen_vl_utils",
+    "anthropic",
+    "google.generativeai",
+    "requests",
+    "httpx",
+    "matplotlib",
+    "seaborn",
+]
+
+# Modules imported at the start of a run, with their import time budget in seconds
+IMPORT_BUDGETS = {
+    "component_registry": 0.05,
+    "agent_systems": 0.5,
+    "game_systems": 0.5,
+    "init_experiment_components": 0.5,
+    "run_experiment": 1.5,
+}
+
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(module, repeats=3):
+    """
+    Import a module in fresh interpreters.
+
+    Returns:
+        dict: Best import time in seconds and the heavy modules it loaded.
+    """
+    best = None
+    for _ in range(repeats):
+        result = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=EXPERIMENT_DIR, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+        measurement = json.loads(result.stdout.strip().splitlines()[-1])
+        if best is None or measurement["seconds"] < best["seconds"]:
+            best = measurement
+    return best
+
+
+def check_import_budget(budgets=None, repeats=3):
+    """
+    Measure every module against its budget.
+
+    Returns:
+        bool: True if all modules are within budget and load no heavy dependency.
+    """
+    budgets = budgets or IMPORT_BUDGETS
+    within_budget = True
+    for module, budget in budgets.items():
+        measurement = measure_import(module, repeats)
+        ok = measurement["seconds"] <= budget and not measurement["heavy"]
+        within_budget = within_budget and ok
+        log = logging.info if ok else logging.error
+        log(f"{module}: {measurement['seconds'] * 1000:.0f} ms (budget {budget * 1000:.0f} ms)"
+            + (f", loaded {', '.join(measurement['heavy'])}" if measurement["heavy"] else ""))
+    return within_budget
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(0 if check_import_budget() else 1)
@@ -0,0 +1,262 @@
+"""
+- In-process inference server of a hosted open source model, the act calls of episodes that run on concurrent
+  threads are collected into dynamic batches and run through one generate call
+- A request made while no other request of the model is in flight, e.g. every step of run_experiment, which plays
+  one episode at a time, is generated right away on the calling thread, without the queue and without waiting
+- A batch is closed when it holds max_batch_size requests, when it holds every request in flight, or max_wait_ms
+  after its first request, requests with different generation parameters go into different batches
+- Requests that arrive while a batch is generated are queued and form the next batch
+- The conversations of a batch are collated with process_vision_info and padded on the left by the processor, the
+  generated tokens after the prompt are decoded and handed back to the episode that sent them
+- Throughput in steps per second, the mean batch size and the time requests wait for their batch are logged every
+  LOG_EVERY batches and kept in InferenceServer.stats
+- With prefix_cache, requests that run alone reuse the encoded system prompt, see prefix_cache
+- The wait for its batch, the generate time and the prompt and answer tokens of a request go into the step
+  metrics of the episode that sent it, see step_metrics
+"""
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from component_registry import LazyModule
+from prefix_cache import PrefixKVCache
+import step_metrics
+
+torch = LazyModule("torch")
+qwen_vl_utils = LazyModule("qwen_vl_utils")
+
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_MAX_WAIT_MS = 20
+LOG_EVERY = 50
+
+
+class InferenceRequest:
+    def __init__(self, messages, generation_kwargs):
+        self.messages = messages
+        self.generation_kwargs = generation_kwargs
+        self.key = tuple(sorted(generation_kwargs.items()))
+        self.future = Future()
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.finished = None
+        self.usage = (None, None)  # Prompt and answer tokens
+
+
+class InferenceServer:
+    """
+    Batches generate calls of one model on a worker thread.
+
+    Args:
+        host (ModelHost): Host of the model and its processor.
+        max_batch_size (int): Most requests in one generate call.
+        max_wait_ms (float): Milliseconds a batch waits for more requests after its first one.
+        prefix_cache (bool): Reuse the key/value cache of the system prompt for requests that run alone, see
+            prefix_cache.
+    """
+
+    def __init__(self, host, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS,
+                 prefix_cache=False):
+        self.host = host
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.prefix_cache = PrefixKVCache(host) if prefix_cache else None
+        self._queue = queue.Queue()
+        self._deferred = deque()  # Requests taken from the queue that did not fit the generation parameters of a batch
+        self._lock = threading.Lock()
+        self._model_lock = threading.Lock()  # One generate call of the model at a time
+        self._worker = None
+        self._prepared = False
+        self._in_flight = 0  # Requests submitted and not answered yet
+        self._inline = 0  # Requests of in_flight generated on their calling thread, they never join a batch
+        self.num_requests = 0
+        self.num_batches = 0
+        self.generate_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._first_request = None
+
+    def configure(self, max_batch_size=None, max_wait_ms=None, prefix_cache=None):
+        if max_batch_size is not None:
+            self.max_batch_size = max_batch_size
+        if max_wait_ms is not None:
+            self.max_wait_ms = max_wait_ms
+        if prefix_cache and self.prefix_cache is None:
+            self.prefix_cache = PrefixKVCache(self.host)
+
+    def _prepare(self):
+        with self._lock:
+            if not self._prepared:
+                # Batched generation continues after the prompt, so the prompts are padded on the left
+                self.host.processor.tokenizer.padding_side = "left"
+                self._prepared = True
+
+    def _ensure_worker(self):
+        self._prepare()
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, name=f"inference-{self.host.model_path}",
+                                                daemon=True)
+                self._worker.start()
+
+    def submit(self, messages, **generation_kwargs):
+        """
+        Queue a conversation for generation.
+
+        Args:
+            messages (list): Conversation in the chat format of the processor, images as in process_vision_info.
+            **generation_kwargs: Parameters of model.generate, e.g. max_new_tokens.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the generated text.
+        """
+        request, _ = self._track(InferenceRequest(messages, generation_kwargs))
+        self._ensure_worker()
+        self._queue.put(request)
+        return request.future
+
+    def _track(self, request):
+        """Count a request as in flight until it is answered, returns it and whether it is the only one."""
+        with self._lock:
+            alone = self._in_flight == 0
+            self._in_flight += 1
+        request.future.add_done_callback(self._done)
+        return request, alone
+
+    def _done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def generate(self, messages, **generation_kwargs):
+        """Generate the answer to a conversation, batched with the requests in flight, see submit."""
+        request, alone = self._track(InferenceRequest(messages, generation_kwargs))
+        if alone:
+            # Nothing to batch with, a single episode does not pay for the queue and the batch wait
+            self._prepare()
+            with self._lock:
+                self._inline += 1
+            try:
+                self._run_batch([request])
+            finally:
+                with self._lock:
+                    self._inline -= 1
+        else:
+            self._ensure_worker()
+            self._queue.put(request)
+        response = request.future.result()
+        # The batch may have run on the worker thread, its times count for the step of the caller
+        step_metrics.add_time("wait", request.started - request.submitted)
+        step_metrics.add_time("call", request.finished - request.started)
+        step_metrics.add("calls")
+        step_metrics.record_usage(*request.usage)
+        return response
+
+    def _next_request(self, timeout=None):
+        if self._deferred:
+            return self._deferred.popleft()
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self):
+        """Block for a request, then take more with the same generation parameters until the batch is closed."""
+        first = self._next_request()
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+        skipped = []
+        # Only wait for requests already in flight, a request that is not submitted yet may never come
+        while len(batch) < min(self.max_batch_size, self._in_flight - self._inline):
+            try:
+                request = self._next_request(timeout=max(deadline - time.perf_counter(), 0.0))
+            except queue.Empty:
+                break
+            (batch if request.key == first.key else skipped).append(request)
+        self._deferred.extendleft(reversed(skipped))
+        return batch
+
+    def _run(self, batch):
+        processor = self.host.processor
+        conversations = [request.messages for request in batch]
+        texts = [processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                 for messages in conversations]
+        image_inputs, video_inputs = qwen_vl_utils.process_vision_info(conversations)
+        inputs = processor(
+            text=texts,
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt"
+        ).to(self.host.device)
+        generated_ids = None
+        if self.prefix_cache is not None and len(batch) == 1:
+            # Left padding shifts the prompts of a batch, the cached prefix only lines up with a single prompt
+            generated_ids = self.prefix_cache.generate(conversations[0], inputs, batch[0].generation_kwargs)
+        if generated_ids is None:
+            with torch.inference_mode():
+                generated_ids = self.host.model.generate(**inputs, **batch[0].generation_kwargs)
+        # With left padding every prompt ends at the same position
+        generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+        prompt_tokens = inputs.attention_mask.sum(dim=1).tolist()
+        answer_tokens = (generated_ids_trimmed != processor.tokenizer.pad_token_id).sum(dim=1).tolist()
+        for request, usage in zip(batch, zip(prompt_tokens, answer_tokens)):
+            request.usage = usage
+        return processor.batch_decode(
+            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+
+    def _run_batch(self, batch):
+        """Generate a batch and answer the futures of its requests."""
+        with self._model_lock:
+            start = time.perf_counter()
+            try:
+                responses = self._run(batch)
+            except Exception as e:
+                logging.error(f"Batch of {len(batch)} requests to {self.host.model_path} failed: {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+                return
+            end = time.perf_counter()
+        for request, response in zip(batch, responses):
+            request.started, request.finished = start, end
+            request.future.set_result(response)
+        self._record(batch, start, end)
+
+    def _work(self):
+        while True:
+            self._run_batch(self._collect())
+
+    def _record(self, batch, start, end):
+        with self._lock:
+            if self._first_request is None:
+                self._first_request = min(request.submitted for request in batch)
+            self.num_requests += len(batch)
+            self.num_batches += 1
+            self.generate_seconds += end - start
+            self.wait_seconds += sum(start - request.submitted for request in batch)
+        if self.num_batches % LOG_EVERY == 0:
+            logging.info(f"{self.host.model_path}: {self.summary()}")
+
+    def steps_per_second(self):
+        """Completed requests per second since the first request."""
+        if self._first_request is None:
+            return 0.0
+        return self.num_requests / max(time.perf_counter() - self._first_request, 1e-9)
+
+    def stats(self):
+        num_batches = max(self.num_batches, 1)
+        num_requests = max(self.num_requests, 1)
+        return {
+            "model_path": self.host.model_path,
+            "requests": self.num_requests,
+            "batches": self.num_batches,
+            "mean_batch_size": self.num_requests / num_batches,
+            "steps_per_second": self.steps_per_second(),
+            "mean_generate_seconds": self.generate_seconds / num_batches,
+            "mean_wait_seconds": self.wait_seconds / num_requests,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache is not None else None,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"{stats['steps_per_second']:.2f} steps/s, {stats['requests']} requests in {stats['batches']} batches "
+                f"(mean size {stats['mean_batch_size']:.1f}), mean wait {stats['mean_wait_seconds'] * 1000:.0f} ms"
+                + (f", {self.prefix_cache.summary()}" if self.prefix_cache is not None else ""))
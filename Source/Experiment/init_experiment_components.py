@@ -1,4 +1,4 @@
-import agent_systems
+import component_registry
 import game_systems
 import experiment_utilities as util
 
@@ -14,17 +14,18 @@ def init_env(env_params, episode_path, episode_logger):
     return config
 
 def init_agent(agent_params, episode_path, config, episode_logger):
-    # Initialise agent
-    if agent_params.get('agent_type', {}) == 'AIAgent':
+    # Initialise agent, its class and dependencies are only imported once an agent of its type is used
+    agent_type = agent_params.get('agent_type', {})
+    if agent_type == 'AIAgent':
         move_set = agent_params.get('move_set', None)
-        agent = agent_systems.AIAgent(
+        agent = component_registry.agent_class(agent_type)(
             episode_logger,
             config.get(move_set, [])
         )
-    elif agent_params.get('agent_type', {}) == 'UserAgent':
-        agent = agent_systems.UserAgent()
-    elif agent_params.get('agent_type', {}) == 'GPT4Agent':
-        agent = agent_systems.GPT4Agent(
+    elif agent_type == 'UserAgent':
+        agent = component_registry.agent_class(agent_type)()
+    elif agent_type in ('GPT4Agent', 'ClaudeAgent', 'GeminiAgent'):
+        agent = component_registry.agent_class(agent_type)(
             episode_path=episode_path,
             episode_logger=episode_logger,
             api_key_file_path=agent_params.get('api_keys_file_path', None),
@@ -33,37 +34,44 @@ def init_agent(agent_params, episode_path, config, episode_logger):
             single_images=agent_params.get('single_images', True),
             COT=agent_params.get('COT', False),
             delay=agent_params.get('delay', 0),
-            max_history = agent_params.get('max_history', 0)
+            max_history = agent_params.get('max_history', 0),
+            request_timeout=agent_params.get('request_timeout', None),
+            rate_limits=agent_params.get('rate_limits', None),
+            image_pipeline=agent_params.get('image_pipeline', None),
+            response_cache=agent_params.get('response_cache', None),
+            history_token_budget=agent_params.get('history_token_budget', None)
         )
-    elif agent_params.get('agent_type', {}) == 'ClaudeAgent':
-        agent = agent_systems.ClaudeAgent(
-            episode_path=episode_path,
-            episode_logger=episode_logger,
-            api_key_file_path=agent_params.get('api_keys_file_path', None),
-            instruction_prompt_file_path=agent_params.get('instruction_prompt_file_path', None),
-            visual_state_embedding=agent_params.get('visual_state_embedding', None),
-            single_images=agent_params.get('single_images', True),
-            COT=agent_params.get('COT', False),
-            delay=agent_params.get('delay', 0),
-            max_history = agent_params.get('max_history', 0)
-        )
-    elif agent_params.get('agent_type', {}) == 'GeminiAgent':
-        agent = agent_systems.GeminiAgent(
-            episode_path=episode_path,
-            episode_logger=episode_logger,
-            api_key_file_path=agent_params.get('api_keys_file_path', None),
+    elif agent_type in ('Qwen2Agent', 'Qwen2_72BAgent'):
+        # The model is loaded once per process by its host, the agent is the session of this episode
+        agent_kwargs = dict(
             instruction_prompt_file_path=agent_params.get('instruction_prompt_file_path', None),
+            max_history=agent_params.get('max_history', 0),
             visual_state_embedding=agent_params.get('visual_state_embedding', None),
             single_images=agent_params.get('single_images', True),
             COT=agent_params.get('COT', False),
-            delay=agent_params.get('delay', 0),
-            max_history = agent_params.get('max_history', 0)
+            image_pipeline=agent_params.get('image_pipeline', None),
+            batching=agent_params.get('batching', None),
+            prefix_cache=agent_params.get('prefix_cache', False),
+            history_token_budget=agent_params.get('history_token_budget', None)
         )
+        if agent_type == 'Qwen2Agent':
+            agent_kwargs['model_path'] = agent_params.get('model_path', 'Qwen/Qwen2-VL-7B-Instruct')
+        agent = component_registry.agent_class(agent_type)(**agent_kwargs)
+        agent.reset(episode_path, episode_logger)
     else:
-        raise ValueError(f"Unsupported agent_type: {agent_params.get('agent_type', {})}")
+        raise ValueError(f"Unsupported agent_type: {agent_type}")
     return agent
 
 def init_game(game_params, episode_path, episode_logger):
+    # Observation persistence, shared by all games
+    observation_params = {
+        "observation_format": game_params.get('observation_format', 'png'),
+        "compress_level": game_params.get('compress_level', 6),
+        "save_intermediate_3D": game_params.get('save_intermediate_3D', True),
+        "deduplicate_frames": game_params.get('deduplicate_frames', False),
+        "archive_observations": game_params.get('archive_observations', False),
+    }
+
     # Initialise game
     if game_params.get('game_type', {}) == 'InteractivePuzzle':
         game = game_systems.InteractivePuzzle(
@@ -74,12 +82,14 @@ def init_game(game_params, episode_path, episode_logger):
             planning_steps=game_params.get("planning_steps", None),
             max_game_length=game_params.get('max_game_length', None),
             predict_board_state=game_params.get('predict_board_state', False),
+            **observation_params
         )
     elif game_params.get('game_type', {}) == 'SceneUnderstanding':
         game = game_systems.SceneUnderstanding(
             experiment_id=episode_path,
             instruction_prompt_file_path=game_params.get("instruction_prompt_file_path", None),
             chain_of_thoughts=game_params.get("chain_of_thoughts", None),
+            **observation_params
         )
     else:
         raise ValueError(f"Unsupported game_type: {game_params.get('game_type', {})}")
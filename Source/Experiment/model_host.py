@@ -0,0 +1,135 @@
+"""
+- Process-wide host of the open source models, the processor and the weights of a model are loaded once and kept on
+  the device for all episodes of an experiment
+- init_agent builds a Qwen2Agent per episode as before, the agent takes the model from its host and reset starts its
+  episode, so only the first episode of a model pays the load time
+- Loading is thread-safe, episodes are prepared on a background thread and the first one that needs a model loads it
+  while the others wait
+- The load time and the memory of every model are logged and kept in ModelHost.stats
+- The generate calls of all sessions of a model go through its InferenceServer, which batches the requests of
+  sessions on concurrent threads and runs a request that is alone right away
+"""
+import time
+import logging
+import threading
+
+from component_registry import LazyModule
+from inference_server import InferenceServer
+
+torch = LazyModule("torch")
+transformers = LazyModule("transformers")
+
+DEFAULT_CACHE_DIR = 'weights'
+
+
+class ModelHost:
+    """
+    Processor and model of one open source vision language model.
+
+    Args:
+        model_path (str): Hugging Face name or local path of the model.
+        cache_dir (str): Directory of the downloaded weights.
+        model_class (str): Name of the transformers model class.
+    """
+
+    def __init__(self, model_path, cache_dir=DEFAULT_CACHE_DIR, model_class="Qwen2VLForConditionalGeneration"):
+        self.model_path = model_path
+        self.cache_dir = cache_dir
+        self.model_class = model_class
+        self._lock = threading.Lock()
+        self._model = None
+        self._processor = None
+        self.load_seconds = None
+        self.memory_bytes = None
+        self.num_sessions = 0
+        self._server = None
+
+    def load(self):
+        """Load processor and model unless they are loaded already."""
+        with self._lock:
+            if self._model is not None:
+                return
+            logging.info(f"Loading {self.model_path}, this happens once per process")
+            start = time.perf_counter()
+            self._processor = transformers.AutoProcessor.from_pretrained(self.model_path, cache_dir=self.cache_dir)
+            model = getattr(transformers, self.model_class).from_pretrained(
+                self.model_path, torch_dtype="auto", device_map="auto", cache_dir=self.cache_dir
+            )
+            model.eval()
+            self.load_seconds = time.perf_counter() - start
+            self.memory_bytes = model.get_memory_footprint()
+            self._model = model
+            logging.info(f"Loaded {self.model_path} in {self.load_seconds:.1f}s, "
+                         f"{self.memory_bytes / 2 ** 30:.1f} GiB of weights on {model.device}"
+                         + self._device_memory_summary())
+
+    @staticmethod
+    def _device_memory_summary():
+        if not torch.cuda.is_available():
+            return ""
+        allocated = [torch.cuda.memory_allocated(index) / 2 ** 30 for index in range(torch.cuda.device_count())]
+        return ", GPU memory allocated " + ", ".join(f"cuda:{i} {gib:.1f} GiB" for i, gib in enumerate(allocated))
+
+    @property
+    def model(self):
+        self.load()
+        return self._model
+
+    @property
+    def processor(self):
+        self.load()
+        return self._processor
+
+    @property
+    def device(self):
+        """Device of the input embeddings, where the inputs of generate go."""
+        return self.model.device
+
+    def inference_server(self, max_batch_size=None, max_wait_ms=None, prefix_cache=None):
+        """
+        Return the inference server that batches the generate calls of all sessions, created on first use.
+
+        Args:
+            max_batch_size (int): Most requests in one generate call, None keeps the current value.
+            max_wait_ms (float): Milliseconds a batch waits for more requests, None keeps the current value.
+            prefix_cache (bool): Reuse the key/value cache of the system prompt, see prefix_cache.
+        """
+        with self._lock:
+            if self._server is None:
+                self._server = InferenceServer(self)
+        self._server.configure(max_batch_size, max_wait_ms, prefix_cache)
+        return self._server
+
+    def open_session(self):
+        """Count an agent session on the model, returns the host for the agent."""
+        self.load()
+        with self._lock:
+            self.num_sessions += 1
+        return self
+
+    def stats(self):
+        return {
+            "model_path": self.model_path,
+            "load_seconds": self.load_seconds,
+            "memory_bytes": self.memory_bytes,
+            "num_sessions": self.num_sessions,
+            "inference": self._server.stats() if self._server is not None else None,
+        }
+
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def get_model_host(model_path, cache_dir=DEFAULT_CACHE_DIR):
+    """Return the process-wide host of a model, the model is loaded on first use."""
+    with _hosts_lock:
+        if model_path not in _hosts:
+            _hosts[model_path] = ModelHost(model_path, cache_dir)
+        return _hosts[model_path]
+
+
+def model_host_stats():
+    """Load time, memory and number of sessions of every hosted model."""
+    with _hosts_lock:
+        return [host.stats() for host in _hosts.values()]
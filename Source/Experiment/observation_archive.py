@@ -0,0 +1,222 @@
+"""
+- Single-file archive of the observation frames of an episode, obs/observations.ivobs
+- Frames are stored as raw pixel arrays split into chunks of a fixed number of rows, each chunk compressed with zlib
+- A JSON index at the end of the file maps every frame name (obs_{i}_3D, obs_{i}_2D, ...) to its shape and chunks,
+  so any frame can be read without touching the others and the file is read through a memory map
+- Written by GameSystem with the archive_observations game param, read by the Visualize/* scripts,
+  convert_experiment packs the obs_*.png files of existing experiments
+
+File layout:
+    header  MAGIC (8 bytes), format version (uint32), reserved (uint32)
+    chunks  zlib compressed rows of the frames, in the order they were added
+    index   JSON, {"chunk_rows": int, "frames": {name: {"shape", "dtype", "chunks": [[offset, length], ...]}}}
+    footer  offset of the index (uint64), END_MAGIC (8 bytes)
+"""
+import os
+import re
+import mmap
+import zlib
+import json
+import struct
+import logging
+import threading
+
+import numpy as np
+
+ARCHIVE_FILE_NAME = "observations.ivobs"
+MAGIC = b"IVOBSARC"
+END_MAGIC = b"IVOBSEND"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+FOOTER = struct.Struct("<Q8s")
+
+
+def archive_path(episode_path):
+    return os.path.join(episode_path, 'obs', ARCHIVE_FILE_NAME)
+
+
+def frame_sort_key(name):
+    """Sort frame names by their step number, like the obs_*.png files are sorted."""
+    match = re.search(r'\d+', name)
+    return (int(match.group()) if match else -1, name)
+
+
+def _read_index(f, file_size):
+    if file_size < HEADER.size + FOOTER.size:
+        raise ValueError("File too small for an observation archive")
+    f.seek(0)
+    magic, version, _ = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("Not an observation archive")
+    if version > VERSION:
+        raise ValueError(f"Unsupported observation archive version {version}")
+    f.seek(file_size - FOOTER.size)
+    index_offset, end_magic = FOOTER.unpack(f.read(FOOTER.size))
+    if end_magic != END_MAGIC:
+        raise ValueError("Observation archive was not closed")
+    f.seek(index_offset)
+    index = json.loads(f.read(file_size - FOOTER.size - index_offset).decode("utf-8"))
+    return index, index_offset
+
+
+class ObservationArchiveWriter:
+    """
+    Appends frames to an episode archive, adding to an existing archive continues it.
+
+    Args:
+        path (str): Path of the archive file.
+        chunk_rows (int): Number of pixel rows per compressed chunk.
+        compress_level (int): zlib level, 1 favours speed, 9 size.
+    """
+
+    def __init__(self, path, chunk_rows=64, compress_level=1):
+        self.path = path
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if os.path.exists(path):
+            self._file = open(path, 'r+b')
+            self.index, index_offset = _read_index(self._file, os.path.getsize(path))
+            # New chunks overwrite the old index, which is written again on close
+            self._file.seek(index_offset)
+            self._file.truncate()
+        else:
+            self._file = open(path, 'w+b')
+            self._file.write(HEADER.pack(MAGIC, VERSION, 0))
+            self.index = {"chunk_rows": chunk_rows, "frames": {}}
+
+    def add(self, name, frame):
+        """
+        Add a frame, a frame with the same name replaces the earlier one in the index.
+
+        Args:
+            name (str): Frame name, e.g. obs_3_3D.
+            frame (numpy.ndarray or PIL.Image.Image): Pixels of the frame, rows first.
+        """
+        array = np.ascontiguousarray(np.asarray(frame))
+        chunk_rows = self.index["chunk_rows"]
+        compressed = [
+            zlib.compress(array[row:row + chunk_rows].tobytes(), self.compress_level)
+            for row in range(0, array.shape[0], chunk_rows)
+        ]
+        with self._lock:
+            chunks = []
+            for data in compressed:
+                chunks.append([self._file.tell(), len(data)])
+                self._file.write(data)
+            self.index["frames"][name] = {"shape": list(array.shape), "dtype": array.dtype.str, "chunks": chunks}
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            index_offset = self._file.tell()
+            self._file.write(json.dumps(self.index).encode("utf-8"))
+            self._file.write(FOOTER.pack(index_offset, END_MAGIC))
+            self._file.close()
+
+
+class ObservationArchive:
+    """
+    Memory-mapped reader of an episode archive.
+
+    Args:
+        path (str): Path of the archive file or of the episode directory.
+    """
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            path = archive_path(path)
+        self.path = path
+        self._file = open(path, 'rb')
+        self.index, _ = _read_index(self._file, os.path.getsize(path))
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def names(self):
+        """Return the frame names sorted by step."""
+        return sorted(self.index["frames"], key=frame_sort_key)
+
+    def __len__(self):
+        return len(self.index["frames"])
+
+    def __contains__(self, name):
+        return name in self.index["frames"]
+
+    def read(self, name, rows=None):
+        """
+        Read a frame as a NumPy array.
+
+        Args:
+            name (str): Frame name.
+            rows (slice): Only decompress the chunks covering these rows.
+        """
+        entry = self.index["frames"][name]
+        shape = entry["shape"]
+        chunk_rows = self.index["chunk_rows"]
+        start, stop = (0, shape[0]) if rows is None else rows.indices(shape[0])[:2]
+        first_chunk, last_chunk = start // chunk_rows, (max(stop, start + 1) - 1) // chunk_rows
+        data = b"".join(
+            zlib.decompress(self._map[offset:offset + length])
+            for offset, length in entry["chunks"][first_chunk:last_chunk + 1]
+        )
+        array = np.frombuffer(data, dtype=np.dtype(entry["dtype"])).reshape([-1] + shape[1:])
+        return array[start - first_chunk * chunk_rows:stop - first_chunk * chunk_rows]
+
+    def read_image(self, name):
+        """Read a frame as a PIL image."""
+        from PIL import Image
+        return Image.fromarray(self.read(name))
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def convert_episode(episode_path, remove_files=False):
+    """
+    Pack the obs_*.png files of an episode into its archive.
+
+    Returns:
+        int: Number of frames added.
+    """
+    from PIL import Image
+
+    obs_dir = os.path.join(episode_path, 'obs')
+    files = [f for f in os.listdir(obs_dir) if f.startswith("obs_") and f.endswith(".png")]
+    files.sort(key=frame_sort_key)
+    writer = ObservationArchiveWriter(archive_path(episode_path))
+    try:
+        for file_name in files:
+            with Image.open(os.path.join(obs_dir, file_name)) as image:
+                writer.add(os.path.splitext(file_name)[0], image)
+    finally:
+        writer.close()
+    if remove_files:
+        for file_name in files:
+            os.remove(os.path.join(obs_dir, file_name))
+    return len(files)
+
+
+def convert_experiment(experiment_id, remove_files=False):
+    """Pack the observation images of all episodes of an experiment into per-episode archives."""
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    episodes_dir = os.path.join(base_dir, 'Data', 'Experiments', experiment_id, 'Episodes')
+    for episode_name in sorted(os.listdir(episodes_dir)):
+        episode_path = os.path.join(episodes_dir, episode_name)
+        if not os.path.isdir(os.path.join(episode_path, 'obs')) or os.path.exists(archive_path(episode_path)):
+            continue
+        num_frames = convert_episode(episode_path, remove_files=remove_files)
+        logging.info(f"Archived {num_frames} frames of {episode_name}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    experiment_id = "Test_Auto_Done"
+    convert_experiment(experiment_id)
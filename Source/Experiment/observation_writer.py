@@ -0,0 +1,133 @@
+"""
+- Background persistence of the observations of an episode
+- GameSystem hands decoded images and board states to an ObservationWriter and returns the observation to the
+  agent right away, encoding and writing happen on worker threads
+- The queue in front of the workers is bounded, a game that produces frames faster than they can be written
+  waits instead of piling up frames in memory
+- Image format and compression are configurable, PNG stays the default because Visualize/* reads obs_*.png
+"""
+import os
+import json
+import queue
+import logging
+import threading
+
+from screenshot_decoding import Screenshot
+
+IMAGE_FORMATS = {
+    "png": ("PNG", ".png"),
+    "webp": ("WEBP", ".webp"),
+    "jpeg": ("JPEG", ".jpg"),
+}
+
+
+class ObservationWriter:
+    """
+    Writes images and JSON files of an episode on a pool of worker threads.
+
+    Args:
+        image_format (str): "png", "webp" or "jpeg".
+        compress_level (int): zlib level for PNG, 0 (fastest) to 9 (smallest).
+        quality (int): Quality for WebP and JPEG, WebP is written lossless when quality is None.
+        num_workers (int): Number of worker threads.
+        max_queue_size (int): Number of pending writes after which submitting blocks.
+        frame_store (FrameStore): Store identical frames only once and link them into the episode, None writes
+            every frame.
+        archive (ObservationArchiveWriter): Add the frames to the episode archive instead of writing image files.
+    """
+
+    def __init__(self, image_format="png", compress_level=6, quality=90, num_workers=2, max_queue_size=16,
+                 frame_store=None, archive=None):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported observation image format: {image_format}")
+        self.pil_format, self.extension = IMAGE_FORMATS[image_format]
+        self.compress_level = compress_level
+        self.quality = quality
+        self.frame_store = frame_store
+        self.archive = archive
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._workers = [
+            threading.Thread(target=self._work, name=f"observation-writer-{n}", daemon=True)
+            for n in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+        self._closed = False
+
+    def _save_options(self):
+        if self.pil_format == "PNG":
+            return {"compress_level": self.compress_level}
+        if self.pil_format == "WEBP":
+            return {"lossless": True} if self.quality is None else {"quality": self.quality}
+        return {"quality": self.quality}
+
+    def _encode_image(self, image, path):
+        if isinstance(image, Screenshot):
+            image = image.image
+        if self.pil_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(path, format=self.pil_format, **self._save_options())
+
+    def _write_image(self, image, path):
+        if self.archive is not None:
+            self.archive.add(os.path.splitext(os.path.basename(path))[0], image)
+        elif self.frame_store is not None:
+            self.frame_store.put(image, path, self._encode_image)
+        else:
+            self._encode_image(image, path)
+
+    @staticmethod
+    def _write_json(content, path):
+        with open(path, 'w') as f:
+            json.dump(content, f, indent=4)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                write, content, path = task
+                write(content, path)
+            except Exception as e:
+                logging.error(f"Error saving observation to {path}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def save_image(self, image, filename):
+        """
+        Queue an image for writing.
+
+        Args:
+            image (PIL.Image.Image or Screenshot): The image, it must not be modified afterwards.
+            filename (str): Path without extension, the extension of the image format is added.
+
+        Returns:
+            str: The path the image will be written to.
+        """
+        path = f"{filename}{self.extension}"
+        self._queue.put((self._write_image, image, path))
+        return path
+
+    def save_json(self, content, path):
+        """Queue a JSON-serialisable object for writing."""
+        self._queue.put((self._write_json, content, path))
+
+    def flush(self):
+        """Block until everything queued so far is on disk."""
+        self._queue.join()
+
+    def close(self):
+        """Write the remaining observations and stop the workers."""
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self.archive is not None:
+            self.archive.close()
+        if self.frame_store is not None:
+            logging.info(f"Frame store: {self.frame_store.num_stored} frames written, "
+                         f"{self.frame_store.num_reused} reused")
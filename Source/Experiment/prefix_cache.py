@@ -0,0 +1,135 @@
+"""
+- Reuse of the key/value cache of the system prompt of local models, the instruction prompt of Data/Instructions is
+  the same for every step of every episode and is tokenized and encoded once per model instead of on every step
+- A request whose tokens start with a cached prefix only encodes its own turn: the tail of the prompt with its
+  images is prefilled on a copy of the prefix cache and generate continues from there
+- generate of Qwen2-VL drops the images when it starts from a filled cache, so the tail is prefilled here with the
+  multimodal rope positions of the whole prompt, generate only sees the last prompt token
+- Prompts that do not start with the cached tokens fall back to a plain generate call
+- The time to first token of every request and the prefill time of the prefix it saved are kept in
+  PrefixKVCache.stats
+"""
+import copy
+import time
+import logging
+import threading
+
+from component_registry import LazyModule
+
+torch = LazyModule("torch")
+transformers = LazyModule("transformers")
+
+
+def _rope_owner(model):
+    # Newer transformers keep the multimodal rope state on the inner model
+    inner = getattr(model, "model", None)
+    return inner if inner is not None and hasattr(inner, "get_rope_index") else model
+
+
+class PrefixKVCache:
+    """
+    Key/value caches of the system prompts of one hosted model.
+
+    Args:
+        host (ModelHost): Host of the model and its processor.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self._lock = threading.Lock()
+        self._prefixes = {}  # system prompt -> (token ids, key/value cache, prefill seconds)
+        self.num_hits = 0
+        self.num_misses = 0
+        self.ttft_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def _prefix(self, system_prompt):
+        """Token ids and key/value cache of a system prompt, encoded on first use."""
+        with self._lock:
+            if system_prompt not in self._prefixes:
+                processor, model = self.host.processor, self.host.model
+                text = processor.apply_chat_template([{"role": "system", "content": system_prompt}], tokenize=False)
+                ids = processor.tokenizer(text, return_tensors="pt").input_ids.to(self.host.device)
+                start = time.perf_counter()
+                with torch.inference_mode():
+                    cache = model(input_ids=ids, past_key_values=transformers.DynamicCache(),
+                                  use_cache=True).past_key_values
+                seconds = time.perf_counter() - start
+                self._prefixes[system_prompt] = (ids, cache, seconds)
+                logging.info(f"Cached {ids.shape[1]} prompt tokens of {self.host.model_path}, "
+                             f"prefill {seconds * 1000:.0f} ms")
+            return self._prefixes[system_prompt]
+
+    def generate(self, messages, inputs, generation_kwargs):
+        """
+        Generate from a prompt whose system prompt is cached.
+
+        Args:
+            messages (list): Conversation of the prompt, the system prompt is its first message.
+            inputs: Processor output of the prompt for a single conversation.
+            generation_kwargs (dict): Parameters of model.generate.
+
+        Returns:
+            The generated ids including the prompt, None if the prompt does not start with the cached tokens.
+        """
+        if not messages or messages[0]["role"] != "system" or not isinstance(messages[0]["content"], str):
+            return None
+        prefix_ids, prefix_cache, prefix_seconds = self._prefix(messages[0]["content"])
+        input_ids, prefix_length = inputs.input_ids, prefix_ids.shape[1]
+        if input_ids.shape[1] <= prefix_length + 1 or not torch.equal(input_ids[:, :prefix_length], prefix_ids):
+            self.num_misses += 1
+            return None
+
+        model = self.host.model
+        rope = _rope_owner(model)
+        start = time.perf_counter()
+        with torch.inference_mode():
+            # Rope positions of the whole prompt, the image tokens of the tail have 3D positions
+            rope_kwargs = {"image_grid_thw": inputs.get("image_grid_thw"),
+                           "video_grid_thw": inputs.get("video_grid_thw"),
+                           "attention_mask": inputs.attention_mask}
+            tail_kwargs = {}
+            if inputs.get("mm_token_type_ids") is not None:
+                # Processors of transformers 5 mark the image tokens, older ones leave it to the model
+                rope_kwargs["mm_token_type_ids"] = inputs["mm_token_type_ids"]
+                tail_kwargs["mm_token_type_ids"] = inputs["mm_token_type_ids"][:, prefix_length:-1]
+            position_ids, rope_deltas = rope.get_rope_index(input_ids, **rope_kwargs)
+            cache = copy.deepcopy(prefix_cache)
+            end = input_ids.shape[1] - 1
+            model(
+                input_ids=input_ids[:, prefix_length:end],
+                attention_mask=inputs.attention_mask[:, :end],
+                position_ids=position_ids[..., prefix_length:end],
+                pixel_values=inputs.get("pixel_values"),
+                image_grid_thw=inputs.get("image_grid_thw"),
+                past_key_values=cache,
+                cache_position=torch.arange(prefix_length, end, device=input_ids.device),
+                use_cache=True,
+                **tail_kwargs
+            )
+            ttft = time.perf_counter() - start
+            # The decoding steps of generate continue the positions of this prompt
+            rope.rope_deltas = rope_deltas
+            generated_ids = model.generate(input_ids=input_ids, attention_mask=inputs.attention_mask,
+                                           past_key_values=cache, **generation_kwargs)
+        with self._lock:
+            self.num_hits += 1
+            self.ttft_seconds += ttft
+            self.saved_seconds += prefix_seconds
+        return generated_ids
+
+    def stats(self):
+        num_hits = max(self.num_hits, 1)
+        return {
+            "prefixes": len(self._prefixes),
+            "hits": self.num_hits,
+            "misses": self.num_misses,
+            "mean_ttft_seconds": self.ttft_seconds / num_hits,
+            "mean_saved_seconds": self.saved_seconds / num_hits,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"prefix cache {stats['hits']} hits, {stats['misses']} misses, time to first token "
+                f"{stats['mean_ttft_seconds'] * 1000:.0f} ms, {stats['mean_saved_seconds'] * 1000:.0f} ms "
+                f"prefill saved per step")
@@ -0,0 +1,336 @@
+"""
+- Rate limiting and retries of the LLM provider calls, shared by all agents and episodes of a process
+- Every provider has a token bucket for requests per minute and one for tokens per minute, a call reserves its
+  request and its estimated tokens before it is sent and waits until the buckets allow it
+- Reservations are served in arrival order, so concurrent episodes share a provider's quota fairly instead of
+  racing for it, and the buckets are corrected with the token usage the provider reports
+- Throttled and failed calls are retried with jittered exponential backoff, a Retry-After of the provider pauses
+  the whole provider, not only the call that received it
+- The waits, the call time, the retries and the reported usage of a call go into the step metrics of the agent
+  that made it, see step_metrics
+"""
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+import step_metrics
+
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+# Exception names of httpx, requests, anthropic, openai and google.api_core that mean the call can be repeated
+RETRYABLE_EXCEPTION_NAMES = {
+    "TimeoutException", "ConnectError", "ReadError", "RemoteProtocolError",  # httpx
+    "Timeout", "ConnectionError", "ChunkedEncodingError",  # requests
+    "APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError", "OverloadedError",  # anthropic
+    "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "TooManyRequests",  # google
+}
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+
+# Rough token counts for the tokens per minute estimate, corrected with the reported usage after the call
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1000
+
+
+class RetryableResponseError(Exception):
+    """A provider response with a status code that is worth retrying."""
+
+    def __init__(self, response):
+        super().__init__(f"Provider responded with status {response.status_code}")
+        self.response = response
+        self.status_code = response.status_code
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations in arrival order.
+
+    A reservation takes its tokens right away, the balance can go negative and the caller waits until it has been
+    refilled, so later callers queue up behind earlier ones.
+
+    Args:
+        per_minute (float): Refill rate and capacity, None for no limit.
+    """
+
+    def __init__(self, per_minute=None):
+        self._lock = threading.Lock()
+        self.per_minute = per_minute
+        self._tokens = per_minute or 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.per_minute:
+            self._tokens = min(self.per_minute, self._tokens + (now - self._updated) * self.per_minute / 60.0)
+        self._updated = now
+
+    def reserve(self, amount=1.0):
+        """
+        Take amount tokens.
+
+        Returns:
+            float: Seconds to wait before the reservation may be used.
+        """
+        with self._lock:
+            if not self.per_minute:
+                return 0.0
+            now = time.monotonic()
+            self._refill(now)
+            # A single call larger than the bucket waits for a full bucket instead of forever
+            self._tokens -= min(amount, self.per_minute)
+            return max(0.0, -self._tokens * 60.0 / self.per_minute)
+
+    def adjust(self, amount):
+        """Return (positive) or take (negative) tokens after the real cost of a call is known."""
+        with self._lock:
+            if self.per_minute:
+                self._refill(time.monotonic())
+                self._tokens = min(self.per_minute, self._tokens + amount)
+
+    def set_rate(self, per_minute):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.per_minute = per_minute
+            if per_minute:
+                self._tokens = min(self._tokens, per_minute)
+
+
+def estimate_tokens(content):
+    """
+    Estimate the tokens of a request from its messages, text by characters and images by a flat count.
+
+    Args:
+        content: Messages in OpenAI, Anthropic or Gemini form, strings, dicts, lists, PIL images or Gemini blobs.
+    """
+    if content is None:
+        return 0
+    if isinstance(content, str):
+        return len(content) // CHARS_PER_TOKEN + 1
+    if isinstance(content, (list, tuple)):
+        return sum(estimate_tokens(item) for item in content)
+    if isinstance(content, dict):
+        if content.get("type") in ("image", "image_url") or "mime_type" in content:
+            return IMAGE_TOKENS
+        return sum(estimate_tokens(value) for key, value in content.items() if key not in ("role", "type"))
+    if hasattr(content, "size") and hasattr(content, "mode"):
+        return IMAGE_TOKENS
+    return len(json.dumps(content, default=str)) // CHARS_PER_TOKEN
+
+
+def usage_split(result):
+    """Input and output tokens of a call, as reported by OpenAI, Anthropic or Gemini, None if the result does not say."""
+    try:
+        if getattr(result, "usage", None) is not None:
+            return result.usage.input_tokens, result.usage.output_tokens
+        if getattr(result, "usage_metadata", None) is not None:
+            return result.usage_metadata.prompt_token_count, result.usage_metadata.candidates_token_count
+        if hasattr(result, "status_code"):
+            usage = result.json().get("usage") or {}
+            return usage.get("prompt_tokens"), usage.get("completion_tokens")
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return None, None
+
+
+def usage_tokens(result):
+    """Tokens a call used, as reported by OpenAI, Anthropic or Gemini, None if the result does not say."""
+    input_tokens, output_tokens = usage_split(result)
+    if input_tokens is None or output_tokens is None:
+        return None
+    return input_tokens + output_tokens
+
+
+def _status_code(error):
+    for candidate in (error, getattr(error, "response", None)):
+        status = getattr(candidate, "status_code", None)
+        if isinstance(status, int):
+            return status
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(error):
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    return any(cls.__name__ in RETRYABLE_EXCEPTION_NAMES for cls in type(error).__mro__)
+
+
+def retry_after(error):
+    """Seconds the provider asked to wait, from retry-after-ms or Retry-After, None if it did not say."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ProviderScheduler:
+    """
+    Rate limits and retries of one provider.
+
+    Args:
+        provider (str): Name of the provider, for the log.
+        requests_per_minute (float): Request quota, None for no limit.
+        tokens_per_minute (float): Token quota, None for no limit.
+        max_retries (int): Retries of a failed call before its error is raised.
+        base_delay (float): Backoff of the first retry in seconds, doubled for every further retry.
+        max_delay (float): Upper bound of the backoff in seconds.
+    """
+
+    def __init__(self, provider, requests_per_minute=None, tokens_per_minute=None, max_retries=DEFAULT_MAX_RETRIES,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.provider = provider
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self.num_calls = 0
+        self.num_retries = 0
+
+    def configure(self, requests_per_minute=None, tokens_per_minute=None, max_retries=None):
+        """Change the limits, for agents that set their own."""
+        if requests_per_minute is not None:
+            self.requests.set_rate(requests_per_minute)
+        if tokens_per_minute is not None:
+            self.tokens.set_rate(tokens_per_minute)
+        if max_retries is not None:
+            self.max_retries = max_retries
+
+    def _reserve(self, estimated_tokens):
+        """Reserve a request and its tokens, one caller at a time, and return the seconds to wait."""
+        with self._lock:
+            pause = max(0.0, self._paused_until - time.monotonic())
+            return max(pause, self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+
+    def _backoff(self, attempt, error):
+        """Seconds to wait before retry number attempt, and pause the provider if it asked for it."""
+        requested = retry_after(error)
+        if requested is not None:
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + requested)
+            return requested
+        # Full jitter, so retries of concurrent episodes do not hit the provider at the same moment
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _settle(self, result, estimated_tokens):
+        input_tokens, output_tokens = usage_split(result)
+        step_metrics.record_usage(input_tokens, output_tokens)
+        if input_tokens is not None and output_tokens is not None:
+            self.tokens.adjust(estimated_tokens - input_tokens - output_tokens)
+
+    @staticmethod
+    def _check(result):
+        status = getattr(result, "status_code", None)
+        if isinstance(status, int) and status in RETRYABLE_STATUS_CODES:
+            raise RetryableResponseError(result)
+        return result
+
+    def _should_retry(self, attempt, error):
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        delay = self._backoff(attempt, error)
+        self.num_retries += 1
+        step_metrics.add("retries")
+        logging.warning(f"{self.provider} call failed ({error}), retry {attempt + 1}/{self.max_retries} "
+                        f"in {delay:.1f}s")
+        return delay
+
+    def call(self, fn, estimated_tokens=0):
+        """
+        Call fn once the limits allow it, retrying throttled and failed calls.
+
+        Args:
+            fn (callable): The provider call, without arguments.
+            estimated_tokens (int): Expected tokens of the call, see estimate_tokens.
+
+        Returns:
+            The result of fn. A response with a retryable status that is still failing after the last retry is
+            returned as it is, so the caller sees the provider's error message.
+        """
+        attempt = 0
+        while True:
+            # The reservation holds the place in the queue, waiting needs no lock
+            wait = self._reserve(estimated_tokens)
+            if wait > 0:
+                with step_metrics.phase("wait"):
+                    time.sleep(wait)
+            self.num_calls += 1
+            step_metrics.add("calls")
+            try:
+                with step_metrics.phase("call"):
+                    result = self._check(fn())
+            except Exception as e:
+                delay = self._should_retry(attempt, e)
+                if delay is None:
+                    if isinstance(e, RetryableResponseError):
+                        return e.response
+                    raise
+                with step_metrics.phase("wait"):
+                    time.sleep(delay)
+                attempt += 1
+                continue
+            self._settle(result, estimated_tokens)
+            return result
+
+    async def acall(self, fn, estimated_tokens=0):
+        """Async version of call, fn returns an awaitable."""
+        attempt = 0
+        while True:
+            wait = self._reserve(estimated_tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.num_calls += 1
+            try:
+                result = self._check(await fn())
+            except Exception as e:
+                delay = self._should_retry(attempt, e)
+                if delay is None:
+                    if isinstance(e, RetryableResponseError):
+                        return e.response
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._settle(result, estimated_tokens)
+            return result
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(provider, requests_per_minute=None, tokens_per_minute=None, max_retries=None):
+    """
+    Return the process-wide scheduler of a provider, created on first use.
+
+    Args:
+        provider (str): "openai", "anthropic", "gemini", ...
+        requests_per_minute (float): Request quota of the account, None keeps the current one.
+        tokens_per_minute (float): Token quota of the account, None keeps the current one.
+        max_retries (int): Retries of a failed call, None keeps the current one.
+    """
+    with _schedulers_lock:
+        if provider not in _schedulers:
+            _schedulers[provider] = ProviderScheduler(provider)
+        scheduler = _schedulers[provider]
+    scheduler.configure(requests_per_minute, tokens_per_minute, max_retries)
+    return scheduler
@@ -0,0 +1,204 @@
+"""
+- Shared HTTP transport of the LLM agents, one connection pool per process reused by all agents and episodes
+- Connections are kept alive between steps, so a step pays for its request and not for TCP and TLS setup
+- Uses httpx, with HTTP/2 when the h2 package is installed, and falls back to a pooled requests.Session
+  (HTTP/1.1 keep-alive) when httpx is not installed
+- post_json is used by Agent.act, apost_json by asyncio code, both share the same timeouts and limits
+- The Anthropic and Gemini clients are created once per API key instead of once per episode, the Anthropic client
+  sends its requests through the shared pool
+"""
+import json
+import asyncio
+import logging
+import threading
+import importlib.util
+
+from component_registry import LazyModule
+import step_metrics
+
+httpx = LazyModule("httpx")
+requests = LazyModule("requests")
+anthropic = LazyModule("anthropic")
+genai = LazyModule("google.generativeai")
+
+DEFAULT_TIMEOUT = 120.0  # Seconds to wait for a response, LLM calls with images can take a while
+DEFAULT_CONNECT_TIMEOUT = 10.0
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+KEEPALIVE_EXPIRY = 90.0  # Longer than a slow step, so the connection survives until the next one
+
+
+def _has_module(name):
+    return importlib.util.find_spec(name) is not None
+
+
+class ProviderTransport:
+    """
+    Pooled HTTP client with sync and async request methods.
+
+    Args:
+        timeout (float): Seconds to wait for a response.
+        connect_timeout (float): Seconds to wait for a connection.
+        max_connections (int): Maximum number of open connections.
+        http2 (bool): Use HTTP/2 if httpx and h2 are installed.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 max_connections=MAX_CONNECTIONS, http2=True):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections = max_connections
+        self.use_httpx = _has_module("httpx")
+        self.http2 = http2 and self.use_httpx and _has_module("h2")
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+        self._async_loop = None
+
+    def request_timeout(self, timeout=None):
+        """Timeout in the form the client expects, timeout overrides the response timeout of one request."""
+        timeout = self.timeout if timeout is None else timeout
+        if self.use_httpx:
+            return httpx.Timeout(timeout, connect=self.connect_timeout)
+        return (self.connect_timeout, timeout)
+
+    def _limits(self):
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                            keepalive_expiry=KEEPALIVE_EXPIRY)
+
+    @property
+    def client(self):
+        """The pooled sync client, an httpx.Client or a requests.Session."""
+        with self._lock:
+            if self._client is None:
+                if self.use_httpx:
+                    self._client = httpx.Client(http2=self.http2, timeout=self.request_timeout(),
+                                                limits=self._limits())
+                else:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                                            pool_maxsize=self.max_connections)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._client = session
+                logging.info(f"Opened provider connection pool ({'httpx' if self.use_httpx else 'requests'}, "
+                             f"{'HTTP/2' if self.http2 else 'HTTP/1.1'})")
+            return self._client
+
+    def async_client(self):
+        """The pooled httpx.AsyncClient of the running event loop."""
+        if not self.use_httpx:
+            raise RuntimeError("Async provider requests need httpx, install it with pip install httpx")
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            # An async client is bound to the loop it was first used in
+            if self._async_client is None or self._async_loop is not loop:
+                self._async_client = httpx.AsyncClient(http2=self.http2, timeout=self.request_timeout(),
+                                                       limits=self._limits())
+                self._async_loop = loop
+            return self._async_client
+
+    def post_json(self, url, payload, headers=None, timeout=None):
+        """
+        POST a JSON payload through the pool.
+
+        Returns:
+            The response, with status_code, headers and json() for both clients.
+        """
+        # Encoded here instead of by the client, so the step metrics can tell it apart from the network time
+        with step_metrics.phase("serialize"):
+            body = json.dumps(payload).encode("utf-8")
+        headers = {**(headers or {}), "Content-Type": "application/json"}
+        if self.use_httpx:
+            return self.client.post(url, content=body, headers=headers, timeout=self.request_timeout(timeout))
+        return self.client.post(url, data=body, headers=headers, timeout=self.request_timeout(timeout))
+
+    async def apost_json(self, url, payload, headers=None, timeout=None):
+        """POST a JSON payload through the async pool."""
+        return await self.async_client().post(url, json=payload, headers=headers,
+                                              timeout=self.request_timeout(timeout))
+
+    def close(self):
+        """Close the sync pool, the async pool is closed by aclose."""
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    async def aclose(self):
+        """Close both pools, from the event loop the async pool was used in."""
+        self.close()
+        with self._lock:
+            async_client, self._async_client, self._async_loop = self._async_client, None, None
+        if async_client is not None:
+            await async_client.aclose()
+
+
+_transports = {}
+_anthropic_clients = {}
+_gemini_api_key = None
+_transports_lock = threading.Lock()
+
+
+def get_transport(timeout=None, connect_timeout=None):
+    """
+    Return the process-wide transport for a timeout configuration, created on first use.
+
+    Args:
+        timeout (float): Seconds to wait for a response, None for DEFAULT_TIMEOUT.
+        connect_timeout (float): Seconds to wait for a connection, None for DEFAULT_CONNECT_TIMEOUT.
+    """
+    key = (DEFAULT_TIMEOUT if timeout is None else timeout,
+           DEFAULT_CONNECT_TIMEOUT if connect_timeout is None else connect_timeout)
+    with _transports_lock:
+        if key not in _transports:
+            _transports[key] = ProviderTransport(timeout=key[0], connect_timeout=key[1])
+        return _transports[key]
+
+
+def anthropic_client(api_key, transport=None):
+    """Return the Anthropic client of an API key, sending its requests through the shared pool."""
+    transport = transport or get_transport()
+    key = (api_key, id(transport))
+    with _transports_lock:
+        if key not in _anthropic_clients:
+            # Retries are left to provider_scheduler, which shares the backoff between episodes
+            _anthropic_clients[key] = anthropic.Anthropic(api_key=api_key, http_client=transport.client,
+                                                          timeout=transport.request_timeout(), max_retries=0)
+        return _anthropic_clients[key]
+
+
+def gemini_model(api_key, model_name, system_instruction):
+    """
+    Return a Gemini model, configuring the API key only when it changes.
+
+    genai.configure drops the clients of the previous configuration, calling it once per episode opened a new
+    channel for every episode.
+    """
+    global _gemini_api_key
+    with _transports_lock:
+        if _gemini_api_key != api_key:
+            genai.configure(api_key=api_key)
+            _gemini_api_key = api_key
+    return genai.GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+
+
+def _take_transports():
+    with _transports_lock:
+        transports = list(_transports.values())
+        _transports.clear()
+        _anthropic_clients.clear()
+    return transports
+
+
+def close_transports():
+    """Close all pooled sync connections."""
+    for transport in _take_transports():
+        transport.close()
+
+
+async def aclose_transports():
+    """Close all pooled connections, at the end of an experiment."""
+    for transport in _take_transports():
+        await transport.aclose()
@@ -1,11 +1,13 @@
-import matplotlib.pyplot as plt
-import seaborn as sns
 import io
-from PIL import Image, ImageDraw, ImageFont
-import matplotlib.colors as mcolors
+import os
+import math
+import importlib.util
+from functools import lru_cache
+
 import numpy as np
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.patches import Rectangle
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+from annotation import add_action_text
 
 
 color_codes = {
@@ -53,79 +55,316 @@ color_codes = {
   }
 }
 
-def add_action_text(image, action_text, color="black"):
+# Layout of the schematic, matching the matplotlib figure of render_schematic_matplotlib
+SCHEMATIC_SIZE = (1200, 900)  # 12 x 9 inch at 100 dpi
+BOARD_LEFT, BOARD_TOP, BOARD_EXTENT = 300, 120, 660  # Square axes inside subplots_adjust(0.25, 0.8, 0.9, 0.1)
+POINTS_TO_PIXELS = 100 / 72
+GRID_LINE_WIDTH = 3  # 2pt grid lines, snapped to whole pixels
+BORDER_WIDTH = 4 * POINTS_TO_PIXELS / 2  # 4pt border, only its inner half lies inside the axes
+MARKER_SIZE = 80 * POINTS_TO_PIXELS
+MARKER_EDGE_WIDTH = 1 * POINTS_TO_PIXELS
+FONT_SIZE = 32 * POINTS_TO_PIXELS
+TICK_LABEL_PAD = 7 * POINTS_TO_PIXELS  # Tick length and tick pad, both 3.5pt
+SUPERSAMPLING = 4
+# Sub-pixel offsets (x, y) between PIL text anchors and pixel centres and matplotlib's, measured against
+# render_schematic_matplotlib
+MARKER_OFFSET = (1.0, 1.0)
+CELL_LABEL_OFFSET = (0.5, -4.0)
+ROW_LABEL_OFFSET = (-0.5, 0.5)
+COLUMN_LABEL_OFFSET = (0.0, -8.0)
+COLUMN_LABELS = ['A', 'B', 'C', 'D']
+
+# Marker outlines in units of the marker size, centred on the cell, y pointing down
+MARKER_POLYGONS = {
+    'cube': [(-0.5, -0.5), (0.5, -0.5), (0.5, 0.5), (-0.5, 0.5)],
+    'pyramid': [(0.0, -0.5), (0.5, 0.5), (-0.5, 0.5)],
+    'cylinder': [(0.5 * math.cos(math.radians(a)), 0.5 * math.sin(math.radians(a))) for a in range(0, 360, 60)],
+}
+
+
+@lru_cache(maxsize=None)
+def _font(size):
+    """DejaVu Sans like matplotlib, from the system or the copy shipped with matplotlib, without importing it."""
+    candidates = ["DejaVuSans.ttf"]
+    spec = importlib.util.find_spec("matplotlib")
+    if spec is not None and spec.origin:
+        candidates.append(os.path.join(os.path.dirname(spec.origin), 'mpl-data', 'fonts', 'ttf', 'DejaVuSans.ttf'))
+    for candidate in candidates:
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+
+def _cell_size(grid_size):
+    return BOARD_EXTENT / grid_size
+
+
+def _line_mask(length, positions, width, start=0.0, end=None):
+    """Coverage of lines of the given width centred on positions, along an axis of length pixels."""
+    mask = np.zeros(length, dtype=np.float32)
+    edges = np.arange(length + 1, dtype=np.float32)
+    for position in positions:
+        lo, hi = position - width / 2, position + width / 2
+        lo, hi = max(lo, start), min(hi, end if end is not None else length)
+        mask = np.maximum(mask, np.clip(np.minimum(edges[1:], hi) - np.maximum(edges[:-1], lo), 0, 1))
+    return mask
+
+
+@lru_cache(maxsize=None)
+def _board_template(grid_size):
+    """Transparent canvas with grid, border and axis labels, shared by all schematics of a grid size."""
+    width, height = SCHEMATIC_SIZE
+    cell = _cell_size(grid_size)
+    right, bottom = BOARD_LEFT + BOARD_EXTENT, BOARD_TOP + BOARD_EXTENT
+
+    # Grid lines are snapped to whole pixels, the border is clipped to the board
+    inner_x = [round(BOARD_LEFT + k * cell) + 0.5 for k in range(1, grid_size)]
+    inner_y = [round(BOARD_TOP + k * cell) + 0.5 for k in range(1, grid_size)]
+    column_mask = np.maximum(
+        _line_mask(width, inner_x, GRID_LINE_WIDTH),
+        _line_mask(width, [BOARD_LEFT, right], 2 * BORDER_WIDTH, BOARD_LEFT, right))
+    row_mask = np.maximum(
+        _line_mask(height, inner_y, GRID_LINE_WIDTH),
+        _line_mask(height, [BOARD_TOP, bottom], 2 * BORDER_WIDTH, BOARD_TOP, bottom))
+    alpha = np.zeros((height, width), dtype=np.float32)
+    alpha[BOARD_TOP:bottom, :] = np.maximum(alpha[BOARD_TOP:bottom, :], column_mask[None, :])
+    alpha[:, BOARD_LEFT:right] = np.maximum(alpha[:, BOARD_LEFT:right], row_mask[:, None])
+    alpha[:, :BOARD_LEFT] = 0
+    alpha[:, right:] = 0
+    alpha[:BOARD_TOP, :] = 0
+    alpha[bottom:, :] = 0
+
+    template = np.zeros((height, width, 4), dtype=np.uint8)
+    template[..., 3] = np.round(alpha * 255).astype(np.uint8)
+    image = Image.fromarray(template, 'RGBA')
+
+    # White axis labels, columns below the board and rows left of it
+    draw = ImageDraw.Draw(image)
+    font = _font(FONT_SIZE)
+    for i in range(grid_size):
+        label = COLUMN_LABELS[i] if i < len(COLUMN_LABELS) else ''
+        draw.text((BOARD_LEFT + (i + 0.5) * cell + COLUMN_LABEL_OFFSET[0], bottom + TICK_LABEL_PAD + COLUMN_LABEL_OFFSET[1]),
+                  label, font=font, fill='white', anchor='ma')
+        draw.text((BOARD_LEFT - TICK_LABEL_PAD + ROW_LABEL_OFFSET[0], BOARD_TOP + (i + 0.5) * cell + ROW_LABEL_OFFSET[1]),
+                  str(grid_size - i), font=font, fill='white', anchor='rm')
+    return np.asarray(image)
+
+
+def _cell_bounds(grid_size, row, column):
+    """Pixel box of the inside of a cell, free of grid lines."""
+    cell = _cell_size(grid_size)
+    margin = GRID_LINE_WIDTH
+    x0, y0 = round(BOARD_LEFT + column * cell) + margin, round(BOARD_TOP + row * cell) + margin
+    x1, y1 = round(BOARD_LEFT + (column + 1) * cell) - margin, round(BOARD_TOP + (row + 1) * cell) - margin
+    return x0, y0, x1, y1
+
+
+def _offset_polygon(points, distance):
+    """Move every edge of a convex, clockwise polygon outwards by distance, with mitred corners."""
+    n = len(points)
+    lines = []
+    for k in range(n):
+        (ax, ay), (bx, by) = points[k], points[(k + 1) % n]
+        length = math.hypot(bx - ax, by - ay)
+        nx, ny = (by - ay) / length, -(bx - ax) / length
+        lines.append(((ax + nx * distance, ay + ny * distance), (bx - ax, by - ay)))
+    offset = []
+    for k in range(n):
+        (px, py), (dx, dy) = lines[k - 1]
+        (qx, qy), (ex, ey) = lines[k]
+        t = ((qx - px) * ey - (qy - py) * ex) / (dx * ey - dy * ex)
+        offset.append((px + t * dx, py + t * dy))
+    return offset
+
+
+@lru_cache(maxsize=None)
+def _marker_sprite(body, color, width, height):
+    """Anti-aliased geom marker with a black edge, centred in a cell sized RGBA sprite."""
+    scale = SUPERSAMPLING
+    sprite = Image.new('RGBA', (width * scale, height * scale), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(sprite)
+    cx, cy = (width / 2 + MARKER_OFFSET[0]) * scale, (height / 2 + MARKER_OFFSET[1]) * scale
+    size, edge = MARKER_SIZE * scale, MARKER_EDGE_WIDTH * scale / 2
+    fill = ImageColor.getrgb(color)
+
+    if body in MARKER_POLYGONS:
+        outline = [(cx + x * size, cy + y * size) for x, y in MARKER_POLYGONS[body]]
+        draw.polygon(_offset_polygon(outline, edge), fill='black')
+        draw.polygon(_offset_polygon(outline, -edge), fill=fill)
+    else:
+        # Spheres and unknown bodies are drawn as circles
+        radius = size / 2
+        draw.ellipse([cx - radius - edge, cy - radius - edge, cx + radius + edge, cy + radius + edge], fill='black')
+        draw.ellipse([cx - radius + edge, cy - radius + edge, cx + radius - edge, cy + radius - edge], fill=fill)
+    return np.asarray(sprite.resize((width, height), Image.Resampling.BOX))
+
+
+@lru_cache(maxsize=None)
+def _label_sprite(label, width, height):
+    """White chess coordinate centred in a cell sized RGBA sprite."""
+    sprite = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    ImageDraw.Draw(sprite).text((width / 2 + CELL_LABEL_OFFSET[0], height / 2 + CELL_LABEL_OFFSET[1]), label, font=_font(FONT_SIZE), fill='white', anchor='mm')
+    return np.asarray(sprite)
+
+
+def _cell_label(grid_size, row, column):
+    return f"{chr(65 + column)}{grid_size - row}"
+
+
+def _occupancy(board_state, grid_size):
+    """Map the cells of a board state, (row, column) from the top left, to the (body, color) placed on them."""
+    occupied = {}
+    for obj in board_state:
+        x, y = obj['current_coordinate']
+        # Rows count from the top, the y coordinate from the bottom
+        occupied[(grid_size - 1 - int(y), int(x))] = (obj['body'], obj['color'])
+    return occupied
+
+
+def _draw_cell(canvas, grid_size, row, column, occupant):
+    """Write the marker of occupant, or the coordinate label of an empty cell, into the inside of a cell."""
+    x0, y0, x1, y1 = _cell_bounds(grid_size, row, column)
+    if occupant is not None:
+        sprite = _marker_sprite(occupant[0], occupant[1], x1 - x0, y1 - y0)
+    else:
+        sprite = _label_sprite(_cell_label(grid_size, row, column), x1 - x0, y1 - y0)
+    canvas[y0:y1, x0:x1] = sprite
+
+
+def render_schematic_array(current_board_state, grid_size=4):
     """
-    Adds the action text in large red letters with a light white, semi-transparent box behind it
-    on the top-right corner of the image, 50 pixels away from the top and right border, with rounded corners.
+    Render a schematic representation of the board state into an RGBA array.
+
+    The board template and every marker and label sprite are drawn once and cached, a schematic is a copy of the
+    template with one sprite per cell. Cell insides are transparent in the template, so placing a sprite is
+    the same as compositing it over the template.
 
     Args:
-        image (PIL.Image): The image on which to add the action text.
-        action_text (str): The action text to add to the image.
+        current_board_state (list of dict): Board state containing body, color, and current coordinates.
+        grid_size (int): Number of cells per board side.
 
     Returns:
-        PIL.Image: The image with the action text added.
+        numpy.ndarray: (900, 1200, 4) uint8 RGBA array.
     """
-    # Ensure the image is in RGBA mode (supports transparency)
-    if image.mode != 'RGBA':
-        image = image.convert('RGBA')
+    canvas = _board_template(grid_size).copy()
+    occupied = _occupancy(current_board_state, grid_size)
+    for row in range(grid_size):
+        for column in range(grid_size):
+            _draw_cell(canvas, grid_size, row, column, occupied.get((row, column)))
+    return canvas
 
-    # Create a drawing context
-    draw = ImageDraw.Draw(image)
 
-    # Try to load a larger font size
-    try:
-        font = ImageFont.truetype("arial.ttf", 50)  # Increased font size to 80
-    except IOError:
-        font = ImageFont.load_default()
-
-    # Get text bounding box
-    text_bbox = draw.textbbox((0, 0), action_text, font=font)
-    text_width, text_height = text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]
-
-    # Add extra padding to make the box slightly larger than the text
-    box_extra_padding = 20  # Adjust this value to control how much larger the box should be
-    border_thickness = 3  # Thickness of the black border
-
-    # Set padding, border offset, and corner radius for rounded edges
-    padding = 10
-    border_offset = 50
-    corner_radius = 20  # Radius for the rounded corners
-
-    # Calculate box and text position (50 pixels from the top and right with additional padding)
-    text_x = image.width - text_width - padding - border_offset
-    text_y = border_offset
-    box_x0 = text_x - padding - box_extra_padding
-    box_y0 = text_y - padding - box_extra_padding
-    box_x1 = image.width - padding - border_offset + box_extra_padding
-    box_y1 = text_y + text_height + padding + box_extra_padding
-
-    # Create a semi-transparent overlay
-    overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))  # Transparent overlay
-    overlay_draw = ImageDraw.Draw(overlay)
-
-    # Draw a black border (slightly larger rectangle)
-    overlay_draw.rounded_rectangle(
-        [box_x0 - border_thickness, box_y0 - border_thickness,
-         box_x1 + border_thickness, box_y1 + border_thickness],
-        radius=corner_radius + border_thickness,
-        fill=(0, 0, 0, 255)  # Black border
-    )
+def iter_schematic_frames(board_states, grid_size=4, copy=False):
+    """
+    Render the schematics of a sequence of board states, redrawing only the cells that changed since the
+    previous state.
 
-    # Draw a semi-transparent white box with rounded corners (50% transparency)
-    overlay_draw.rounded_rectangle(
-        [box_x0, box_y0, box_x1, box_y1],
-        radius=corner_radius,
-        fill=(255, 255, 255, 128)
-    )
+    A move changes two cells, so after the first frame every frame costs two sprite copies.
 
-    # Composite the overlay onto the image
-    image = Image.alpha_composite(image, overlay)
+    Args:
+        board_states (iterable of list of dict): Board states, e.g. from board_states_from_moves.
+        grid_size (int): Number of cells per board side.
+        copy (bool): Yield a new array per frame. By default the same array is updated in place and yielded again,
+            it must be consumed (saved, encoded, copied) before the next frame is requested.
 
-    # Draw the text in red on the original image
-    draw = ImageDraw.Draw(image)
-    draw.text((text_x, text_y), action_text, font=font, fill=color)
+    Yields:
+        numpy.ndarray: (900, 1200, 4) uint8 RGBA array per board state.
+    """
+    canvas = None
+    previous = None
+    for board_state in board_states:
+        occupied = _occupancy(board_state, grid_size)
+        if canvas is None:
+            canvas = render_schematic_array(board_state, grid_size)
+        else:
+            for cell in previous.keys() | occupied.keys():
+                if previous.get(cell) != occupied.get(cell):
+                    _draw_cell(canvas, grid_size, cell[0], cell[1], occupied.get(cell))
+        previous = occupied
+        yield canvas.copy() if copy else canvas
+
+
+def render_schematic_batch(board_states, grid_size=4, out=None):
+    """
+    Render the schematics of a sequence of board states into one stacked array.
 
-    return image
+    Each frame starts as a copy of the previous one and only the changed cells are redrawn. A stack holds
+    4.3 MB per frame, stream long trajectories with iter_schematic_frames instead.
+
+    Args:
+        board_states (sequence of list of dict): Board states, e.g. from board_states_from_moves.
+        grid_size (int): Number of cells per board side.
+        out (numpy.ndarray): Optional (N, 900, 1200, 4) uint8 array to render into.
+
+    Returns:
+        numpy.ndarray: (N, 900, 1200, 4) uint8 RGBA array.
+    """
+    board_states = list(board_states)
+    width, height = SCHEMATIC_SIZE
+    shape = (len(board_states), height, width, 4)
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
+    elif out.shape != shape or out.dtype != np.uint8:
+        raise ValueError(f"out must be a uint8 array of shape {shape}, got {out.dtype} {out.shape}")
+
+    previous = None
+    for i, board_state in enumerate(board_states):
+        occupied = _occupancy(board_state, grid_size)
+        if previous is None:
+            out[i] = render_schematic_array(board_state, grid_size)
+        else:
+            out[i] = out[i - 1]
+            for cell in previous.keys() | occupied.keys():
+                if previous.get(cell) != occupied.get(cell):
+                    _draw_cell(out[i], grid_size, cell[0], cell[1], occupied.get(cell))
+        previous = occupied
+    return out
+
+
+MOVE_DIRECTIONS = {'left': (-1, 0), 'right': (1, 0), 'down': (0, -1), 'up': (0, 1)}
+
+
+def board_states_from_moves(landmarks, move_sequence, grid_size=4):
+    """
+    Replay a move sequence of a config, e.g. its shortest_move_sequence, on the start coordinates of its landmarks.
+
+    Moves follow the commands of translate_moves_to_commands, "move <color> <body> <direction>" or
+    "move tile <nr> <direction>". A move off the board or onto an occupied cell leaves the board unchanged,
+    like the simulator does, so invalid move sequences can be replayed as well.
+
+    Args:
+        landmarks (list of dict): Landmarks of the config with geom_nr, body, color and start_coordinate.
+        move_sequence (list of str): Commands, starting with "start".
+        grid_size (int): Number of cells per board side.
+
+    Returns:
+        list of list of dict: One board state per command, in the format render_schematic expects.
+    """
+    board_state = [
+        {'body': landmark['body'], 'color': landmark['color'],
+         'current_coordinate': list(landmark['start_coordinate'])}
+        for landmark in landmarks
+    ]
+    board_states = []
+    for command in move_sequence:
+        words = command.split()
+        if len(words) == 4 and words[0] == 'move' and words[3] in MOVE_DIRECTIONS:
+            if words[1] == 'tile':
+                matches = [i for i, landmark in enumerate(landmarks) if str(landmark.get('geom_nr')) == words[2]]
+            else:
+                matches = [i for i, obj in enumerate(board_state) if (obj['color'], obj['body']) == (words[1], words[2])]
+            if matches:
+                obj = board_state[matches[0]]
+                dx, dy = MOVE_DIRECTIONS[words[3]]
+                target = [obj['current_coordinate'][0] + dx, obj['current_coordinate'][1] + dy]
+                occupied = {tuple(other['current_coordinate']) for other in board_state}
+                if 0 <= target[0] < grid_size and 0 <= target[1] < grid_size and tuple(target) not in occupied:
+                    board_state = [dict(other) for other in board_state]
+                    board_state[matches[0]]['current_coordinate'] = target
+        board_states.append(board_state)
+    return board_states
 
 
 def render_schematic(current_board_state, grid_size=4):
@@ -139,6 +378,26 @@ def render_schematic(current_board_state, grid_size=4):
     Returns:
         PIL.Image.Image: Rendered schematic as a PIL image object.
     """
+    return Image.fromarray(render_schematic_array(current_board_state, grid_size), 'RGBA')
+
+
+def render_schematic_matplotlib(current_board_state, grid_size=4):
+    """
+    Reference implementation of render_schematic with matplotlib and seaborn, kept to check the fast renderer.
+    Render a schematic representation of the board state and return it as a PIL image object.
+    Adds text labels with chess coordinates in unoccupied cells.
+
+    Args:
+        current_board_state (list of dict): Board state containing body, color, and current coordinates.
+
+    Returns:
+        PIL.Image.Image: Rendered schematic as a PIL image object.
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import matplotlib.colors as mcolors
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    from matplotlib.patches import Rectangle
 
     fig, ax = plt.subplots(figsize=(12, 9), dpi=100)
 
@@ -0,0 +1,178 @@
+"""
+- Cache of LLM responses in a local SQLite database, so re-running an experiment does not call the paid APIs again
+- A response is keyed by a hash of the provider, the model, the full request with its images and the sampling
+  parameters, any change to the prompt, the images or the parameters is a new request
+- Modes, set with the response_cache agent param:
+  - off: every request is sent to the provider
+  - record: cached responses are reused, new ones are sent and stored
+  - replay: only cached responses are served, a request that is not cached raises ResponseCacheMiss, which ends
+    the experiment instead of calling the provider
+- The database is shared by all episodes and experiments, Data/ResponseCache/responses.sqlite by default
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import step_metrics
+
+CACHE_MODES = ("off", "record", "replay")
+DEFAULT_CACHE_FILE = os.path.join("Data", "ResponseCache", "responses.sqlite")
+
+
+class ResponseCacheMiss(Exception):
+    """A request that is not in the cache, raised in replay mode."""
+
+
+def _json_default(value):
+    # Images and binary blobs enter the key by their content hash
+    if isinstance(value, (bytes, bytearray)):
+        return {"bytes": hashlib.sha256(value).hexdigest()}
+    if hasattr(value, "tobytes") and hasattr(value, "mode"):
+        digest = hashlib.sha256(value.tobytes()).hexdigest()
+        return {"image": f"{value.mode}:{value.size[0]}x{value.size[1]}:{digest}"}
+    return repr(value)
+
+
+def request_key(provider, model, request, sampling=None):
+    """
+    Hash of a request.
+
+    Args:
+        provider (str): "openai", "anthropic", "gemini", ...
+        model (str): Name of the model.
+        request: The full request, e.g. the messages and the system prompt, JSON-like with bytes or PIL images.
+        sampling (dict): Sampling parameters, e.g. temperature and max_tokens.
+
+    Returns:
+        str: SHA-256 hex digest of the canonical JSON of the request.
+    """
+    canonical = json.dumps({"provider": provider, "model": model, "request": request, "sampling": sampling or {}},
+                           sort_keys=True, separators=(",", ":"), default=_json_default)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def sampling_params(payload, request_fields=("model", "messages")):
+    """Parameters of a request payload besides the model and the request itself, e.g. max_tokens and temperature."""
+    return {key: value for key, value in payload.items() if key not in request_fields}
+
+
+class ResponseCache:
+    """
+    SQLite store of response texts by request key.
+
+    Args:
+        path (str): Database file, created with its directory if missing.
+        mode (str): "off", "record" or "replay".
+    """
+
+    def __init__(self, path, mode="record"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown response cache mode: {mode}, use one of {', '.join(CACHE_MODES)}")
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._connection = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # One connection per process, used by the threads of all episodes under the lock
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")  # Readers of other processes do not block writers
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, provider TEXT, model TEXT, response TEXT, created REAL)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def get(self, key):
+        """Cached response of a key, None if it is not cached."""
+        with self._lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, provider, model, response):
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, provider, model, response, created) VALUES (?, ?, ?, ?, ?)",
+                (key, provider, model, response, time.time())
+            )
+            self.connection.commit()
+
+    def complete(self, provider, model, request, sampling, call):
+        """
+        Return the response of a request, from the cache or from call.
+
+        Args:
+            provider (str): Provider of the model.
+            model (str): Name of the model.
+            request: The full request, see request_key.
+            sampling (dict): Sampling parameters of the request.
+            call (callable): Sends the request and returns the response text.
+
+        Returns:
+            str: The response text.
+
+        Raises:
+            ResponseCacheMiss: In replay mode, if the request is not cached.
+        """
+        if self.mode == "off":
+            return call()
+        with step_metrics.phase("serialize"):
+            key = request_key(provider, model, request, sampling)
+        response = self.get(key)
+        if response is not None:
+            self.hits += 1
+            step_metrics.add("cache_hits")
+            return response
+        self.misses += 1
+        if self.mode == "replay":
+            raise ResponseCacheMiss(f"No cached {provider} response of {model} for request {key[:16]} in {self.path}")
+        response = call()
+        self.put(key, provider, model, response)
+        return response
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(params=None):
+    """
+    Return the response cache of the response_cache agent param, shared by all agents using the same database.
+
+    Args:
+        params (dict): mode ("off", "record" or "replay") and path of the database relative to the repository,
+            None for "off".
+    """
+    params = params or {}
+    mode = params.get('mode', 'off')
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    path = os.path.join(base_dir, params.get('path', DEFAULT_CACHE_FILE))
+    with _caches_lock:
+        if (path, mode) not in _caches:
+            _caches[(path, mode)] = ResponseCache(path, mode)
+            if mode != "off":
+                logging.info(f"Response cache in {mode} mode: {path}")
+        return _caches[(path, mode)]
+
+
+def close_response_caches():
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.close()
+        _caches.clear()
@@ -0,0 +1,59 @@
+"""
+- Decoding of the screenshots the simulator sends with Screenshot and ActionAck packets
+- The payload is raw RGBA pixels, bottom row first, so it is decoded once from base64 and then only viewed:
+  Screenshot.array is a read-only NumPy view with a negative row stride, no pixels are copied
+- A PIL image is only made when one is needed, in a single pass that also flips the rows
+"""
+import base64
+
+import numpy as np
+from PIL import Image
+
+SCREENSHOT_SIZE = (1200, 900)
+
+
+class Screenshot:
+    """
+    Lazily converted screenshot of the simulator.
+
+    Args:
+        buffer (bytes): Raw RGBA pixels, bottom row first.
+        size (tuple): Width and height of the screenshot.
+    """
+
+    mode = "RGBA"
+
+    def __init__(self, buffer, size=SCREENSHOT_SIZE):
+        width, height = size
+        if len(buffer) != width * height * 4:
+            raise ValueError(f"Screenshot payload has {len(buffer)} bytes, expected {width * height * 4} for {size}")
+        self.buffer = buffer
+        self.size = size
+        self._image = None
+
+    @property
+    def array(self):
+        """Read-only (height, width, 4) view of the pixels, top row first."""
+        width, height = self.size
+        return np.frombuffer(self.buffer, dtype=np.uint8).reshape(height, width, 4)[::-1]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.array
+        return array if dtype is None else array.astype(dtype)
+
+    @property
+    def image(self):
+        """PIL image of the screenshot, made on first access and cached."""
+        if self._image is None:
+            # Orientation -1 makes the raw decoder read the rows bottom-up, flipping while copying
+            self._image = Image.frombuffer(self.mode, self.size, self.buffer, 'raw', self.mode, 0, -1)
+        return self._image
+
+    def tobytes(self):
+        """Pixels top row first, like Image.tobytes."""
+        return self.array.tobytes()
+
+
+def decode_screenshot(encoded_data, size=SCREENSHOT_SIZE):
+    """Decode the base64 payload of a simulator packet into a Screenshot."""
+    return Screenshot(base64.b64decode(encoded_data), size)
@@ -0,0 +1,143 @@
+"""
+- Annotation of the state images an agent sends to its model, marking them as active, goal or past state by
+  background color, label, both or none (the visual_state_embedding of the agent)
+- EpisodeImageCache keeps the annotated and encoded images of an episode by step and role, so the goal image and
+  the past frames in the history are annotated and encoded once instead of on every step
+- Frames are cropped, scaled and encoded by the ImagePipeline of the agent, the cache counts the bytes and tokens
+  of the images sent in a step
+"""
+import base64
+from collections import OrderedDict
+
+from PIL import Image
+
+from annotation import add_action_text, action_label_region
+from image_pipeline import ImagePipeline, ImageStats
+import step_metrics
+
+# Color code of the background of every role, per visual_state_embedding
+STATE_BACKGROUNDS = {
+    'color': {'active': 'active_1', 'goal': 'goal_1', 'past': 'past'},
+    'label': {'active': 'active_1', 'goal': 'active_1', 'past': 'active_1'},
+    'both': {'active': 'active_1', 'goal': 'goal_1', 'past': 'past'},
+    'none': {'active': 'active_1', 'goal': 'active_1', 'past': 'active_1'},
+}
+# Whether the role is written into the image, per visual_state_embedding
+STATE_LABELS = {'color': False, 'label': True, 'both': True, 'none': False}
+
+
+def annotate_state_image(observation, role, visual_state_embedding, color_codes):
+    """
+    Mark an observation as active, goal or past state.
+
+    Args:
+        observation (PIL.Image.Image): Observation with a transparent background.
+        role (str): 'active', 'goal' or 'past'.
+        visual_state_embedding (str): 'color', 'label', 'both' or 'none'.
+        color_codes (dict): Color codes of Visualize/color_codes.json.
+
+    Returns:
+        PIL.Image.Image: The observation on the background of its role, labelled with it if the embedding says so.
+    """
+    if visual_state_embedding not in STATE_BACKGROUNDS:
+        raise ValueError("No viable image state embedding set for agent.")
+    background_color = tuple(color_codes[STATE_BACKGROUNDS[visual_state_embedding][role]]['rgb'])
+    image = Image.new('RGB', observation.size, background_color)
+    image.paste(observation, mask=observation.getchannel('A') if 'A' in observation.getbands() else None)
+    if STATE_LABELS[visual_state_embedding]:
+        image = add_action_text(image, role)
+    return image
+
+
+class EpisodeImageCache:
+    """
+    Annotated and encoded state images of one episode, keyed by step and role.
+
+    Frames of the last max_history + 1 steps are kept, enough for the history window and the active frame, older
+    steps are dropped. Frames without a step, like the goal, are kept for the whole episode.
+
+    Args:
+        visual_state_embedding (str): 'color', 'label', 'both' or 'none'.
+        color_codes (dict): Color codes of Visualize/color_codes.json.
+        pipeline (ImagePipeline): Crops, scales and encodes the images, None for full size PNG.
+        max_history (int): History length of the agent.
+    """
+
+    def __init__(self, visual_state_embedding, color_codes, pipeline=None, max_history=0):
+        self.visual_state_embedding = visual_state_embedding
+        self.color_codes = color_codes
+        self.pipeline = pipeline or ImagePipeline()
+        self.max_steps = max_history + 1
+        self._entries = {}
+        self._steps = OrderedDict()  # step -> keys of its entries, oldest step first
+        self.hits = 0
+        self.misses = 0
+        self.step_stats = ImageStats()
+
+    def _get(self, key, build):
+        if key in self._entries:
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        with step_metrics.phase("images"):
+            value = build()
+        self._entries[key] = value
+        step = key[1]
+        if isinstance(step, int):
+            self._steps.setdefault(step, []).append(key)
+            while len(self._steps) > self.max_steps:
+                _, keys = self._steps.popitem(last=False)
+                for old_key in keys:
+                    self._entries.pop(old_key, None)
+        return value
+
+    @staticmethod
+    def _key(observation, step, role):
+        # Steps identify frames, without one the frame object does
+        return (step, role) if step is not None else (("frame", id(observation)), role)
+
+    def _annotated(self, observation, step, role):
+        return self._get(("annotated",) + self._key(observation, step, role),
+                         lambda: annotate_state_image(observation, role, self.visual_state_embedding, self.color_codes))
+
+    def _build_image(self, observation, step, role):
+        # The crop keeps the state label, which sits in the corner of the full image
+        keep = action_label_region(role, observation.width) if STATE_LABELS[self.visual_state_embedding] else None
+        return self.pipeline.process(self._annotated(observation, step, role), observation, keep)
+
+    def image(self, observation, step, role):
+        """Annotated image of an observation in a role as processed by the pipeline, see annotate_state_image."""
+        return self._get(("image",) + self._key(observation, step, role),
+                         lambda: self._build_image(observation, step, role))
+
+    def _build_encoded(self, observation, step, role):
+        image = self.image(observation, step, role)
+        data = self.pipeline.encode_bytes(image)
+        return data, self.pipeline.stats(image, self._annotated(observation, step, role), data)
+
+    def _sent(self, observation, step, role):
+        data, stats = self._get(("encoded",) + self._key(observation, step, role),
+                                lambda: self._build_encoded(observation, step, role))
+        self.step_stats += stats
+        step_metrics.add("images", stats.images)
+        step_metrics.add("image_bytes", stats.bytes)
+        return data
+
+    def encoded(self, observation, step, role):
+        """Base64 string of the image of an observation in a role, counted as sent in this step."""
+        data = self._sent(observation, step, role)
+        return self._get(("base64",) + self._key(observation, step, role),
+                         lambda: base64.b64encode(data).decode('utf-8'))
+
+    def blob(self, observation, step, role):
+        """The image of an observation in a role as Gemini blob, counted as sent in this step."""
+        return {"mime_type": self.pipeline.media_type, "data": self._sent(observation, step, role)}
+
+    def take_step_stats(self):
+        """Return the statistics of the images sent since the last call and start counting anew."""
+        stats, self.step_stats = self.step_stats, ImageStats()
+        return stats
+
+    def clear(self):
+        self._entries.clear()
+        self._steps.clear()
@@ -0,0 +1,257 @@
+"""
+- Telemetry of the act calls of the agents, where the time of a step goes and how many tokens and image bytes it
+  sends
+- Phases of a step:
+  - images: annotating, cropping, scaling and encoding the state images in the episode image cache
+  - serialize: encoding the request, the JSON body of HTTP requests and the key of the response cache
+  - wait: rate limit waits and retry backoff of the provider scheduler, batch waits of the inference server
+  - call: the provider call or the generate call of a local model, network and model latency
+  - parse: parse_action and the cleanup of the action
+- Phases do not overlap, the time of a phase that runs inside another one, e.g. serializing the body of an HTTP
+  call, counts for the inner phase only
+- Input and output tokens are the usage the provider reports, local models count the tokens of the prompt and the
+  answer, calls served by the response cache count as cache_hits without tokens
+- Every step is a line of step_metrics.jsonl in the episode directory, the totals of all episodes of an experiment
+  are written to step_metrics.json in the experiment directory, mean tokens per step give the cost of a new run
+- The step of an act call is tracked per thread, so the scheduler, the image cache and the response cache record
+  into the step of the agent that called them without passing it around
+"""
+import os
+import json
+import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+STEP_METRICS_FILE_NAME = "step_metrics.jsonl"
+EXPERIMENT_METRICS_FILE_NAME = "step_metrics.json"
+PHASES = ("images", "serialize", "wait", "call", "parse")
+COUNTS = ("input_tokens", "output_tokens", "images", "image_bytes", "calls", "retries", "cache_hits")
+
+_local = threading.local()
+
+
+class StepMetrics:
+    """Timings per phase and counts of one act call."""
+
+    def __init__(self, step):
+        self.step = step
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(COUNTS, 0)
+        self.seconds = 0.0
+        self.error = None
+        self._stack = []  # Open phases, the innermost one is timed
+        self._since = None
+
+    def _charge(self):
+        now = time.perf_counter()
+        if self._stack:
+            self.phases[self._stack[-1]] += now - self._since
+        self._since = now
+
+    @contextmanager
+    def phase(self, name):
+        # Nested phases of the same name, e.g. encoding an image that is processed first, are timed once
+        if name in self._stack:
+            yield
+            return
+        self._charge()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._charge()
+            self._stack.pop()
+
+    def add(self, key, amount=1):
+        self.counts[key] += amount
+
+    def to_dict(self):
+        return {
+            "step": self.step,
+            "seconds": self.seconds,
+            "phases": self.phases,
+            **self.counts,
+            "error": self.error,
+        }
+
+
+def current():
+    """The step of the act call running on this thread, None outside of act."""
+    return getattr(_local, "metrics", None)
+
+
+@contextmanager
+def phase(name):
+    """Time a phase of the current step, does nothing outside of act."""
+    metrics = current()
+    if metrics is None:
+        yield
+        return
+    with metrics.phase(name):
+        yield
+
+
+def timed(name):
+    """Decorator that times a function as a phase of the current step."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add(key, amount=1):
+    """Add to a count of the current step, does nothing outside of act."""
+    metrics = current()
+    if metrics is not None and amount:
+        metrics.add(key, amount)
+
+
+def add_time(name, seconds):
+    """Add seconds that passed on another thread, e.g. in a batch of the inference server, to a phase."""
+    metrics = current()
+    if metrics is not None:
+        metrics.phases[name] += seconds
+
+
+def record_usage(input_tokens, output_tokens):
+    add("input_tokens", input_tokens or 0)
+    add("output_tokens", output_tokens or 0)
+
+
+class _Totals:
+    """Sums of the steps of one agent type."""
+
+    def __init__(self):
+        self.episodes = 0
+        self.steps = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(COUNTS, 0)
+
+    def add(self, metrics):
+        self.steps += 1
+        self.errors += metrics.error is not None
+        self.seconds += metrics.seconds
+        for name, seconds in metrics.phases.items():
+            self.phases[name] += seconds
+        for key, amount in metrics.counts.items():
+            self.counts[key] += amount
+
+    def merge(self, other):
+        self.episodes += other.episodes
+        self.steps += other.steps
+        self.errors += other.errors
+        self.seconds += other.seconds
+        for name in PHASES:
+            self.phases[name] += other.phases[name]
+        for key in COUNTS:
+            self.counts[key] += other.counts[key]
+
+    def to_dict(self):
+        steps = max(self.steps, 1)
+        return {
+            "episodes": self.episodes,
+            "steps": self.steps,
+            "errors": self.errors,
+            "seconds": self.seconds,
+            "mean_step_seconds": self.seconds / steps,
+            "mean_phase_seconds": {name: seconds / steps for name, seconds in self.phases.items()},
+            **self.counts,
+            "mean_per_step": {key: amount / steps for key, amount in self.counts.items()},
+        }
+
+    def summary(self):
+        steps = max(self.steps, 1)
+        phases = ", ".join(f"{name} {seconds / steps * 1000:.0f} ms" for name, seconds in self.phases.items())
+        return (f"{self.steps} steps, {self.seconds / steps:.2f}s per step ({phases}), "
+                f"{self.counts['input_tokens'] / steps:.0f} input and {self.counts['output_tokens'] / steps:.0f} "
+                f"output tokens per step, {self.counts['image_bytes'] / steps / 1024:.1f} KiB of images per step, "
+                f"{self.counts['retries']} retries, {self.counts['cache_hits']} cache hits")
+
+
+class StepTelemetry:
+    """
+    Telemetry of the steps of one agent in one episode.
+
+    Args:
+        episode_path (str): Directory of the episode, step_metrics.jsonl is written there.
+        agent_name (str): Name of the agent type, the experiment totals are kept per agent type.
+        episode_logger (logging.Logger): Logger of the episode, gets the totals of the episode.
+    """
+
+    def __init__(self, episode_path, agent_name, episode_logger=None):
+        self.path = os.path.join(episode_path, STEP_METRICS_FILE_NAME)
+        self.agent_name = agent_name
+        self.episode_logger = episode_logger
+        self.totals = _Totals()
+        self.totals.episodes = 1
+        self._file = None
+
+    @contextmanager
+    def step(self, step):
+        """Track an act call, its metrics are written when it returns."""
+        metrics = StepMetrics(step)
+        previous, _local.metrics = current(), metrics
+        start = time.perf_counter()
+        try:
+            yield metrics
+        except Exception as e:
+            metrics.error = repr(e)
+            raise
+        finally:
+            metrics.seconds = time.perf_counter() - start
+            _local.metrics = previous
+            self._write(metrics)
+
+    def _write(self, metrics):
+        self.totals.add(metrics)
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps(metrics.to_dict()) + "\n")
+            self._file.flush()
+        except OSError as e:
+            logging.error(f"Error writing step metrics to {self.path}: {e}")
+
+    def close(self):
+        """Close the metrics file, log the totals of the episode and add them to the experiment."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.totals.steps == 0:
+            return
+        if self.episode_logger is not None:
+            self.episode_logger.info(f"\nStep metrics: {self.totals.summary()}")
+        with _experiment_lock:
+            _experiment_totals.setdefault(self.agent_name, _Totals()).merge(self.totals)
+        self.totals = _Totals()
+
+
+_experiment_totals = {}
+_experiment_lock = threading.Lock()
+
+
+def write_experiment_metrics(experiment_dir, logger=None):
+    """
+    Write the totals of the episodes run since the last call to step_metrics.json and start counting anew.
+
+    Returns:
+        dict: Totals per agent type.
+    """
+    global _experiment_totals
+    with _experiment_lock:
+        totals, _experiment_totals = _experiment_totals, {}
+    if not totals:
+        return {}
+    result = {agent_name: agent_totals.to_dict() for agent_name, agent_totals in totals.items()}
+    with open(os.path.join(experiment_dir, EXPERIMENT_METRICS_FILE_NAME), 'w') as f:
+        json.dump(result, f, indent=4)
+    for agent_name, agent_totals in totals.items():
+        (logger or logging).info(f"Step metrics of {agent_name}: {agent_totals.summary()}")
+    return result
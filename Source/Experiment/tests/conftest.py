@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The experiment modules import each other by their flat names
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,60 @@
+import asyncio
+
+import episode_pipeline
+import experiment_sharding
+from episode_pipeline import prefetch_episodes
+from experiment_sharding import FileWorkQueue
+
+
+def make_episodes(count):
+    return [{"episode_name": f"episode_{i:03d}"} for i in range(count)]
+
+
+def test_prefetch_releases_claims_of_episodes_prepared_ahead(tmp_path, monkeypatch):
+    monkeypatch.setattr(experiment_sharding, "experiments_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(episode_pipeline, "prepare_episode", lambda episode: dict(episode, prepared=True))
+    queue = FileWorkQueue("experiment", "worker")
+
+    async def run_first_episode():
+        prefetched = prefetch_episodes(queue.claim_episodes(make_episodes(5)), prefetch=2, release=queue.release)
+        async for episode in prefetched:
+            # The running episode fails, the caller releases it and closes the prefetch
+            queue.release(episode["episode_name"])
+            await prefetched.aclose()
+            return episode
+
+    episode = asyncio.run(run_first_episode())
+
+    assert episode["episode_name"] == "episode_000" and episode["prepared"]
+    assert queue.progress() == (0, 0)
+    assert all(queue.owner(f"episode_{i:03d}") is None for i in range(5))
+
+
+def test_prefetch_releases_the_episode_that_failed_to_prepare(tmp_path, monkeypatch):
+    monkeypatch.setattr(experiment_sharding, "experiments_dir", lambda: str(tmp_path))
+
+    def prepare_episode(episode):
+        if episode["episode_name"] == "episode_001":
+            raise OSError("config missing")
+        return episode
+
+    monkeypatch.setattr(episode_pipeline, "prepare_episode", prepare_episode)
+    queue = FileWorkQueue("experiment", "worker")
+    yielded = []
+
+    async def run_all():
+        async for episode in prefetch_episodes(queue.claim_episodes(make_episodes(4)), prefetch=1,
+                                               release=queue.release):
+            yielded.append(episode["episode_name"])
+            queue.mark_done(episode["episode_name"])
+
+    try:
+        asyncio.run(run_all())
+    except OSError:
+        pass
+    else:
+        raise AssertionError("the preparation error was not raised")
+
+    assert yielded == ["episode_000"]
+    # Only the finished episode keeps its claim
+    assert queue.progress() == (1, 1)
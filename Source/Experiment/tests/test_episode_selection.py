@@ -0,0 +1,33 @@
+import experiment_sharding
+from experiment_sharding import FileWorkQueue, select_episodes
+
+
+def make_episodes(count):
+    return [{"episode_name": f"episode_{i:03d}"} for i in range(count)]
+
+
+def test_select_episodes_skips_completed():
+    episodes = make_episodes(4)
+    pending, finished = select_episodes(episodes, {"episode_001"})
+    assert [episode["episode_name"] for episode in pending] == ["episode_000", "episode_002", "episode_003"]
+    assert finished == 1
+
+
+def test_select_episodes_claims_from_work_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(experiment_sharding, "experiments_dir", lambda: str(tmp_path))
+    episodes = make_episodes(5)
+    other = FileWorkQueue("experiment", "other")
+    assert other.claim("episode_001")
+    assert other.claim("episode_002")
+    other.mark_done("episode_002")
+    queue = FileWorkQueue("experiment", "worker")
+
+    pending, finished = select_episodes(episodes, {"episode_000"}, queue)
+
+    # The progress bar starts from the episodes every worker finished, before anything is claimed
+    assert finished == 1
+    assert queue.progress() == (2, 1)
+    claimed = [episode["episode_name"] for episode in pending]
+    assert claimed == ["episode_003", "episode_004"]
+    assert queue.owner("episode_003") == "worker"
+    assert queue.owner("episode_001") == "other"
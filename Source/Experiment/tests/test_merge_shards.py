@@ -0,0 +1,55 @@
+import os
+import shutil
+
+import pytest
+from PIL import Image
+
+import checkpoints
+import experiment_sharding
+import frame_store
+from checkpoints import save_checkpoint
+from experiment_sharding import merge_shards, shard_experiment_id
+from frame_store import FrameStore, experiment_frame_store_dir
+
+
+@pytest.fixture
+def experiments(tmp_path, monkeypatch):
+    monkeypatch.setattr(experiment_sharding, "experiments_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(checkpoints, "_experiment_dir", lambda experiment_id: str(tmp_path / experiment_id))
+    return tmp_path
+
+
+def write_shard(experiments, shard_id, episode_name):
+    episode_path = os.path.join(experiments, shard_id, 'Episodes', episode_name)
+    os.makedirs(os.path.join(episode_path, 'obs'))
+    store = FrameStore(experiment_frame_store_dir(episode_path))
+    # Two steps showing the same frame share one stored object
+    for i in range(2):
+        store.put(Image.new("RGB", (4, 4), (10, 20, 30)), os.path.join(episode_path, 'obs', f"obs_{i}_3D.png"),
+                  lambda image, path: image.save(path))
+    save_checkpoint(shard_id, {"completed": [episode_name]})
+
+
+@pytest.mark.parametrize("move", [True, False])
+@pytest.mark.parametrize("symlinks", [False, True])
+def test_merged_frames_are_linked_to_the_merged_frame_store(experiments, monkeypatch, move, symlinks):
+    shard_id = shard_experiment_id("experiment", "a")
+    with monkeypatch.context() as patch:
+        if symlinks:
+            # Hard links fail on some shared storage, the frames are symbolic links then
+            patch.setattr(frame_store.os, "link", lambda *args: (_ for _ in ()).throw(OSError("no hard links")))
+        write_shard(experiments, shard_id, "episode_000")
+    shard_frame = experiments / shard_id / "Episodes" / "episode_000" / "obs" / "obs_0_3D.png"
+    assert os.path.islink(shard_frame) == symlinks
+
+    assert merge_shards("experiment", move=move) == {shard_id: 1}
+    shutil.rmtree(experiments / shard_id)
+
+    store_dir = experiments / "experiment" / "FrameStore"
+    objects = [os.path.join(root, f) for root, _, files in os.walk(store_dir) for f in files]
+    assert len(objects) == 1
+    for i in range(2):
+        frame = experiments / "experiment" / "Episodes" / "episode_000" / "obs" / f"obs_{i}_3D.png"
+        assert os.path.samefile(frame, objects[0])
+        with Image.open(frame) as image:
+            assert image.getpixel((0, 0)) == (10, 20, 30)
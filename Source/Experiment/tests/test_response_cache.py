@@ -0,0 +1,15 @@
+from response_cache import ResponseCache, sampling_params
+
+
+def test_sampling_params_are_part_of_the_key(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), mode="record")
+    payload = {"model": "gpt-4o", "messages": [{"role": "user", "content": "start"}], "max_tokens": 500,
+               "temperature": 0.5}
+    assert sampling_params(payload) == {"max_tokens": 500, "temperature": 0.5}
+
+    first = cache.complete("openai", "gpt-4o", payload["messages"], sampling_params(payload), lambda: "cold")
+    payload["temperature"] = 0.0
+    second = cache.complete("openai", "gpt-4o", payload["messages"], sampling_params(payload), lambda: "colder")
+    assert (first, second) == ("cold", "colder")
+    assert cache.misses == 2
+    cache.close()
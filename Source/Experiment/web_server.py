@@ -1,113 +1,415 @@
-import http.server
-import socketserver
-import os
-import webbrowser
 import asyncio
 import websockets
 import uuid
 import json
 import base64
-import time  # Example to show main script continuing work
+import time
 import threading
 import logging
+from collections import deque
+from http import HTTPStatus
 
-connected_clients = {}
+SERVER_ID = "0000-0000-0000-0000"
+DEFAULT_CAPABILITY = "webgl"
 
-async def handle_client(websocket, path):
 
-    client_id = str(uuid.uuid4())
-    connected_clients[client_id] = websocket
-    logging.info(f"Client connected and registered with network id: {client_id}")
+def parse_pairing_message(message_data):
+    """Read the JSON object carried in the first message of an Announce or Claim packet."""
+    messages = message_data.get("messages") or []
+    try:
+        content = json.loads(messages[0]) if messages else {}
+    except (TypeError, json.JSONDecodeError):
+        content = {}
+    return content if isinstance(content, dict) else {}
 
-    #sending handshake to client
 
-    byte_array = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x01'
+class ClientConnection:
+    """
+    A connected websocket client with its own bounded send queue.
 
-    # Encode the byte array to Base64
-    encoded_byte_array = base64.b64encode(byte_array).decode('utf-8')
-    handshake_data = {
-        "command" : "Handshake",
-        "from" : "0000-0000-0000-0000",
-        "to" : client_id,
-        "messages" : ["action perception server V1.0.","your network id is registered"],
-        "payload" : encoded_byte_array
-    }
-    #websocket.send(f"Handshake")
-    await websocket.send(json.dumps(handshake_data))
-    try:
-        # Continuously listen for messages from the client
-        #async for message in websocket:
-        while True:
-
-            message = await websocket.recv()
-
-            #print(message)
-            # Parse the incoming message as JSON
-            if message != "":
-                message_data = json.loads(message)
-                #if message_data.get("command") == "ClientClose":
-                #    raise websocket.ConnectionClosed
-                to_client_id = message_data.get("to")
-                from_client_id = message_data.get("from")
-                command =  message_data.get("command")
-                msg = message_data.get("messages")[0]
-                logging.debug(f"Packet from {from_client_id} to {to_client_id}: command {command} with message {msg}")
-
-                if to_client_id in connected_clients:
-                    # Route the message to the intended recipient
-                    await connected_clients[to_client_id].send(json.dumps(message_data))
-                else:
-                    # Notify the sender that the target client is not connected
-                    error_message = {
-                        "command": "Error",
-                        "from": "0000-0000-0000-0000",  # Server ID
-                        "to": from_client_id,
-                        "messages": [f"Target client {to_client_id} is not connected."],
-                        "payload": ""
-                    }
-                    await websocket.send(json.dumps(error_message))
-                message = ""
-
-    except json.JSONDecodeError:
-        logging.warning("Received invalid JSON message")
-    except websockets.ConnectionClosed:
-        logging.error(f"Client {client_id} disconnected")
-    finally:
-        logging.warning(f"removing connection {client_id}")
-        # Remove the client from the connected clients dictionary on disconnection
-
-        del connected_clients[client_id]
-
-
-async def start_server():
-    # Define the host and port for the server
-    server = await websockets.serve(handle_client, "localhost", 1984,max_size=10000000,ping_interval=10, ping_timeout=360)  # Replace "localhost" and 8765 if needed
-
-    logging.info("WebSocket server started on ws://localhost:1984")
-    #await server.wait_closed()
-    await asyncio.Future()
+    Messages routed to this client are put on the queue and sent by a dedicated sender task, so a slow
+    receiver only ever blocks the client that is currently talking to it and not the whole relay.
+    """
+
+    def __init__(self, client_id, websocket, max_queue_size):
+        self.client_id = client_id
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.room = None
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.sender_task = None
+
+    def start(self):
+        self.sender_task = asyncio.create_task(self._drain())
+
+    async def enqueue(self, message, timeout=None):
+        """
+        Put a message on the send queue, waiting while the queue is full (backpressure).
+
+        Args:
+            message (str): The serialised message to send.
+            timeout (float): Seconds to wait for a free slot before giving up, None waits forever.
+
+        Raises:
+            asyncio.TimeoutError: If the queue stayed full for longer than timeout.
+        """
+        await asyncio.wait_for(self.queue.put(message), timeout=timeout)
+
+    async def _drain(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                await self.websocket.send(message)
+                self.messages_sent += 1
+                self.bytes_sent += len(message)
+                self.queue.task_done()
+        except websockets.ConnectionClosed:
+            logging.info(f"Sender for {self.client_id} stopped, connection closed")
+        except asyncio.CancelledError:
+            pass
+
+    async def close(self):
+        if self.sender_task is not None:
+            self.sender_task.cancel()
+            try:
+                await self.sender_task
+            except asyncio.CancelledError:
+                pass
+
+
+class Room:
+    """
+    A session between a pair of clients, usually one experiment runner and one simulator.
+
+    Keeps the counters used by the stats endpoint.
+    """
+
+    def __init__(self, members, rate_window=10.0):
+        self.room_id = str(uuid.uuid4())
+        self.key = frozenset(members)
+        self.members = set(members)
+        self.created = time.time()
+        self.messages = 0
+        self.bytes = 0
+        self.rate_window = rate_window
+        self._recent = deque()  # timestamps of messages within the rate window
+
+    def record(self, num_bytes):
+        now = time.monotonic()
+        self.messages += 1
+        self.bytes += num_bytes
+        self._recent.append(now)
+        self._trim(now)
+
+    def messages_per_second(self):
+        now = time.monotonic()
+        self._trim(now)
+        return len(self._recent) / self.rate_window
+
+    def _trim(self, now):
+        while self._recent and now - self._recent[0] > self.rate_window:
+            self._recent.popleft()
+
+
+class RelayServer:
+    """
+    Websocket relay that routes packets between clients, grouped into per-pair rooms.
+
+    Simulators join a pool when they acknowledge the server handshake (or send an Announce packet with their
+    role and capability tag). Experiment runners send Claim to get a free simulator and Release, or simply
+    disconnect, to return it to the pool for the next runner.
+
+    Every client gets a bounded send queue. When the queue of a receiver is full the handler of the sending
+    client waits before reading its next message, which pushes the backpressure down to the sender's socket.
+    A GET request on /stats returns a JSON report of all sessions instead of upgrading to a websocket.
+    """
+
+    def __init__(self, host="localhost", port=1984, max_queue_size=32, send_timeout=60.0,
+                 max_size=10000000, ping_interval=10, ping_timeout=360):
+        self.host = host
+        self.port = port
+        self.max_queue_size = max_queue_size
+        self.send_timeout = send_timeout
+        self.max_size = max_size
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+
+        self.clients = {}
+        self.rooms = {}  # frozenset of the two client ids -> Room
+        self.simulators = {}  # simulator client id -> {"capability": ..., "claimed_by": runner id or None}
+        self.started = time.time()
+        self._loop = None
+        self._stop_event = None
+        self._ready = threading.Event()
+
+    async def handle_client(self, websocket, path=None):
+        client_id = str(uuid.uuid4())
+        client = ClientConnection(client_id, websocket, self.max_queue_size)
+        self.clients[client_id] = client
+        client.start()
+        logging.info(f"Client connected and registered with network id: {client_id}")
+
+        #sending handshake to client
+        byte_array = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x01'
+        handshake_data = {
+            "command": "Handshake",
+            "from": SERVER_ID,
+            "to": client_id,
+            "messages": ["action perception server V1.0.", "your network id is registered"],
+            "payload": base64.b64encode(byte_array).decode('utf-8')
+        }
+        await client.enqueue(json.dumps(handshake_data))
+
+        try:
+            # Continuously listen for messages from the client
+            async for message in websocket:
+                if message == "":
+                    continue
+                try:
+                    message_data = json.loads(message)
+                except json.JSONDecodeError:
+                    logging.warning(f"Received invalid JSON message from {client_id}")
+                    continue
+                await self.route(client, message_data, message)
+
+        except websockets.ConnectionClosed:
+            logging.error(f"Client {client_id} disconnected")
+        finally:
+            logging.warning(f"removing connection {client_id}")
+            await self.remove_client(client)
+
+    async def route(self, sender, message_data, raw_message):
+        """
+        Route a single packet from sender to the client named in its "to" field.
+
+        Args:
+            sender (ClientConnection): The client that sent the packet.
+            message_data (dict): The parsed packet.
+            raw_message (str): The packet as received, forwarded unchanged.
+        """
+        to_client_id = message_data.get("to")
+        from_client_id = message_data.get("from")
+        command = message_data.get("command")
+        messages = message_data.get("messages") or [""]
+        logging.debug(f"Packet from {from_client_id} to {to_client_id}: command {command} with message {messages[0]}")
+
+        if to_client_id == SERVER_ID:
+            await self.handle_server_command(sender, message_data)
+            return
+
+        target = self.clients.get(to_client_id)
+        if target is None:
+            # Notify the sender that the target client is not connected
+            await self.send_error(sender, f"Target client {to_client_id} is not connected.")
+            return
+
+        room = self.join_room(sender, target)
+        try:
+            await target.enqueue(raw_message, timeout=self.send_timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Send queue of {to_client_id} stayed full for {self.send_timeout}s, dropping packet")
+            await self.send_error(sender, f"Target client {to_client_id} is not receiving.")
+            return
+        room.record(len(raw_message))
+
+    async def handle_server_command(self, sender, message_data):
+        command = message_data.get("command")
+        if command == "ClientClose":
+            logging.info(f"Client {sender.client_id} is closing the connection")
+            await sender.websocket.close()
+        elif command == "ACK":
+            # The simulator acknowledges the server handshake, which is how it announces itself
+            self.register_simulator(sender, capability=DEFAULT_CAPABILITY)
+        elif command == "Announce":
+            announcement = parse_pairing_message(message_data)
+            if announcement.get("role", "simulator") == "simulator":
+                self.register_simulator(sender, capability=announcement.get("capability", DEFAULT_CAPABILITY))
+        elif command == "Claim":
+            request = parse_pairing_message(message_data)
+            await self.claim_simulator(sender, capability=request.get("capability"))
+        elif command == "Release":
+            self.release_simulators(sender)
+        else:
+            logging.debug(f"Packet {command} from {sender.client_id} addressed to the server")
+
+    def register_simulator(self, client, capability):
+        """Add a simulator to the pool of free simulators, keeping any existing claim."""
+        entry = self.simulators.setdefault(client.client_id, {"capability": capability, "claimed_by": None})
+        entry["capability"] = capability
+        logging.info(f"Simulator {client.client_id} announced with capability '{capability}'")
+
+    async def claim_simulator(self, runner, capability=None):
+        """
+        Hand a free simulator to the runner, replying with Claimed or NoSimulator.
+
+        Args:
+            runner (ClientConnection): The experiment runner asking for a simulator.
+            capability (str): Only simulators announced with this tag qualify, None accepts any.
+        """
+        simulator_id = None
+        for client_id, entry in self.simulators.items():
+            if entry["claimed_by"] is None and capability in (None, entry["capability"]):
+                simulator_id = client_id
+                break
+
+        if simulator_id is None:
+            reply = {"command": "NoSimulator", "messages": [f"No free simulator with capability '{capability}'."]}
+        else:
+            self.simulators[simulator_id]["claimed_by"] = runner.client_id
+            self.join_room(runner, self.clients[simulator_id])
+            logging.info(f"Simulator {simulator_id} claimed by {runner.client_id}")
+            reply = {"command": "Claimed", "messages": [simulator_id]}
+
+        reply.update({"from": SERVER_ID, "to": runner.client_id, "payload": ""})
+        await runner.enqueue(json.dumps(reply), timeout=self.send_timeout)
+
+    def release_simulators(self, runner):
+        """Return every simulator claimed by the runner to the pool."""
+        for client_id, entry in self.simulators.items():
+            if entry["claimed_by"] == runner.client_id:
+                entry["claimed_by"] = None
+                logging.info(f"Simulator {client_id} released by {runner.client_id}")
+
+    async def send_error(self, client, text):
+        error_message = {
+            "command": "Error",
+            "from": SERVER_ID,
+            "to": client.client_id,
+            "messages": [text],
+            "payload": ""
+        }
+        try:
+            await client.enqueue(json.dumps(error_message), timeout=self.send_timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Could not deliver error to {client.client_id}: {text}")
+
+    def join_room(self, client_a, client_b):
+        """Return the room of the pair, creating it and leaving previous rooms if needed."""
+        key = frozenset((client_a.client_id, client_b.client_id))
+        room = self.rooms.get(key)
+        if room is None:
+            for client in (client_a, client_b):
+                self.leave_room(client)
+            room = Room(key)
+            self.rooms[key] = room
+            logging.info(f"Opened room {room.room_id} for {client_a.client_id} and {client_b.client_id}")
+        client_a.room = room
+        client_b.room = room
+        return room
+
+    def leave_room(self, client):
+        """Close the room of the client, detaching its partner as well."""
+        room = client.room
+        if room is None:
+            return
+        for member_id in room.members:
+            member = self.clients.get(member_id)
+            if member is not None and member.room is room:
+                member.room = None
+        self.rooms.pop(room.key, None)
+        logging.info(f"Closed room {room.room_id}")
+
+    async def remove_client(self, client):
+        self.leave_room(client)
+        self.release_simulators(client)
+        self.simulators.pop(client.client_id, None)
+        self.clients.pop(client.client_id, None)
+        await client.close()
+
+    def stats(self):
+        """
+        Collect the relay statistics reported by the /stats endpoint.
+
+        Returns:
+            dict: Server totals and, for every room, message rate, bytes and the queue depth of each member.
+        """
+        sessions = []
+        for room in self.rooms.values():
+            sessions.append({
+                "room_id": room.room_id,
+                "members": sorted(room.members),
+                "age_seconds": round(time.time() - room.created, 1),
+                "messages": room.messages,
+                "bytes": room.bytes,
+                "messages_per_second": round(room.messages_per_second(), 3),
+                "queue_depth": {m: self.clients[m].queue.qsize() for m in room.members if m in self.clients},
+            })
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "connected_clients": len(self.clients),
+            "simulators": {
+                "total": len(self.simulators),
+                "free": sum(1 for entry in self.simulators.values() if entry["claimed_by"] is None),
+            },
+            "max_queue_size": self.max_queue_size,
+            "sessions": sessions,
+        }
+
+    async def process_request(self, path, request_headers):
+        # Answer plain HTTP requests for the stats endpoint, let everything else upgrade to a websocket
+        if path.split("?")[0].rstrip("/") == "/stats":
+            body = json.dumps(self.stats(), indent=2).encode("utf-8")
+            headers = [("Content-Type", "application/json"), ("Content-Length", str(len(body)))]
+            return HTTPStatus.OK, headers, body
+        return None
+
+    async def serve(self):
+        """Run the relay until stop() is called."""
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        server = await websockets.serve(
+            self.handle_client, self.host, self.port,
+            max_size=self.max_size, ping_interval=self.ping_interval, ping_timeout=self.ping_timeout,
+            process_request=self.process_request
+        )
+        logging.info(f"WebSocket server started on ws://{self.host}:{self.port}")
+        self._ready.set()
+        try:
+            await self._stop_event.wait()
+        finally:
+            logging.info("Shutting down WebSocket server...")
+            server.close()
+            await server.wait_closed()
+            for client in list(self.clients.values()):
+                await self.remove_client(client)
+            logging.info("WebSocket server stopped")
+
+    def stop(self):
+        """Stop the relay, safe to call from any thread."""
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+    def wait_until_ready(self, timeout=None):
+        return self._ready.wait(timeout)
 
 
 # WebSocket server logic
-async def start_WebSocket_server():
+async def start_WebSocket_server(relay=None):
     logging.info("Starting WebSocket Server...")
-    server = await websockets.serve(handle_client, "localhost", 1984, max_size=10000000, ping_interval=10, ping_timeout=360)
-    logging.info("WebSocket server started on ws://localhost:1984")
-    await asyncio.Future()  # Keep running indefinitely
+    relay = relay or RelayServer()
+    await relay.serve()
+
 
 # Background server runners
-def run_WebSocket_server_in_background():
-    thread = threading.Thread(target=lambda: asyncio.run(start_WebSocket_server()), daemon=True)
+def run_WebSocket_server_in_background(**relay_params):
+    """
+    Start the relay in a daemon thread.
+
+    Returns:
+        RelayServer: The running relay, call stop() on it for a clean shutdown.
+    """
+    relay = RelayServer(**relay_params)
+    thread = threading.Thread(target=lambda: asyncio.run(start_WebSocket_server(relay)), daemon=True)
     thread.start()
+    relay.wait_until_ready(timeout=10)
     logging.info("WebSocket server started in the background.")
+    return relay
 
 
 if __name__ == "__main__":
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-    webApp_dir = os.path.join(base_dir, 'iVISPAR')
-
-
-    #Run the server in the background
-    asyncio.run(start_server())
-    while True:
-        pass
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(start_WebSocket_server())
+    except KeyboardInterrupt:
+        logging.info("WebSocket server interrupted")
@@ -7,6 +7,12 @@ from PIL import Image, ImageDraw, ImageFont,ImageSequence
 from moviepy import ImageSequenceClip
 import numpy as np
 import json
+import sys
+
+# The observation archive is written by the experiment code
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Experiment')))
+from observation_archive import ObservationArchive, archive_path, frame_sort_key
+from annotation import add_action_text
 
 
 def add_background_to_transparent_images(images, background_color=(0, 0, 0)):
@@ -31,83 +37,6 @@ def add_background_to_transparent_images(images, background_color=(0, 0, 0)):
     return processed_images
 
 
-def add_action_text(image, action_text, color="black"):
-    """
-    Adds the action text in large red letters with a light white, semi-transparent box behind it
-    on the top-right corner of the image, 50 pixels away from the top and right border, with rounded corners.
-
-    Args:
-        image (PIL.Image): The image on which to add the action text.
-        action_text (str): The action text to add to the image.
-
-    Returns:
-        PIL.Image: The image with the action text added.
-    """
-    # Ensure the image is in RGBA mode (supports transparency)
-    if image.mode != 'RGBA':
-        image = image.convert('RGBA')
-
-
-    # Create a drawing context
-    draw = ImageDraw.Draw(image)
-
-    # Try to load a larger font size
-    try:
-        font = ImageFont.truetype("arial.ttf", 50)  # Increased font size to 80
-    except IOError:
-        print("Warning: 'arial.ttf' not found. Using default font.")
-        font = ImageFont.load_default()
-
-    # Get text bounding box
-    text_bbox = draw.textbbox((0, 0), action_text, font=font)
-    text_width, text_height = text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]
-
-    # Add extra padding to make the box slightly larger than the text
-    box_extra_padding = 20  # Adjust this value to control how much larger the box should be
-    border_thickness = 3  # Thickness of the black border
-
-    # Set padding, border offset, and corner radius for rounded edges
-    padding = 10
-    border_offset = 50
-    corner_radius = 20  # Radius for the rounded corners
-
-    # Calculate box and text position (50 pixels from the top and right with additional padding)
-    text_x = image.width - text_width - padding - border_offset
-    text_y = border_offset
-    box_x0 = text_x - padding - box_extra_padding
-    box_y0 = text_y - padding - box_extra_padding
-    box_x1 = image.width - padding - border_offset + box_extra_padding
-    box_y1 = text_y + text_height + padding + box_extra_padding
-
-    # Create a semi-transparent overlay
-    overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))  # Transparent overlay
-    overlay_draw = ImageDraw.Draw(overlay)
-
-    # Draw a black border (slightly larger rectangle)
-    overlay_draw.rounded_rectangle(
-        [box_x0 - border_thickness, box_y0 - border_thickness,
-         box_x1 + border_thickness, box_y1 + border_thickness],
-        radius=corner_radius + border_thickness,
-        fill=(0, 0, 0, 255)  # Black border
-    )
-
-    # Draw a semi-transparent white box with rounded corners (50% transparency)
-    overlay_draw.rounded_rectangle(
-        [box_x0, box_y0, box_x1, box_y1],
-        radius=corner_radius,
-        fill=(255, 255, 255, 128)
-    )
-
-    # Composite the overlay onto the image
-    image = Image.alpha_composite(image, overlay)
-
-    # Draw the text in red on the original image
-    draw = ImageDraw.Draw(image)
-    draw.text((text_x, text_y), action_text, font=font, fill=color)
-
-    return image
-
-
 def load_images_and_actions(subdir_path):
     """
     Loads images and extracts the actions from their filenames, excluding 'init'.
@@ -126,17 +55,22 @@ def load_images_and_actions(subdir_path):
 
     obs_dir = os.path.join(subdir_path, "obs")
 
-    # Get all image files from the 'obs' directory, excluding files that end with "_compare.png"
-    files = [f for f in os.listdir(obs_dir) if f.endswith(".png") and not f.endswith("_compare.png")]
+    if os.path.exists(archive_path(subdir_path)):
+        # Read all frames from the episode archive, sorted by step like the image files
+        with ObservationArchive(subdir_path) as archive:
+            images = [archive.read_image(name) for name in archive.names() if not name.endswith("_compare")]
+    else:
+        # Get all image files from the 'obs' directory, excluding files that end with "_compare.png"
+        files = [f for f in os.listdir(obs_dir) if f.endswith(".png") and not f.endswith("_compare.png")]
 
-    # Sort files numerically based on the number in the filename
-    files.sort(key=lambda f: int(re.search(r'\d+', f).group()))
+        # Sort files numerically based on the number in the filename
+        files.sort(key=lambda f: int(re.search(r'\d+', f).group()))
 
-    # Iterate over the files to load images and extract actions
-    for filename in files:
-        image_path = os.path.join(obs_dir, filename)
-        image = Image.open(image_path)
-        images.append(image)
+        # Iterate over the files to load images and extract actions
+        for filename in files:
+            image_path = os.path.join(obs_dir, filename)
+            image = Image.open(image_path)
+            images.append(image)
 
     # Define the file path
     action_text_file_path = os.path.join(subdir_path, 'agent_message_log.txt')
@@ -149,6 +83,43 @@ def load_images_and_actions(subdir_path):
     return images, actions
 
 
+def observation_names(subdir_path):
+    """
+    Lists the observation frames of an episode, from its archive or from the obs_*.png files.
+
+    Args:
+        subdir_path (str): The episode directory.
+
+    Returns:
+        list: The frame names without extension (e.g. obs_3_3D), sorted by step.
+    """
+    if os.path.exists(archive_path(subdir_path)):
+        with ObservationArchive(subdir_path) as archive:
+            return archive.names()
+    obs_dir = os.path.join(subdir_path, "obs")
+    if not os.path.exists(obs_dir):
+        return []
+    names = [os.path.splitext(f)[0] for f in os.listdir(obs_dir) if f.startswith('obs_') and f.endswith('.png')]
+    return sorted(names, key=frame_sort_key)
+
+
+def load_observation(subdir_path, name):
+    """
+    Loads one observation frame of an episode as a PIL image, from its archive or from its png file.
+
+    Args:
+        subdir_path (str): The episode directory.
+        name (str): The frame name without extension, as returned by observation_names.
+
+    Returns:
+        PIL.Image.Image: The frame.
+    """
+    if os.path.exists(archive_path(subdir_path)):
+        with ObservationArchive(subdir_path) as archive:
+            return archive.read_image(name)
+    return Image.open(os.path.join(subdir_path, "obs", f"{name}.png"))
+
+
 def load_params_from_json(file_name):
     """
     Loads parameters from a JSON file and returns them as a dictionary.
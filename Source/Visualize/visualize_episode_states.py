@@ -1,7 +1,8 @@
 from PIL import Image
 import os
 
-from visualization_utilities import add_action_text, add_background_to_transparent_images, load_params_from_json
+from visualization_utilities import (add_action_text, add_background_to_transparent_images, load_params_from_json,
+                                     observation_names, load_observation)
 
 
 def visualize_full_state_progression(experiment_id, white_bar_width=20):
@@ -24,44 +25,38 @@ def visualize_full_state_progression(experiment_id, white_bar_width=20):
         if not os.path.isdir(subdir_path):
             continue  # Skip non-directory files
 
-        obs_dir = os.path.join(subdir_path, "obs")
+        obs_names = observation_names(subdir_path)
 
-        if not os.path.exists(obs_dir):
-            print(f"No 'obs' directory found in {subdir_path}. Skipping...")
+        if not obs_names:
+            print(f"No observations found in {subdir_path}. Skipping...")
             continue
 
-        obs_files = [f for f in os.listdir(obs_dir) if f.startswith('obs_') and f.endswith('.png')]
+        # Frames for initial, goal, and result state
+        init_state_name = "obs_1"
+        goal_state_name = "obs_0"
 
-        if not obs_files:
-            print(f"No 'obs_*.png' files found in {obs_dir}. Skipping...")
-            continue
-
-        # Paths for initial, goal, and result state images
-        init_state_image_path = os.path.join(obs_dir, "obs_1.png")
-        goal_state_image_path = os.path.join(obs_dir, "obs_0.png")
-
-        # Extract numbers from filenames to find the highest for the last observed state
-        obs_numbers = [int(f.split('_')[1].split('.')[0]) for f in obs_files if f.split('_')[1].split('.')[0].isdigit()]
+        # Extract numbers from frame names to find the highest for the last observed state
+        obs_numbers = [int(name.split('_')[1]) for name in obs_names if name.split('_')[1].isdigit()]
         max_obs_number = max(obs_numbers)
-        result_state_image_path = os.path.join(obs_dir, f"obs_{max_obs_number}.png")
+        result_state_name = f"obs_{max_obs_number}"
 
-        # Ensure all images exist
-        if not all(os.path.exists(path) for path in [init_state_image_path, goal_state_image_path, result_state_image_path]):
+        # Ensure all frames exist
+        if not all(name in obs_names for name in [init_state_name, goal_state_name, result_state_name]):
             print(f"Missing images in {subdir_path}. Skipping...")
             continue
 
         # Load and annotate images
-        init_image = Image.open(init_state_image_path)
+        init_image = load_observation(subdir_path, init_state_name)
         init_image = add_background_to_transparent_images([init_image.copy()], tuple(color_codes['start']['rgb']))
         init_image = init_image[0]
         init_image = add_action_text(init_image.copy(), color_codes['start']['type'], "black")
 
-        result_image = Image.open(result_state_image_path)
+        result_image = load_observation(subdir_path, result_state_name)
         result_image = add_background_to_transparent_images([result_image.copy()], tuple(color_codes['last']['rgb']))
         result_image = result_image[0]
         result_image = add_action_text(result_image.copy(),  color_codes['last']['type'], "black")
 
-        goal_image = Image.open(goal_state_image_path)
+        goal_image = load_observation(subdir_path, goal_state_name)
         goal_image = add_background_to_transparent_images([goal_image.copy()], tuple(color_codes['goal_1']['rgb']))
         goal_image = goal_image[0]
         goal_image = add_action_text(goal_image.copy(), color_codes['goal_1']['type'], "black")